@@ -18,18 +18,10 @@ import re
 import json
 import requests
 #requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
-import logging as log
+import logging
+from netcontrol.ssh.ssh import debug_log
 
-# remove warning message on certificates
-
-log.basicConfig(
-    format='%(asctime)s,%(msecs)3.3d\
-    %(levelname)-8s[%(module)-7.7s.%(funcName)\
-    -30.30s:%(lineno)5d] %(message)s',
-    datefmt='%Y%m%d:%H:%M:%S',
-    filename='debug.log',
-    level=log.NOTSET
-    )
+log = logging.getLogger('netcontrol.fabric')
 
 class Fabric(object):
     """
@@ -38,7 +30,7 @@ class Fabric(object):
     def __init__(self, ip='', port=443, user='admin', password='', debug=False):
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
+            debug_log()
 
         log.debug("Constructor with ip={}, port={}, user={}, password={}, debug={}".
                  format(ip, port, user, password, debug))
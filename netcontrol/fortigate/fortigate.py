@@ -6,28 +6,31 @@ Created on Fev 25, 2020
 Driver for FortiGate
 """
 
-from netcontrol.ssh.ssh import Ssh
-import logging as log
+from netcontrol.ssh.ssh import Ssh, AsyncSsh, ssh_steps, debug_log
+import functools
+import logging
 import re
 
+log = logging.getLogger('netcontrol.fortigate')
+
+
 class Fortigate(object):
     """
     classdocs
     """
-    def __init__(self, ip='', port=22, user='admin', password='', private_key_file='', mock=False, debug=False):
+    # ssh session class, see AsyncFortigate
+    ssh_class = Ssh
+    # default deadline in seconds of each ssh call (see Ssh.deadline)
+    deadline = 30
+
+    def __init__(self, ip='', port=22, user='admin', password='', private_key_file='', mock=False, debug=False, pool=None, jump=None):
         '''
         Constructor
         '''
-        # create logger
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
 
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
+            debug_log()
 
         log.debug("Constructor with ip={}, port={}, user={}, password={}, private_key_file={}, debug={}".
                  format(ip, port, user, password, private_key_file, debug))
@@ -40,7 +43,8 @@ class Fortigate(object):
         self.private_key_file = private_key_file
         self.moke_context = ''
         self.debug = debug
-        self.ssh = Ssh(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug)
+        self.ssh = self.ssh_class(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug, pool=pool, jump=jump)
+        self.ssh.deadline = self.deadline
 
         # private attributs
 
@@ -57,10 +61,14 @@ class Fortigate(object):
     def trace_mark(self, mark):
         self.ssh.trace_mark(mark)
 
+    def trace_flush(self):
+        self.ssh.trace_flush()
+
     def close(self):
         if self.ssh:
             self.ssh.close()
 
+    @ssh_steps
     def cli(self, commands=[]):
         """
         Sends a list of commands to FortiGate CLI
@@ -71,16 +79,15 @@ class Fortigate(object):
         log.debug("Enter with commands={}".format(commands))
 
         # Send command
-        if not self.ssh.connected:
-            self.ssh.connect()
 
         # issue command and capture output
         for command in commands:
             command = command + "\n"
-            self.run_op_mode_command(command)
+            yield from self.run_op_mode_command.steps(self, command)
 
-            log.debug("command={} output={}".format(command, self.ssh.output))
+            log.debug("command=%s output=%s", command, self.ssh.output)
 
+    @ssh_steps
     def enter_vdom(self, vdom=None):
         """
         Enters a specific vdom
@@ -99,17 +106,15 @@ class Fortigate(object):
             log.error("please provide vdom name")
             raise SystemExit
 
-        if not self.ssh.connected:
-            self.ssh.connect()
 
         # Leave current vdom or global section
-        self.run_op_mode_command("end\n")
+        yield from self.run_op_mode_command.steps(self, "end\n")
         # Enter vdom
-        self.run_op_mode_command("config vdom\n")
-        self.run_op_mode_command("edit "+str(vdom)+"\n")
+        yield from self.run_op_mode_command.steps(self, "config vdom\n")
+        yield from self.run_op_mode_command.steps(self, "edit "+str(vdom)+"\n")
 
         for line in self.ssh.output.splitlines():
-            log.debug("line={}".format(line))
+            log.debug("line=%s", line)
             match_vdom = re.search("\s\((?P<vd>\S+)\)\s", line)
             if match_vdom:
                 vd = match_vdom.group('vd')
@@ -117,9 +122,13 @@ class Fortigate(object):
                 if vd == vdom:
                     log.debug("Confirmed vdom prompt")
                     result = True
+        if result:
+            # restored if the session is reconnected
+            self.ssh.replay = ["end\n", "config vdom\n", "edit "+str(vdom)+"\n"]
 
         return result
 
+    @ssh_steps
     def enter_global(self):
         """
         Enters global section
@@ -132,24 +141,26 @@ class Fortigate(object):
         log.debug("Enter")
         result = False
 
-        if not self.ssh.connected:
-            self.ssh.connect()
 
         # Leave current vdom or global section
-        self.run_op_mode_command("end\n")
+        yield from self.run_op_mode_command.steps(self, "end\n")
 
         # Enter global
-        self.run_op_mode_command("config global\n")
+        yield from self.run_op_mode_command.steps(self, "config global\n")
 
         for line in self.ssh.output.splitlines():
-            log.debug("line={}".format(line))
+            log.debug("line=%s", line)
             match_global = re.search("\s\(global\)\s", line)
             if match_global:
                log.debug("Confirmed global prompt")
                result = True
+        if result:
+            # restored if the session is reconnected
+            self.ssh.replay = ["end\n", "config global\n"]
 
         return result
 
+    @ssh_steps
     def get_status(self):
         """
         Returns a dictionary with FortiGate version, license status
@@ -166,10 +177,8 @@ class Fortigate(object):
         found_version = False
         found_license = False
 
-        if not self.ssh.connected:
-            self.ssh.connect()
 
-        self.run_op_mode_command("get sys status | grep '^Version\|License St'\n")
+        yield from self.run_op_mode_command.steps(self, "get sys status | grep '^Version\|License St'\n")
         #
         # FGT-B1-1 # get sys status | grep '^Version\|License St'
         #Version: FortiGate-VM64-KVM v6.2.3,build8348,200304 (GA)
@@ -196,9 +205,10 @@ class Fortigate(object):
         if not found_license:
             log.error("Could not extract license status")
 
-        log.debug("result={}".format(result))
+        log.debug("result=%s", result)
         return result
 
+    @ssh_steps
     def get_ike_and_ipsec_sa_number(self):
         """
         Returns a dictionary with the number of 'created' and 'connected' ike and ispec SA
@@ -213,10 +223,8 @@ class Fortigate(object):
         log.debug("Enter")
         result = {'ike': {}, 'ipsec' : {} }
 
-        if not self.ssh.connected:
-            self.ssh.connect()
 
-        self.run_op_mode_command("diagnose vpn ike status\n")
+        yield from self.run_op_mode_command.steps(self, "diagnose vpn ike status\n")
         # FGT-B1-1 #  diagnose vpn ike status
         #connection: 3/348
         #IKE SA: created 3/348  established 3/3  times 0/2083/3220 ms
@@ -243,9 +251,10 @@ class Fortigate(object):
         else:
             log.debug("Could not extract IPsec SA numbers")
 
-        log.debug("result={}".format(result))
+        log.debug("result=%s", result)
         return result
 
+    @ssh_steps
     def get_bgp_routes(self, vrf='0'):
        """
        Returns information on BGP routes for the given VRF like :
@@ -288,17 +297,15 @@ class Fortigate(object):
        log.debug("Enter with vrf={}".format(vrf))
        result = { 'total' : {}, 'subnet' : [], 'nexthop' : [], 'interface' : [] }
 
-       if not self.ssh.connected:
-            self.ssh.connect()
 
-       self.run_op_mode_command("get router info routing-table bgp\n")
+       yield from self.run_op_mode_command.steps(self, "get router info routing-table bgp\n")
 
        # Start checking routes when seeing "VRF=xxx"
        vrf_flag = False
        nb_route = 0
        nb_recursive_route = 0
        for line in self.ssh.output.splitlines():
-           log.debug("line={}".format(line))
+           log.debug("line=%s", line)
            if not vrf_flag:
                match_vrf = re.search("Routing\stable\sfor\sVRF="+str(vrf),line)
                if match_vrf:
@@ -342,9 +349,10 @@ class Fortigate(object):
 
        result['total'] = nb_route
        result['recursive'] = nb_recursive_route
-       log.debug("result={}".format(result))
+       log.debug("result=%s", result)
        return result
 
+    @ssh_steps
     def get_sdwan_service(self, service='1', version='6.4'):
         """
         Returns a dictionary with information from
@@ -372,15 +380,13 @@ class Fortigate(object):
         result = {'members': {}, 'mode':''}
         members_flag = False
         mode = ''
-        if not self.ssh.connected:
-            self.ssh.connect()
         cmd = "diagnose sys sdwan service"
         if version == '6.2':
             log.debug("old 6.2 command required")
             cmd = 'diagnose sys virtual-wan-link service'
-        self.run_op_mode_command("{} {}\n".format(cmd, service))
+        yield from self.run_op_mode_command.steps(self, "{} {}\n".format(cmd, service))
         for line in self.ssh.output.splitlines():
-            log.debug("line={}".format(line))
+            log.debug("line=%s", line)
             # Get mode
             match_mode = re.search("(?:,\sMode\()(?P<mode>\S+)(?:\))", line)
             if match_mode:
@@ -415,6 +421,7 @@ class Fortigate(object):
                 members_flag = True
         return result
 
+    @ssh_steps
     def get_session(self, filter={}):
         """
         Filter and retrieve a session from the session list
@@ -507,100 +514,109 @@ class Fortigate(object):
             else:
                 command_list.append("diagnose sys session filter "+key+" "+str(filter[key])+"\n")
 
-        command_list.append("diagnose sys session list\n")
-        self.ssh.shell_send(command_list)
-        result = self._session_analysis()
+        # Filters are sent at once, session list is parsed while received
+        yield 'shell_send', command_list, True
+        yield 'shell_stream', "diagnose sys session list\n", functools.partial(self._session_line, result)
+        log.debug("result=%s", result)
         return (result)
 
 
+    @ssh_steps
     def run_op_mode_command(self, cmd):
         """
         Use netcontrol shell to send commands to vyos
         """
         log.debug("Enter with cmd={}".format(cmd))
-        self.ssh.shell_send([cmd])
+        yield 'shell_send', [cmd]
         return(self.ssh.output)
 
-    def _session_analysis(self):
+    def _session_line(self, result, line):
         """
-        Returns a json reflecting the session
-        Takes self.ssh.output as input
+        Parses a line of the session list, adding what is found to the
+        result dictionary
         """
-        log.debug("Enter")
-        result = {}
+        log.debug("line=%s", line)
+
+        # session info: proto=6 proto_state=01 duration=375 expire=3599 timeout=3600 flags=00000000 sockflag=00000000 sockport=0 av_idx=0 use=4
+        match_session_info = re.search("^session\sinfo:\sproto=(?P<proto>\d+)\sproto_state=(?P<proto_state>\d+)\sduration=(?P<duration>\d+)\sexpire=(?P<expire>\d+)\stimeout=(?P<timeout>\d+)",line)
+        if match_session_info:
+            proto = match_session_info.group('proto')
+            proto_state = match_session_info.group('proto_state')
+            duration = match_session_info.group('duration')
+            expire = match_session_info.group('expire')
+            timeout = match_session_info.group('timeout')
+            log.debug("session-info : proto=%s proto_state=%s duration=%s expire=%s timeout=%s", proto, proto_state, duration, expire, timeout)
+            result['proto'] = proto
+            result['proto_state'] = proto_state
+            result['duration'] = duration
+            result['expire'] = expire
+            result['timeout'] = timeout
+
+        # state=log local may_dirty
+        match_state = re.search("^state=(?P<state>.+)", line)
+        if match_state:
+            states = []
+            session_states = match_state.group('state')
+            log.debug("states: %s", session_states)
+            for flag in session_states.split():
+                log.debug("flag=%s", flag)
+                states.append(flag)
+            result['state'] = states
+
+        # statistic(bytes/packets/allow_err): org=28670/369/1 reply=21275/200/1 tuples=2
+        match_statistic = re.search("^statistic\(bytes/packets/allow_err\):\sorg=(?P<org_byte>\d+)/(?P<org_packet>\d+)/\d\sreply=(?P<reply_byte>\d+)/(?P<reply_packet>\d+)",line)
+        if match_statistic:
+            stats = {}
+            org_byte = match_statistic.group('org_byte')
+            org_packet = match_statistic.group('org_packet')
+            reply_byte = match_statistic.group('reply_byte')
+            reply_packet = match_statistic.group('reply_packet')
+            log.debug("org_byte=%s org_packet=%s reply_byte=%s reply_packet=%s", org_byte, org_packet, reply_byte, reply_packet)
+            stats['org_byte'] = org_byte
+            stats['org_packet'] = org_packet
+            stats['reply_byte'] = reply_byte
+            stats['reply_packet'] = reply_packet
+            result['statistics'] = stats
+
+        # orgin->sink: org pre->in, reply out->post dev=28->24/24->28 gwy=10.199.3.1/0.0.0.0
+        match_dev_gw = re.search("\sdev=(?P<dev>[0-9-/>]+)\sgwy=(?P<gwy>[0-9./]+)",line)
+        if match_dev_gw:
+            dev = match_dev_gw.group('dev')
+            gwy = match_dev_gw.group('gwy')
+            log.debug("dev=%s gwy=%s", dev, gwy)
+
+        # hook=pre dir=org act=noop 10.199.3.10:36990->10.199.3.1:222(0.0.0.0:0)
+        match_ip = re.search("^hook=pre\sdir=org\sact=noop\s(?P<src>[0-9.]+):(?P<sport>\d+)->(?P<dest>[0-9.]+):(?P<dport>\d+)",line)
+        if match_ip:
+            src = match_ip.group('src')
+            sport = match_ip.group('sport')
+            dest =  match_ip.group('dest')
+            dport = match_ip.group('dport')
+            result['src'] = src
+            result['sport'] = sport
+            result['dest'] = dest
+            log.debug("src=%s sport=%s dest=%s dport=%s", src, sport, dest, dport)
+
+        # Total session (should be 1 ideally)
+        match_total_session = re.search("^total\ssession\s(?P<total>\d+)", line)
+        if match_total_session:
+            total = match_total_session.group('total')
+            result['total'] = total
+
+
+class AsyncFortigate(Fortigate):
+    """
+    asyncio flavour of Fortigate, backed by AsyncSsh
+    Every method talking to the device is a coroutine
+    """
+    ssh_class = AsyncSsh
+
+    async def connect(self):
+        await self.ssh.connect()
+
+    async def close(self):
+        await self.ssh.close()
 
-        # Parse and build session json
-        for line in self.ssh.output.splitlines():
-            log.debug("line={}".format(line))
-
-            # session info: proto=6 proto_state=01 duration=375 expire=3599 timeout=3600 flags=00000000 sockflag=00000000 sockport=0 av_idx=0 use=4
-            match_session_info = re.search("^session\sinfo:\sproto=(?P<proto>\d+)\sproto_state=(?P<proto_state>\d+)\sduration=(?P<duration>\d+)\sexpire=(?P<expire>\d+)\stimeout=(?P<timeout>\d+)",line)
-            if match_session_info:
-                proto = match_session_info.group('proto')
-                proto_state = match_session_info.group('proto_state')
-                duration = match_session_info.group('duration')
-                expire = match_session_info.group('expire')
-                timeout = match_session_info.group('timeout')
-                log.debug("session-info : proto={} proto_state={} duration={} expire={} timeout={}".format(proto, proto_state, duration, expire, timeout))
-                result['proto'] = proto
-                result['proto_state'] = proto_state
-                result['duration'] = duration
-                result['expire'] = expire
-                result['timeout'] = timeout
-
-            # state=log local may_dirty
-            match_state = re.search("^state=(?P<state>.+)", line)
-            if match_state:
-                states = []
-                session_states = match_state.group('state')
-                log.debug("states: {}".format(session_states))
-                for flag in session_states.split():
-                    log.debug("flag={}".format(flag))
-                    states.append(flag)
-                result['state'] = states
-
-            # statistic(bytes/packets/allow_err): org=28670/369/1 reply=21275/200/1 tuples=2
-            match_statistic = re.search("^statistic\(bytes/packets/allow_err\):\sorg=(?P<org_byte>\d+)/(?P<org_packet>\d+)/\d\sreply=(?P<reply_byte>\d+)/(?P<reply_packet>\d+)",line)
-            if match_statistic:
-                stats = {}
-                org_byte = match_statistic.group('org_byte')
-                org_packet = match_statistic.group('org_packet')
-                reply_byte = match_statistic.group('reply_byte')
-                reply_packet = match_statistic.group('reply_packet')
-                log.debug("org_byte={} org_packet={} reply_byte={} reply_packet={}".format(org_byte, org_packet, reply_byte, reply_packet))
-                stats['org_byte'] = org_byte
-                stats['org_packet'] = org_packet
-                stats['reply_byte'] = reply_byte
-                stats['reply_packet'] = reply_packet
-                result['statistics'] = stats
-
-            # orgin->sink: org pre->in, reply out->post dev=28->24/24->28 gwy=10.199.3.1/0.0.0.0
-            match_dev_gw = re.search("\sdev=(?P<dev>[0-9-/>]+)\sgwy=(?P<gwy>[0-9./]+)",line)
-            if match_dev_gw:
-                dev = match_dev_gw.group('dev')
-                gwy = match_dev_gw.group('gwy')
-                log.debug("dev={} gwy={}".format(dev, gwy))
-
-            # hook=pre dir=org act=noop 10.199.3.10:36990->10.199.3.1:222(0.0.0.0:0)
-            match_ip = re.search("^hook=pre\sdir=org\sact=noop\s(?P<src>[0-9.]+):(?P<sport>\d+)->(?P<dest>[0-9.]+):(?P<dport>\d+)",line)
-            if match_ip:
-                src = match_ip.group('src')
-                sport = match_ip.group('sport')
-                dest =  match_ip.group('dest')
-                dport = match_ip.group('dport')
-                result['src'] = src
-                result['sport'] = sport
-                result['dest'] = dest
-                log.debug("src={} sport={} dest={} dport={}".format(src,sport,dest,dport))
-
-            # Total session (should be 1 ideally)
-            match_total_session = re.search("^total\ssession\s(?P<total>\d+)", line)
-            if match_total_session:
-                total = match_total_session.group('total')
-                result['total'] = total
-
-        log.debug("result={}".format(result))
-        return result
 
 """
 Class sample code
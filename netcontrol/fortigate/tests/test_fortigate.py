@@ -6,7 +6,9 @@ Created on Fev 25, 2020
 import logging as log
 import json
 import unittest
-from fortigate import Fortigate
+import asyncio
+from fortigate import Fortigate, AsyncFortigate
+from netcontrol.ssh.ssh import SshPool
 
 # create logger
 log.basicConfig(
@@ -57,6 +59,29 @@ class FGTTestCase(unittest.TestCase):
         self.fgt.close()
         self.assertDictEqual(result, {'version': 'v6.2.3,build8348,200304', 'license': True})
 
+    ###@unittest.skip  # no reason needed
+    def test_async_get_status(self):
+        async def run():
+            fgt = AsyncFortigate(ip='192.168.122.178', port='10101', user='admin', password='', debug=True)
+            fgt.ssh.mock(context='get_system_status')
+            result = await fgt.get_status()
+            await fgt.close()
+            return result
+        result = asyncio.run(run())
+        self.assertDictEqual(result, {'version': 'v6.2.3,build8348,200304', 'license': True})
+
+    ###@unittest.skip  # no reason needed
+    def test_pooled_connection(self):
+        pool = SshPool()
+        for i in range(3):
+            fgt = Fortigate(ip='192.168.122.178', port='10101', user='admin', password='', pool=pool)
+            fgt.ssh.mock(context='get_system_status')
+            result = fgt.get_status()
+            fgt.close()
+            self.assertDictEqual(result, {'version': 'v6.2.3,build8348,200304', 'license': True})
+        self.assertEqual(pool.misses, 1)
+        self.assertEqual(pool.hits, 2)
+
     ###@unittest.skip  # no reason needed
     def test_ike_and_ipsec_SA(self):
         self.fgt.ssh.mock(context='ipsec')
@@ -103,6 +128,7 @@ class FGTTestCase(unittest.TestCase):
          self.fgt.trace_open(filename="fgt_tracefile.log")
          result = self.fgt.enter_vdom(vdom='customer')
          self.assertTrue (result)
+         self.assertEqual(self.fgt.ssh.replay, ["end\n", "config vdom\n", "edit customer\n"])
          self.fgt.close()
 
     ##@unittest.skip
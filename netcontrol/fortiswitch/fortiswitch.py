@@ -9,27 +9,28 @@ Fortiswitch control :
   - get_fsw_port_status (port: <port_name>)
   - set_fsw_port_status (port: <port_name>, status: <up|down>)  
 """
-from netcontrol.ssh.ssh import Ssh
-import logging as log
+from netcontrol.ssh.ssh import Ssh, AsyncSsh, ssh_steps, debug_log
+import logging
 import re
 import json
 
+log = logging.getLogger('netcontrol.fortiswitch')
+
 
 class Fortiswitch(object):
     """
     main class
     """
+    # ssh session class, see AsyncFortiswitch
+    ssh_class = Ssh
+    # default deadline in seconds of each ssh call (see Ssh.deadline)
+    deadline = 30
+
     def __init__(self, ip='', port=22, user='admin', password='',
-                 private_key_file='', debug=False):
+                 private_key_file='', debug=False, pool=None, jump=None):
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
-            7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
+            debug_log()
         log.debug("Constructor with ip={}, port={}, user={}, password={}, private_key_file={}, debug={}".
                  format(ip, port, user, password, private_key_file, debug))
         self.ip = ip
@@ -40,8 +41,9 @@ class Fortiswitch(object):
         self.timeout = 3
         self.moke_exception = ''
         self.moke_context = ''
-        self.ssh = Ssh(ip=ip, port=port, user=user, password=password,
-                       private_key_file=private_key_file, debug=debug)
+        self.ssh = self.ssh_class(ip=ip, port=port, user=user, password=password,
+                       private_key_file=private_key_file, debug=debug, pool=pool, jump=jump)
+        self.ssh.deadline = self.deadline
 
     def connect(self):
         self.ssh.connect()
@@ -60,6 +62,10 @@ class Fortiswitch(object):
     def trace_mark(self, mark):
         self.ssh.trace_mark(mark)
 
+    def trace_flush(self):
+        self.ssh.trace_flush()
+
+    @ssh_steps
     def set_port_status(self, port='', status=''):
         """
         Set fortiswitch given port UP or DOWN.
@@ -79,8 +85,6 @@ class Fortiswitch(object):
         if (port == ''):
             print("port is missing")
             return("ERROR: port missing")
-        if not self.ssh.connected:
-            self.ssh.connect()
         cmds = (
                 "config switch physical-port\n",
                 "edit "+port+"\n",
@@ -90,8 +94,9 @@ class Fortiswitch(object):
                 )
         for cmd in cmds:
             log.debug("send: {}".format(cmd))
-            self.run_op_mode_command(cmd)
+            yield from self.run_op_mode_command.steps(self, cmd)
 
+    @ssh_steps
     def get_port_status(self, port=''):
         """
         Returns status for given port : 'up' or 'down'
@@ -115,12 +120,10 @@ class Fortiswitch(object):
         if (port == ''):
             print("port is missing")
             return("ERROR: port missing")
-        if not self.ssh.connected:
-            self.ssh.connect()
         cmd = "diagnose switch physical-ports summary "+port+"\n"
-        self.run_op_mode_command(cmd)
+        yield from self.run_op_mode_command.steps(self, cmd)
         for line in self.ssh.output.splitlines():
-            log.debug("line={}".format(line))
+            log.debug("line=%s", line)
             match = re.search('^(?:\s+)(?P<port>port\d+)(?:\s+)(?P<status>\S+)(?:\s+)', line)
             if match:
                 m_port = match.group('port')
@@ -129,10 +132,25 @@ class Fortiswitch(object):
                     log.debug("found expected port={}, status={}".format(m_port, m_status))
                     return m_status
 
+    @ssh_steps
     def run_op_mode_command(self, cmd):
         """
         Use netcontrol shell to send commands
         """
         log.debug("Enter  with cmd={}".format(cmd))
-        self.ssh.shell_send([cmd])
+        yield 'shell_send', [cmd]
         return(self.ssh.output)
+
+
+class AsyncFortiswitch(Fortiswitch):
+    """
+    asyncio flavour of Fortiswitch, backed by AsyncSsh
+    Every method talking to the device is a coroutine
+    """
+    ssh_class = AsyncSsh
+
+    async def connect(self):
+        await self.ssh.connect()
+
+    async def close(self):
+        await self.ssh.close()
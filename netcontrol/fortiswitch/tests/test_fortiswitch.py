@@ -8,7 +8,8 @@ Created on Sep 25, 2019
 import unittest
 import logging as log
 import json
-from fortiswitch import Fortiswitch
+import asyncio
+from fortiswitch import Fortiswitch, AsyncFortiswitch
 
 # create logger
 log.basicConfig(
@@ -37,6 +38,16 @@ class fortiswitchTestCase(unittest.TestCase):
         self.fsw.close()
         self.assertEqual(str(result),'up')
 
+    def test_async_get_port_status(self):
+        async def run():
+            fsw = AsyncFortiswitch(ip='127.0.0.1', user='admin', password='fortinet', debug=True)
+            await fsw.connect()
+            fsw.ssh.mock(context='fortiswitch')
+            result = await fsw.get_port_status(port='port21')
+            await fsw.close()
+            return result
+        self.assertEqual(str(asyncio.run(run())),'down')
+
     def test_set_port_status(self):
         self.fsw.connect()
         self.fsw.ssh.mock(context='fortiswitch')
@@ -13,32 +13,30 @@ FortiPoc link control :
 - set_poc_link_status (device: <fpoc_device_name>,
                        link: <ETHx>, status: <up|down>)
 """
-from netcontrol.ssh.ssh import Ssh
-import logging as log
+from netcontrol.ssh.ssh import Ssh, AsyncSsh, ssh_steps, debug_log
+import logging
 import re
 import json
 
+log = logging.getLogger('netcontrol.fpoc')
+
 
 class Fpoc(object):
     """
     main class
     """
+    # ssh session class, see AsyncFpoc
+    ssh_class = Ssh
+    # default deadline in seconds of each ssh call (see Ssh.deadline)
+    deadline = 30
 
     def __init__(self, ip='', port=22, user='admin', password='',
-                 private_key_file='', debug=False):
+                 private_key_file='', debug=False, pool=None, jump=None):
 
         # Set debug level first
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
-
-        # create logger
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-\
-            7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
+            debug_log()
 
         log.debug("Constructor with ip={}, port={}, user={}, password={}, private_key_file={}, debug={}".
                  format(ip, port, user, password, private_key_file, debug))
@@ -52,8 +50,9 @@ class Fpoc(object):
         self.timeout = 3
         self.moke_exception = ''
         self.moke_context = ''
-        self.ssh = Ssh(ip=ip, port=port, user=user, password=password,
-                       private_key_file=private_key_file, debug=debug)
+        self.ssh = self.ssh_class(ip=ip, port=port, user=user, password=password,
+                       private_key_file=private_key_file, debug=debug, pool=pool, jump=jump)
+        self.ssh.deadline = self.deadline
 
     def connect(self):
         self.ssh.connect()
@@ -72,6 +71,10 @@ class Fpoc(object):
     def trace_mark(self, mark):
         self.ssh.trace_mark(mark)
 
+    def trace_flush(self):
+        self.ssh.trace_flush()
+
+    @ssh_steps
     def set_poc_link_status(self, device='', link='', status=''):
         """
         Set fortipoc link UP or DOWN for the given device and link
@@ -96,14 +99,13 @@ class Fpoc(object):
             return("ERROR: link missing")
 
         # Send command to FortiPoc
-        if not self.ssh.connected:
-            self.ssh.connect()
 
         cmd = "poc link " + status + " " + device + " " + link
         log.debug("cmd={}".format(cmd))
-        self.ssh.commands([cmd])
+        yield 'commands', [cmd]
         return(self.ssh.output)
 
+    @ssh_steps
     def get_poc_link_status(self, device=''):
         """
         Returns a json object representing fortipoc link status for given
@@ -137,12 +139,10 @@ class Fpoc(object):
         """
         log.debug("Enter with device={}".format(device))
 
-        if not self.ssh.connected:
-            self.ssh.connect()
 
-        self.ssh.commands(['poc link list'])
+        yield 'commands', ['poc link list']
 
-        log.debug("output:{}".format(self.ssh.output))
+        log.debug("output:%s", self.ssh.output)
 
         # our dictionary to return port status as json
         # the key is the port name
@@ -156,8 +156,7 @@ class Fpoc(object):
             # if the device is found and line does not start with a space, then
             # we have hit the next device, time to leave the loop
             if (flag_device and line[0] != " "):
-                log.debug("end of our device port list - line={}".
-                          format(line))
+                log.debug("end of our device port list - line=%s", line)
                 flag_device = False
 
             # Raise device_flag when we see our device name
@@ -169,7 +168,7 @@ class Fpoc(object):
             # If device is found, catch the line with the port we need
             # Get port status and feedback in return_dict
             if (flag_device):
-                log.debug("line:"+line)
+                log.debug("line:%s", line)
                 match_port = re.search("^(?:\s+)(?P<port>.\S+)(?:\s\()", line)
 
                 if match_port:
@@ -187,6 +186,20 @@ class Fpoc(object):
         return(json.dumps(return_dic, indent=4, sort_keys=True))
 
 
+class AsyncFpoc(Fpoc):
+    """
+    asyncio flavour of Fpoc, backed by AsyncSsh
+    Every method talking to the device is a coroutine
+    """
+    ssh_class = AsyncSsh
+
+    async def connect(self):
+        await self.ssh.connect()
+
+    async def close(self):
+        await self.ssh.close()
+
+
 if __name__ == '__main__': #pragma: no cover
 
     # Simple example :
@@ -8,7 +8,8 @@ Created on Sep 25, 2019
 import unittest
 import logging as log
 import json
-from fpoc import Fpoc
+import asyncio
+from fpoc import Fpoc, AsyncFpoc
 
 # create logger
 log.basicConfig(
@@ -39,6 +40,18 @@ class fpocTestCase(unittest.TestCase):
         self.fpoc.close()
         self.assertEqual(str(result),expected) 
 
+    def test_async_get_poc_link_status(self):
+        async def run():
+            fpoc = AsyncFpoc(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            await fpoc.connect()
+            fpoc.ssh.mock(context='fpoc')
+            result = await fpoc.get_poc_link_status(device='FGT-1')
+            await fpoc.close()
+            return result
+        result = json.loads(asyncio.run(run()))
+        expected =  "{'port1': 'UP', 'port10': 'UP', 'port2': 'UP', 'port3': 'UP', 'port4': 'UP', 'port5': 'UP', 'port6': 'UP', 'port7': 'UP', 'port8': 'UP', 'port9': 'UP'}"
+        self.assertEqual(str(result),expected)
+
     def test_set_poc_link_status_wrong_state(self):
         log.debug("* Running test_set_poc_link_status_wrong_state *")
         self.fpoc.connect()
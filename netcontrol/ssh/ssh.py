@@ -34,43 +34,94 @@ The default context 'tests/mockfiles/default' is needed if no context is
 provided.
 """
 
-import logging as log
+import asyncio
+import codecs
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
 import paramiko
+import queue
+import selectors
+import shutil
 import socket
+import socketserver
+import tempfile
+import threading
 import time
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # Workaround for paramiko deprecation warnings (will be fixed later version)
 import warnings
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
+# Loggers of netcontrol modules are children of 'netcontrol', see debug_log
+log = logging.getLogger('netcontrol.ssh')
+logging.getLogger('netcontrol').addHandler(logging.NullHandler())
+
+# Private key types tried in order, see load_private_key
+KEY_CLASSES = ('RSAKey', 'Ed25519Key', 'ECDSAKey')
+
+# Format of debug_log files
+LOG_FORMAT = '%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s'
+
+# Numbers of a command (counters, addresses, ids), see normalize_command
+COMMAND_NUMBERS = re.compile(r'\b\d+(?:[.:/]\d+)*\b')
+
+# Ssh settings given with each request to the mux daemon, see SshMux
+MUX_OPTIONS = ('completion', 'prompt_timeout', 'sentinel_timeout', 'exec_timeout',
+               'max_channels', 'replay', 'deadline', 'mock_context')
+
+# Shell prompt, see Ssh.read_prompt
+SEARCH_PROMPT = r'(^\[?[A-Za-z0-9@~\:_-]+\s*(?:\$|\#|\~|\(|\]))\s?'
+
+# ANSI escape sequences : CSI (colors, cursor moves...), OSC (window title)
+# and two characters escapes, see StreamDecoder
+ANSI_ESCAPE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])')
+# Escape sequence not complete at the end of a chunk
+ANSI_INCOMPLETE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?\Z')
+
 
 class Ssh(object):
     """ main class """
 
-    def __init__(self, ip='', port=22, user='admin', password='', private_key_file='', debug=False):
+    def __init__(self, ip='', port=22, user='admin', password='', private_key_file='', debug=False, pool=None,
+                 jump=None, mux=None):
         """
         Constructor with default values.
         Use admin / no password by default
+        pool : SshPool sharing authenticated connections between Ssh objects
+        (see SshPool), True to use the process wide ssh_pool.
+        jump : JumpHost the device is reached through, or a dictionary of
+        its arguments (ex: {'ip': '10.5.0.1', 'user': 'lab'}) to use the
+        JumpHost shared by all Ssh objects with the same bastion (see
+        jump_host)
+        mux : unix socket path of a mux daemon (see SshMux) owning the device
+        session : connect, shell_send and commands are run by the daemon,
+        on its session shared with other processes. Without a daemon
+        listening, the session is opened by this object as usual.
         """
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d\
-            %(levelname)-8s[%(module)-7.7s.%(funcName)\
-            -30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
- 
         if debug:
-            log.basicConfig(level='DEBUG')
-        log.debug("Constructor with ip={}, port={}, user={}, password={}, private_key_file={}, debug={}"
-                  .format(ip, port, user, password, private_key_file, debug))
+            debug_log()
+        log.debug("Constructor with ip={}, port={}, user={}, password={}, private_key_file={}, debug={}, pool={}, jump={}, mux={}"
+                  .format(ip, port, user, password, private_key_file, debug, pool, jump, mux))
         # public class attributs
         self.ip = ip
         self.port = port
         self.user = user
         self.password = password
         self.private_key_file = private_key_file
+        self.jump = jump_host(**jump) if isinstance(jump, dict) else jump
+        self.mux = mux
+        # Time in seconds a call waits for the answer of the mux daemon
+        # (within the deadline of the call)
+        self.mux_timeout = 300
+        # Time in seconds to connect (within the deadline of the call)
         self.timeout = 3
         self.debug = debug
         self.output = ''
@@ -80,15 +131,95 @@ class Ssh(object):
         # Number of maximum round used to search for prompt
         # Can be increased in case command takes time to
         # give back prompt (ex : a failing ping, takes several seconds)
+        # Deprecated : a round counts for 0.1s, prefer read_timeout or the
+        # deadline of the call (see shell_send)
         self.maxround = 10
+        # Deadline in seconds for shell_read to see the prompt
+        # If None, it is derived from maxround
+        self.read_timeout = None
+        # Deadline in seconds for read_prompt to identify a prompt
+        self.prompt_timeout = 2
+        # Time in seconds channel_read waits for the first data
+        self.channel_timeout = 0.2
+        # Polling interval when the channel has no file descriptor (mock)
+        self.poll_interval = 0.01
+        # Time in seconds an exec channel (commands) waits for data
+        self.exec_timeout = 10
+        # Default deadline in seconds of a whole shell_send, shell_read or
+        # commands call (None : no deadline, only the timeouts above)
+        # Drivers set their own default, see their deadline class attribute
+        self.deadline = None
+        # True if the last call was stopped by its deadline
+        self.timed_out = False
+        # How shell_send knows a command is complete :
+        # 'prompt' : the device prompt is received (default, any device)
+        # 'sentinel' : an echo of a unique marker sent after the command is
+        # received (POSIX shells only : Linux/KVM, ESXi, VyOS operational mode)
+        self.completion = 'prompt'
+        # Deadline in seconds for a command to complete in 'sentinel' mode
+        self.sentinel_timeout = 60
+        # Exit status of the last command sent in 'sentinel' mode
+        self.exit_status = None
+        # Output of each command of the last shell_send(pipeline=True)
+        self.outputs = []
+        # Time in seconds stream waits for data before giving up
+        self.stream_timeout = 60
+        # Maximum channels opened at a time by commands(concurrent=True)
+        # (OpenSSH servers default MaxSessions is 10)
+        self.max_channels = 10
+        # Per command results of the last commands call
+        self.results = []
+        # Interval in seconds of ssh keepalive messages (0 : none), they
+        # keep firewalls and NAT sessions opened and detect dead peers
+        self.keepalive = 0
+        # Number of reconnections tried by shell_send and commands when the
+        # session is found dead or fails (0 : none). Commands are sent again
+        # once reconnected, they should be safe to repeat (polling)
+        self.reconnect = 0
+        # Commands restoring the shell state after a reconnection, sent once
+        # the prompt is discovered again (ex: ['config global\n'])
+        self.replay = []
+        # Number of successful reconnections after a failure
+        self.reconnects = 0
+        # Total time in seconds between failures and reconnections
+        self.downtime = 0.0
+        # Number of calls (shell_send, commands, stream...) which failed or
+        # reached their deadline, never reset : a driver can compare it
+        # before and after its calls
+        self.failures = 0
+        # Characters of a shell_send or shell_read output kept in memory
+        # (None : no limit). Beyond, self.output is only the first
+        # output_limit characters and the whole output is in self.capture
+        # (see OutputCapture). With 'sentinel' completion or pipeline, the
+        # output of the command (or batch) being read is still held while
+        # its end is looked for, stream keeps nothing
+        self.output_limit = None
+        # OutputCapture of the last shell_send or shell_read if output_limit
+        # is set
+        self.capture = None
         # Private attributs
         self._client = paramiko.SSHClient()
         self._channel = None  # Paramiko channel
         self._prompt = ''
-        self._maxround = 10
-        self._tracefile_FH = None  # Tracefile filehandle
+        self._deadline = None      # time.monotonic() deadline of the running call
+        self._tracer = None        # TraceWriter, started on first write
+        self._trace_lock = threading.Lock()  # Guards the TraceWriter start
         self._traceflag = False    # Flag to tell if tracing is needed or not
         self._tracefilename = None # Name of tracefile
+        self._traceoptions = {}    # TraceWriter options given to trace_open
+        self._pool = ssh_pool if pool is True else pool
+        # Cache of parsed private keys and known_hosts (see KeyCache), None
+        # to read them on each connect
+        self.key_cache = key_cache
+        # Registry of connect and commands metrics (see SshMetrics), None
+        # (default) to not record them. ex: myssh.metrics = ssh_metrics
+        self.metrics = None
+        self._probe = None         # CommandProbe of the running command
+        self._stream_done = False  # Last stream reached the end of its command
+        self._down_since = None    # time.monotonic() of the last failure
+        self._replay_pending = False  # reconnected, shell state to restore
+        self._decoder = StreamDecoder()  # Shell channel decoder
+        self._muxed = False        # Session owned by the mux daemon
 
     def connect(self):
         """
@@ -103,26 +234,29 @@ class Ssh(object):
         Returns ssh object itself to allow methods chaining
         """
         log.debug("Enter")
+        if self.mux:
+            result_flag = self._mux_call('connect')
+            if result_flag is not None:
+                self.connected = result_flag
+                return result_flag
+        if self._pool and self.connected:
+            # connecting again : our pool slot is given back first
+            self._release()
         # Moking : position request for exception if asked
         if self.mock_exception:
             self._client.exception = self.mock_exception
-        self._client.load_system_host_keys()
-        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
         log.debug("Connecting with ip={} port={} user={} password={} private_key_file={}"
                   .format(self.ip, self.port, self.user, self.password, self.private_key_file))
         # Connecting
+        start = time.monotonic()
         try:
-            private_key = None
-            if (self.private_key_file != ''):
-                log.debug("Got private_key")
-                private_key = paramiko.RSAKey.from_private_key_file(self.private_key_file)
-                log.debug("private_key={}".format(private_key))
-            self._client.connect(hostname=self.ip, port=self.port,
-                                 username=self.user, pkey=private_key,
-                                 password=self.password,
-                                 timeout=self.timeout,
-                                 allow_agent=False,
-                                 look_for_keys=False)
+            if self._pool:
+                self._client = self._pool.acquire(self._pool_key(), self._open_client)
+                # pooled client may come from another Ssh object
+                if self.mock_context:
+                    self.mock(context=self.mock_context)
+            else:
+                self._open_client()
         except paramiko.AuthenticationException:
             log.debug("exception : Authentication failed")
             result_flag = False
@@ -143,20 +277,319 @@ class Ssh(object):
             self._client.close()
         else:
             result_flag = True
+            if self.metrics is not None:
+                self.metrics.observe('connect_seconds', self.ip, '', time.monotonic() - start)
+            self._connected()
         self.connected = result_flag
         return result_flag
 
+    def _connected(self):
+        """
+        Sets keepalive on the new session and records the reconnection if
+        we were disconnected by a failure
+        """
+        if self.keepalive:
+            transport = self._client.get_transport()
+            if transport is not None:
+                transport.set_keepalive(self.keepalive)
+        if self._down_since is not None:
+            down = time.monotonic() - self._down_since
+            self.reconnects += 1
+            self.downtime += down
+            self._down_since = None
+            self._replay_pending = True
+            log.debug("reconnected after {:.3f}s, reconnects={}".format(down, self.reconnects))
+
+    def alive(self):
+        """
+        Cheap liveness probe of the session : the transport is active and an
+        ssh 'ignore' message can be sent (no round trip), the shell channel
+        (if any) is not closed
+        Returns True if the session looks alive
+        """
+        if not self.connected:
+            return False
+        transport = self._client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception as e:
+            log.debug("liveness probe failed : {}".format(e))
+            return False
+        return not (self._channel and self._channel_ended(self._channel))
+
+    def _reset(self):
+        """
+        Forgets a failed session : client is closed (with a pool, its slot
+        is freed), no shell channel and not connected any more
+        """
+        log.debug("Enter")
+        self._probe_end(False)
+        if self.connected and self._down_since is None:
+            self._down_since = time.monotonic()
+        self._client.close()
+        if self._pool and self.connected:
+            # closed client is dropped by the pool
+            self._pool.release(self._pool_key(), self._client)
+            self._client = paramiko.SSHClient()
+        self._channel = None
+        self.connected = False
+
+    def _run(self, steps):
+        """
+        Runs steps, a generator yielding the calls to make on this session
+        as a tuple (method name, arguments...), see ssh_steps.
+        Methods written as steps are shared with AsyncSsh, which only
+        overrides the methods waiting for the channel or the executor
+        Returns the generator return value (a coroutine with AsyncSsh)
+        """
+        return _run_steps(self, steps)
+
+    def _with_reconnect(self, run, deadline=None):
+        """
+        Steps of run(), a method returning the steps of a call ending with a
+        result flag, within deadline seconds (see _start_deadline). If the
+        session is dead before, or fails while running (session reset),
+        reconnects and runs it again, up to self.reconnect times while the
+        deadline is not reached
+        Returns the result flag, False if the deadline was reached
+        """
+        self._start_deadline(deadline)
+        try:
+            attempts = self.reconnect
+            if attempts and self.connected and not self.alive():
+                log.debug("session is dead, reconnecting")
+                self._reset()
+            while True:
+                result_flag = yield from run()
+                if result_flag or self.connected or attempts <= 0 or self._expired():
+                    return self._result(result_flag and not self.timed_out)
+                attempts -= 1
+                log.debug("session failed, reconnecting ({} attempts left)".format(attempts))
+        finally:
+            self._deadline = None
+
+    def _result(self, result_flag):
+        """
+        Counts the failed calls in self.failures
+        Returns result_flag
+        """
+        if not result_flag:
+            self.failures += 1
+        return result_flag
+
+    def _start_deadline(self, deadline):
+        """
+        Starts the deadline of a call : every wait of the call (connect,
+        prompt, marker, exec channel data) ends at the latest deadline
+        seconds from now. Uses self.deadline if deadline is None
+        """
+        if deadline is None:
+            deadline = self.deadline
+        self.timed_out = False
+        self._deadline = None if deadline is None else time.monotonic() + deadline
+
+    def _until(self, timeout):
+        """
+        Returns the time.monotonic() deadline of a wait of timeout seconds,
+        not after the deadline of the running call
+        """
+        until = time.monotonic() + timeout
+        if self._deadline is not None and self._deadline < until:
+            return self._deadline
+        return until
+
+    def _remaining(self, timeout):
+        """
+        Returns the time in seconds of a wait of timeout seconds, not after
+        the deadline of the running call
+        """
+        return max(0.0, self._until(timeout) - time.monotonic())
+
+    def _expire(self, until):
+        """
+        Called when a wait ending at until (a time.monotonic() value) gave
+        up : sets timed_out if it was stopped by the deadline of the call
+        """
+        if self._deadline is not None and until >= self._deadline:
+            log.debug("deadline reached")
+            self.timed_out = True
+
+    def _expired(self):
+        """
+        Returns True if the deadline of the running call is reached (and
+        sets timed_out)
+        """
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self._expire(self._deadline)
+        return self.timed_out
+
+    def _new_probe(self, command):
+        """
+        Returns a CommandProbe measuring command, None without metrics
+        """
+        return CommandProbe(command) if self.metrics is not None else None
+
+    def _probe_start(self, command):
+        """
+        Starts measuring command on the shell channel (see _decode)
+        """
+        self._probe = self._new_probe(command)
+
+    def _probe_end(self, complete):
+        """
+        Records the metrics of the command measured on the shell channel
+        """
+        probe, self._probe = self._probe, None
+        self._probe_record(probe, complete)
+
+    def _probe_record(self, probe, complete):
+        """
+        Records the metrics of probe, complete is False if the command was
+        not seen complete
+        """
+        if probe is not None:
+            self.metrics.record(self.ip, probe, complete)
+
+    def _mux_call(self, method, **kwargs):
+        """
+        Runs method with kwargs on the device session of the mux daemon
+        (see SshMux) and sets our output, outputs, results, exit_status
+        and timed_out from its answer. The answer is waited for until the
+        deadline of the call, mux_timeout seconds at most
+        Returns the result flag, None if the daemon could not be reached
+        (the caller then uses a direct session). Once the request is sent,
+        a failure is returned as False : the daemon may have run it already
+        """
+        log.debug("Enter with method={} mux={}".format(method, self.mux))
+        request = {'method': method, 'kwargs': kwargs,
+                   'device': {'ip': self.ip, 'port': self.port, 'user': self.user,
+                              'password': self.password, 'private_key_file': self.private_key_file},
+                   'options': {name: getattr(self, name) for name in MUX_OPTIONS}}
+        self._start_deadline(kwargs.get('deadline'))
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.mux)
+                except OSError as e:
+                    log.debug("mux daemon not reachable, direct session : {}".format(e))
+                    return None
+                self._muxed = True
+                self.output = ''
+                until = self._until(self.mux_timeout)
+                try:
+                    sock.settimeout(max(0.001, until - time.monotonic()))
+                    sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+                    with sock.makefile('rb') as reader:
+                        answer = json.loads(reader.readline().decode('utf-8'))
+                except socket.timeout:
+                    log.error("mux daemon did not answer method={}".format(method))
+                    self._expire(until)
+                    return self._result(False)
+                except (OSError, ValueError) as e:
+                    log.error("mux daemon request failed method={} : {}".format(method, e))
+                    return self._result(False)
+        finally:
+            self._deadline = None
+        if 'error' in answer:
+            log.error("mux daemon error method={} : {}".format(method, answer['error']))
+            return self._result(False)
+        for name in ('output', 'outputs', 'results', 'exit_status', 'timed_out'):
+            setattr(self, name, answer[name])
+        self.trace_write(self.output)
+        return answer['result']
+
+    def _mux_refused(self, method):
+        """
+        Returns True (and logs it) if the session is owned by the mux daemon :
+        method works on the local shell channel, it can not be forwarded
+        """
+        if self._muxed:
+            log.error("{} is not available with the mux daemon session".format(method))
+            return True
+        return False
+
+    def _invoke_shell(self):
+        """
+        Steps opening the shell channel and discovering the prompt. After a
+        reconnection, the shell state is restored with self.replay commands
+        """
+        log.debug("Invoke shell")
+        yield '_open_channel',
+        yield 'read_prompt',
+        if self._replay_pending:
+            self._replay_pending = False
+            for command in self.replay:
+                log.debug("replay command={}".format(command))
+                self._channel.send(command)
+                yield 'read_prompt',
+
+    def _open_client(self):
+        """
+        Authenticates our paramiko client on the ssh server
+        Returns the client
+        """
+        if self.key_cache:
+            # known_hosts parsed once, only the keys of our host are copied
+            name = self.ip if int(self.port) == 22 else "[{}]:{}".format(self.ip, self.port)
+            for keytype, key in (self.key_cache.host_keys().lookup(name) or {}).items():
+                self._client.get_host_keys().add(name, keytype, key)
+        else:
+            self._client.load_system_host_keys()
+        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
+        private_key = None
+        if (self.private_key_file != ''):
+            log.debug("Got private_key")
+            if self.key_cache:
+                private_key = self.key_cache.private_key(self.private_key_file)
+            else:
+                private_key = load_private_key(self.private_key_file)
+            log.debug("private_key={}".format(private_key))
+        sock = None
+        if self.jump:
+            sock = self.jump.open_channel(self.ip, self.port, timeout=self._remaining(self.timeout))
+        self._client.connect(hostname=self.ip, port=self.port,
+                             username=self.user, pkey=private_key,
+                             password=self.password,
+                             timeout=self._remaining(self.timeout),
+                             allow_agent=False,
+                             look_for_keys=False,
+                             sock=sock)
+        return self._client
+
+    def _pool_key(self):
+        """
+        Returns the key identifying our connection in the pool
+        Devices with the same address behind different bastions are
+        different devices. A password only takes part as a digest, so a
+        connection is not reused with other credentials
+        """
+        jump = self.jump.identity() if self.jump else None
+        return (self.ip, int(self.port), self.user, _digest(self.password), self.private_key_file, jump)
+
     def close(self):
         """
         Close ssh connection if opened
+        With a pool, the connection is given back to the pool instead
+        """
+        self._release()
+        self._trace_close()
+
+    def _release(self):
+        """
+        Closes our channel and the connection, or gives it back to the pool
         """
         if self.connected:
-            self._client.close()
-            self.connected = False
             if self._channel:
                 self._channel.close()
-        if self._tracefile_FH:
-            self._tracefile_FH.close()
+            if self._pool:
+                self._pool.release(self._pool_key(), self._client)
+                self._client = paramiko.SSHClient()
+            else:
+                self._client.close()
+            self._channel = None
+            self.connected = False
 
     def execute(self, commands=[], type='command'):
         """
@@ -180,7 +613,7 @@ class Ssh(object):
         elif type == 'shell':
             self.send(commands)
 
-    def shell_send(self, commands):
+    def shell_send(self, commands, pipeline=False, deadline=None):
         """
         Open a shell channel and send a list of command.
         To read the command output, use shell_read afterwards
@@ -192,66 +625,353 @@ class Ssh(object):
         args : commands [] - list of one of more commands
         ex : ['show date']
 
+        pipeline : if True, all commands are written at once and the received
+        stream is split back per command, so the list costs about one round
+        trip instead of one per command. Output of each command is stored in
+        self.outputs. Commands should not prompt for input.
+
+        With reconnect, a dead or failing session is opened again and the
+        commands sent again (see reconnect and replay)
+
+        deadline : time in seconds for the whole call (self.deadline if None).
+        Each wait ends at the latest at the deadline, commands not sent yet
+        are dropped and self.timed_out is set.
+        ex: myssh.shell_send(['get system status\n'], deadline=2.5)
+
+        If output_limit is set, self.output only has the beginning of a
+        bigger output, the whole output is in self.capture (see shell_read)
+
+        returns True if commands are sent succesfully before the deadline
+        """
+        if self.mux:
+            result_flag = self._mux_call('shell_send', commands=commands, pipeline=pipeline, deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        return self._run(self._with_reconnect(functools.partial(self._shell_send, commands, pipeline), deadline))
+
+    def _shell_send(self, commands, pipeline):
+        """
+        Steps sending commands on the shell channel, see shell_send
         returns True if commands are sent succesfully
         """
-        log.debug("Enter with commands={}".format(commands))
+        log.debug("Enter with commands={} pipeline={}".format(commands, pipeline))
         self.output = ''
+        self.outputs = []
         result_flag = False
         if not self.connected:
-            self.connect()
+            yield 'connect',
         try:
             if self.connected:
                 if not self._channel:
-                    log.debug("Invoke shell")
-                    self._channel = self._client.invoke_shell(term='dumb',
-                                                              width=0,
-                                                              height=0,
-                                                              width_pixels=0,
-                                                              height_pixels=0,
-                                                              environment=None)
-                    self.read_prompt()
+                    yield from self._invoke_shell()
                 # Clear all output so far, expecting that all usefull output
                 # has been processed on output buffer so far
                 self.output = ""
-                # send all we need to send
-                for command in commands:
-                    log.debug("Processing command={}, context={}".format(command, self.mock_context))
-                    self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
-                    if self._channel.send_ready():
-                        log.debug("sending command={}".format(command))
-                        self._channel.send(command)
-                        if self.read_prompt():
-                            log.debug("command is confirmed, output recorded")
-                            self.trace_write(self.output)
+                self._new_capture()
+                if pipeline and len(commands) > 1:
+                    self._probe_start(" ; ".join(commands))
+                    complete = yield '_send_pipeline', commands
+                    self._probe_end(complete)
+                    if complete:
+                        log.debug("commands are confirmed, output recorded")
+                    self.trace_write(self.output)
+                else:
+                    # send all we need to send
+                    for command in commands:
+                        if self._expired():
+                            log.debug("deadline reached, command={} not sent".format(command))
+                            break
+                        log.debug("Processing command={}, context={}".format(command, self.mock_context))
+                        self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
+                        if self._channel.send_ready():
+                            log.debug("sending command={}".format(command))
+                            self._probe_start(command)
+                            if self.completion == 'sentinel':
+                                complete = yield '_send_sentinel', command
+                            else:
+                                self._channel.send(command)
+                                complete = yield 'read_prompt',
+                            self._probe_end(complete)
+                            if complete:
+                                log.debug("command is confirmed, output recorded")
+                                self.trace_write(self.output)
         except socket.timeout as e:
             log.debug("Command timed out : {}".format(e))
-            self._client.close()
+            self._reset()
             result_flag = False
         except paramiko.SSHException:
-            log.debug("Failed to execute the command {}".format(command))
-            self._client.close()
+            log.debug("Failed to execute the commands {}".format(commands))
+            self._reset()
             result_flag = False
         else:
             result_flag = True
         return result_flag
 
-    def shell_read(self):
+    def _send_pipeline(self, commands):
+        """
+        Writes all commands at once and reads until the last one is complete
+        (its marker with 'sentinel' completion, or its echo followed by a
+        prompt), then splits the stream per command in self.outputs
+        With 'prompt' completion, self.output is the whole stream like with
+        successive commands. Deadline is prompt_timeout per command
+        ('prompt') or sentinel_timeout ('sentinel')
+
+        Returns True if all commands were seen complete
+        """
+        batch = self._pipeline_start(commands)
+        buffer = ReadBuffer()
+        complete = False
+        deadline = self._until(self._pipeline_timeout(commands))
+        selector = self._open_selector()
+        try:
+            while self._wait_recv_ready(selector, deadline):
+                read_stdout = self._channel.recv(32768)
+                if not read_stdout:
+                    log.debug("Channel is closed")
+                    break
+                text = buffer.append(self._decode(read_stdout))
+                complete = self._pipeline_complete(batch, buffer, text)
+                if complete:
+                    break
+        finally:
+            if selector:
+                selector.close()
+        return self._pipeline_end(batch, buffer.getvalue(), complete)
+
+    def _pipeline_timeout(self, commands):
+        """
+        Returns the deadline in seconds for a pipelined list of commands
+        """
+        if self.completion == 'sentinel':
+            return self.sentinel_timeout
+        return self.prompt_timeout * len(commands)
+
+    def _pipeline_start(self, commands):
+        """
+        Sends all commands in one write, each one followed by its marker echo
+        with 'sentinel' completion
+        Returns the batch : a list of tuple (command, typed marker, marker
+        regex), marker items are None with 'prompt' completion
+        """
+        for command in commands:
+            self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
+        if self.completion == 'sentinel':
+            batch = [(command,)+self._sentinel_marker() for command in commands]
+            data = "".join(command.rstrip('\n')+"\n"+"echo "+typed+" $?\n"
+                           for command, typed, done in batch)
+        else:
+            batch = [(command, None, None) for command in commands]
+            data = "".join(commands)
+        log.debug("sending data=%s", data)
+        self._channel.send(data)
+        return batch
+
+    def _pipeline_complete(self, batch, buffer, text):
+        """
+        Returns True once the last command of the batch is complete
+        buffer : ReadBuffer of the stream
+        text : text of buffer from the start of the last line received
+        """
+        if self.completion == 'sentinel':
+            return batch[-1][2].search(text) is not None
+        if not re.search(SEARCH_PROMPT, buffer.tail):
+            return False
+        return self._pipeline_split(batch, buffer.getvalue()) is not None
+
+    def _pipeline_split(self, batch, read_block):
+        """
+        Splits the stream received for a batch of commands
+        Returns the list of each command output or None if the stream does
+        not contain all commands
+        With 'prompt' completion, a command output starts after the line
+        echoing the command and ends before the line echoing the next one.
+        A last line of an output only made of a prompt is removed.
+        """
+        outputs = []
+        if self.completion == 'sentinel':
+            start = 0
+            for command, typed, done in batch:
+                match = done.search(read_block, start)
+                if not match:
+                    return None
+                outputs.append(self._sentinel_output(command, typed, read_block[start:match.start()]))
+                start = match.end()
+            return outputs
+        lines = read_block.splitlines()
+        echoes = []
+        index = 0
+        for command, typed, done in batch:
+            while index < len(lines) and not self._is_echo(lines[index], command):
+                index += 1
+            if index == len(lines):
+                return None
+            echoes.append(index)
+            index += 1
+        echoes.append(len(lines))
+        for i in range(len(batch)):
+            output = lines[echoes[i]+1:echoes[i+1]]
+            if output and re.fullmatch(SEARCH_PROMPT + r'\s*', output[-1]):
+                output.pop()
+            outputs.append("".join(line+"\n" for line in output))
+        return outputs
+
+    def _is_echo(self, line, command):
+        """
+        Returns True if line is the echo of command, alone or after a prompt
+        """
+        command = command.strip()
+        if command and line.strip() == command:
+            return True
+        match = re.search(SEARCH_PROMPT, line)
+        return bool(match) and line[match.end():].rstrip().endswith(command)
+
+    def _pipeline_end(self, batch, read_block, complete):
+        """
+        Stores the output of each command of the batch in self.outputs
+        Returns complete
+        """
+        outputs = self._pipeline_split(batch, read_block) if complete else None
+        if outputs is None:
+            log.debug("batch not complete before deadline")
+            outputs = [read_block]
+        self.outputs = outputs
+        if self.completion == 'sentinel':
+            match = batch[-1][2].search(read_block)
+            self.exit_status = int(match.group(1)) if match else None
+            self._output_write("".join(outputs))
+        else:
+            self._output_write(read_block)
+        return complete
+
+    def _send_sentinel(self, command):
+        """
+        Sends command followed by an echo of a unique marker and its exit
+        status, then reads until the marker is received.
+        Command output, without its echo and the marker lines, is added to
+        self.output and its exit status stored in self.exit_status.
+        Reading stops as soon as the marker is seen : no prompt guessing, no
+        waiting for slow commands more than needed (up to sentinel_timeout)
+
+        Returns True if the marker was received
+        """
+        typed, done = self._sentinel_start(command)
+        buffer = ReadBuffer()
+        match = None
+        deadline = self._until(self.sentinel_timeout)
+        selector = self._open_selector()
+        try:
+            while self._wait_recv_ready(selector, deadline):
+                read_stdout = self._channel.recv(32768)
+                if not read_stdout:
+                    log.debug("Channel is closed")
+                    break
+                match = self._sentinel_chunk(done, buffer, read_stdout)
+                if match:
+                    break
+        finally:
+            if selector:
+                selector.close()
+        return self._sentinel_end(command, typed, buffer, match)
+
+    def _sentinel_start(self, command):
+        """
+        Sends command and its marker echo
+        Returns a tuple (typed marker, compiled regex of the received marker)
+        """
+        typed, done = self._sentinel_marker()
+        self._channel.send(command.rstrip('\n')+"\n"+"echo "+typed+" $?\n")
+        return typed, done
+
+    def _sentinel_marker(self):
+        """
+        Returns a new unique marker as a tuple (typed marker, compiled regex
+        of the received marker). Marker is typed quoted in two pieces so
+        the echo of what we typed does not match
+        """
+        marker = "NC{}".format(uuid.uuid4().hex)
+        typed = '"{}""__"'.format(marker)
+        done = re.compile(re.escape(marker)+r'__ (\d+)\r?\n', re.M)
+        return typed, done
+
+    def _sentinel_chunk(self, done, buffer, read_stdout):
+        """
+        Adds received data to buffer (a ReadBuffer) and looks for the marker,
+        only from the start of the last line already received
+        Returns the marker match (positions relative to buffer.scan) or None
+        """
+        return done.search(buffer.append(self._decode(read_stdout)))
+
+    def _sentinel_end(self, command, typed, buffer, match):
+        """
+        Adds the command output to self.output and sets self.exit_status
+        Returns True if the marker was received
+        """
+        read_block = buffer.getvalue()
+        if match:
+            read_block = read_block[:buffer.scan + match.start()]
+        self._output_write(self._sentinel_output(command, typed, read_block))
+        if not match:
+            log.debug("marker not received before sentinel_timeout={}".format(self.sentinel_timeout))
+            self.exit_status = None
+            return False
+        self.exit_status = int(match.group(1))
+        log.debug("exit_status={}".format(self.exit_status))
+        return True
+
+    def _sentinel_output(self, command, typed, read_block):
+        """
+        Returns the output of a command received before its marker, without
+        the echo of the command (may follow a prompt) and of the marker
+        """
+        lines = read_block.splitlines()
+        if lines and command.strip() and lines[0].endswith(command.strip()):
+            lines.pop(0)
+        return "".join(line+"\n" for line in lines if typed not in line)
+
+    def shell_read(self, deadline=None):
         """
         Read the shell.
         Should be generally used after a shell_send to gather the command
         output. If the device prompt is known (discovered during a previous
         shell_send), it will stop gathering data once the prompt is seen.
-        The idea is to not spend time waiting for nothing.
-        maxround default attribut is set to 10 by default (enough for fast-answering commands)
-        For slow commands (pings...) it may be increased
+        The idea is to not spend time waiting for nothing : the channel file
+        descriptor is watched so reading starts as soon as data arrives and
+        stops as soon as the prompt is received.
+        read_timeout is the deadline in seconds to get the prompt (derived
+        from maxround if not set, 1s by default, enough for fast-answering
+        commands). For slow commands (pings...) it may be increased
+        deadline : time in seconds for the whole call, connection included
+        (self.deadline if None), self.timed_out is set if it is reached
 
         Upon success, shell output is available in self.output
+        If output_limit is set, a bigger output is spilled to a temporary
+        file : self.output only has its beginning, the whole output is read
+        with self.capture.lines() or self.capture.view()
 
+        With mux, the read is done on the daemon session (output_limit does
+        not apply)
+
+        returns True if the prompt was found
+        """
+        if self.mux:
+            result_flag = self._mux_call('shell_read', deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        self._start_deadline(deadline)
+        try:
+            return self._shell_read()
+        finally:
+            self._deadline = None
+
+    def _shell_read(self):
+        """
+        Reads the shell until the prompt, see shell_read
         returns True if the prompt was found
         """
-        log.debug("Enter with [prompt={} maxround={}]".format(self._prompt, self._maxround))
+        timeout = self._read_timeout()
+        log.debug("Enter with [prompt={} timeout={}]".format(self._prompt, timeout))
         result_flag = False
-        read_block = ""
+        buffer = ReadBuffer(self._new_capture())
         if not self.connected:
             self.connect()
         try:
@@ -264,65 +984,244 @@ class Ssh(object):
                                                               width_pixels=0,
                                                               height_pixels=0,
                                                               environment=None)
-                looping = True
-                found = False
-                round = 1
-                read_block = ""
-                # Need some time after write or channel
-                # will never be ready for read
-                # don't understand why this is required here...
-                time.sleep(0.1)
-                while (looping and round < self.maxround):
-                    if self._channel.recv_ready():
+                    self._decoder = StreamDecoder()
+                deadline = self._until(timeout)
+                selector = self._open_selector()
+                try:
+                    while self._wait_recv_ready(selector, deadline):
                         read_stdout = self._channel.recv(9999)
-                        if type(read_stdout) is str:
-                            # Mocked paramiko or paramiko on python2
-                            log.debug("read_stdout is a {} (mocked paramiko or python2)".format(type(read_stdout)))
-                            read = re.compile(r'\x1b[^m]*m').sub('', read_stdout)
-                            log.debug("Reading channel round={} read={}".format(round, read))
-                            read_block += read
-                        else:
-                            # paramiko on python3
-                            log.debug("read_stdout is a {} (paramiko on python3)".format(type(read_stdout)))
-                            read = re.compile(r'\x1b[^m]*m').sub('', read_stdout.decode('utf-8'))
-                            log.debug("Reading channel round={} read={}".format(round, read))
-                            read_block += read
-                    # See if prompt has been seen
-                    # For mockup, make sure file 'default_stdin.txt' has same
-                    # prompt as 'show configuration commands | grep network-emulator_stdin.txt'
-                    # or the prompt won't be found !
-                    if self._prompt:
-                        log.debug("round={} inspect for prompt={} in read_block={}".
-                                  format(round, self._prompt, read_block))
-                        if not (read_block.find(self._prompt) == -1):
-                            log.debug("found prompt in read_block find index={}".
-                                      format(read_block.find(self._prompt)))
-                            looping = False
-                            result_flag = True
-                    if not found:
-                        time.sleep(0.1)
-                    round = round + 1
+                        if not read_stdout:
+                            log.debug("Channel is closed")
+                            break
+                        result_flag = self._shell_chunk(buffer, read_stdout)
+                        if result_flag:
+                            break
+                finally:
+                    if selector:
+                        selector.close()
         except socket.timeout as e:
             log.debug("Command timed out : {}".format(e))
-            self._client.close()
+            self._reset()
             result_flag = False
         except paramiko.SSHException as e:
             log.debug("Failed : {}".format(e))
-            self._client.close()
+            self._reset()
             result_flag = False
-        self.output = read_block
-        self.trace_write(self.output)
+        self._read_end(buffer)
         return result_flag
 
+    def _new_capture(self):
+        """
+        Closes the capture of the previous read
+        Returns a new OutputCapture if output_limit is set, None otherwise
+        """
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+        if self.output_limit is not None:
+            self.capture = OutputCapture(self.output_limit)
+        return self.capture
+
+    def _output_write(self, text):
+        """
+        Adds text received by shell_send to self.output. If output_limit is
+        set, text goes to self.capture and self.output only keeps its first
+        output_limit characters, like with shell_read
+        """
+        if self.capture is None:
+            self.output += text
+            return
+        room = self.capture.limit - self.capture.size
+        self.capture.write(text)
+        if room > 0:
+            self.output += text[:room]
+
+    def _read_end(self, buffer):
+        """
+        Stores the text read in buffer in self.output (only its first
+        output_limit characters if the capture was spilled) and traces it
+        """
+        capture = buffer.close()
+        if capture is None:
+            self.output = buffer.getvalue()
+            self.trace_write(self.output)
+            return
+        self.output = capture.head
+        for chunk in capture.chunks():
+            self.trace_write(chunk)
+
+    def stream(self, command, deadline=None):
+        """
+        Sends a command on the shell and yields its output lines as they are
+        received, decoded and without ANSI escape sequences, without the
+        command echo and the final prompt (or marker with 'sentinel'
+        completion). Output is not stored in self.output so memory use does
+        not depend on the output size.
+        Channel is only read when the next line is asked for : a slow consumer
+        lets the ssh flow control window fill up and the device waits.
+        The generator should be consumed to the end, or the rest of the
+        output would be received by the next command.
+        Gives up if nothing is received for stream_timeout seconds, or after
+        deadline seconds if set (self.timed_out is then set)
+
+        Not available with the mux daemon session (nothing is yielded)
+
+        ex:
+            for line in myssh.stream('diagnose sys session list\n'):
+                parse(line)
+        """
+        log.debug("Enter with command={}".format(command))
+        self.output = ''
+        self._stream_done = False
+        if self._mux_refused('stream'):
+            self._result(False)
+            return
+        if not self._run(self._open_shell()):
+            return
+        self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
+        state = self._stream_start(command)
+        end = self._stream_end(deadline)
+        selector = self._open_selector()
+        try:
+            while not self._stream_done and self._wait_recv_ready(selector, self._stream_until(end)):
+                read_stdout = self._channel.recv(32768)
+                if not read_stdout:
+                    log.debug("Channel is closed")
+                    break
+                for line in self._stream_chunk(state, read_stdout):
+                    yield line
+        finally:
+            if selector:
+                selector.close()
+            self._stream_finish(end)
+
+    def shell_stream(self, command, callback, deadline=None):
+        """
+        Sends a command on the shell and calls callback with each line of its
+        output as it is received, see stream
+        Returns True if the end of the command output was seen
+        """
+        for line in self.stream(command, deadline):
+            callback(line)
+        return self._stream_done
+
+    def _stream_end(self, deadline):
+        """
+        Starts the deadline of a stream (a generator : it can not use the
+        deadline of the running call)
+        Returns the time.monotonic() end of the stream or None
+        """
+        self.timed_out = False
+        return None if deadline is None else time.monotonic() + deadline
+
+    def _stream_until(self, end):
+        """
+        Returns the time.monotonic() deadline to receive the next data of a
+        stream : stream_timeout from now, not after its end
+        """
+        until = time.monotonic() + self.stream_timeout
+        return until if end is None else min(until, end)
+
+    def _stream_finish(self, end):
+        """
+        Records the stream metrics, sets timed_out if the stream was stopped
+        by its deadline
+        """
+        self._probe_end(self._stream_done)
+        self._result(self._stream_done)
+        if end is not None and not self._stream_done and time.monotonic() >= end:
+            log.debug("stream deadline reached")
+            self.timed_out = True
+
+    def _open_shell(self):
+        """
+        Steps connecting and opening the shell channel if not done yet,
+        waiting for the prompt
+        Returns True if connected
+        """
+        if not self.connected:
+            yield 'connect',
+        if self.connected and not self._channel:
+            yield from self._invoke_shell()
+        return self.connected
+
+    def _stream_start(self, command):
+        """
+        Sends the command of a stream
+        Returns the stream state
+        """
+        state = {'command': command.strip(), 'typed': None, 'done': None,
+                 'pending': '', 'first': True}
+        self._probe_start(command)
+        if self.completion == 'sentinel':
+            state['typed'], state['done'] = self._sentinel_start(command)
+        else:
+            self._channel.send(command)
+        return state
+
+    def _stream_chunk(self, state, read_stdout):
+        """
+        Splits received data in lines, keeping the last incomplete line for
+        the next chunk. Sets self._stream_done when the end of the command
+        output is seen (the marker, or a prompt with nothing more to receive)
+        Returns the list of output lines
+        """
+        lines = (state['pending'] + self._decode(read_stdout)).split('\n')
+        state['pending'] = lines.pop()
+        result = []
+        for line in lines:
+            line = line.rstrip('\r')
+            if state['first']:
+                state['first'] = False
+                if state['command'] and line.endswith(state['command']):
+                    continue
+            if state['typed']:
+                match = state['done'].search(line+"\n")
+                if match:
+                    self.exit_status = int(match.group(1))
+                    self._stream_done = True
+                    break
+                if state['typed'] in line:
+                    continue
+            result.append(line)
+        if result:
+            self.trace_write("".join(line+"\n" for line in result))
+        if (not state['typed'] and self._is_prompt(state['pending'])
+                and not self._channel.recv_ready()):
+            log.debug("prompt={}".format(state['pending']))
+            self.trace_write(state['pending']+"\n")
+            self._stream_done = True
+        return result
+
+    def _is_prompt(self, line):
+        """
+        Returns True if line (last line received, not terminated) is the
+        whole shell prompt : the discovered prompt (with its vdom if any, ex:
+        FGT-1B2-9 (vdom) #), or a line fully matching SEARCH_PROMPT if the
+        prompt is not known yet. A line received in several chunks (ex:
+        statistic(bytes/pac) is not a prompt.
+        """
+        line = line.rstrip()
+        if self._prompt:
+            prompt = self._prompt.rstrip()
+            if line == prompt:
+                return True
+            return prompt.endswith('(') and line.startswith(prompt) and line.endswith(('#', '$'))
+        return bool(re.fullmatch(SEARCH_PROMPT + r'\s*', line))
+
     def read_prompt(self):
         """
-        Reads up to 10 blocks until we can identify the shell prompt
+        Reads the channel until we can identify the shell prompt
         Once found, prompt is stored in self._prompt
         It can be called after a shell_send to make sure we have received an
         acknowledgment prompt from the device
         While waiting for prompt, all output received is stored in the
         ssh.output for processing
 
+        The prompt is expected on the last line received, not followed by a
+        newline (the device waits for our next command). Reading stops as soon
+        as it is seen or when prompt_timeout (in seconds) is reached.
+
         Prompt may or may not have vdom so it may have 2 forms like
         FGT-1B2-9 #  or  FGT-1B2-9 (vdom)  or even FGT-1B2-9 (global) #
         for form with global or vdom, we would match once the first ( is found
@@ -332,105 +1231,364 @@ class Ssh(object):
         Returns True if prompt si found
         """
         log.debug("Enter")
-        prompt = ""
-        round = 1
         found = False
-        while (not found and round <= 10):
-            log.debug("wait for prompt round={}".format(round))
-            if self._channel.recv_ready():
+        # Last line received, not terminated by a newline yet
+        tail = ""
+        deadline = self._until(self.prompt_timeout)
+        selector = self._open_selector()
+        try:
+            while not found and self._wait_recv_ready(selector, deadline):
                 tmp = self._channel.recv(99999)
-                for line in tmp.splitlines():
-                    if isinstance(line, bytes):
-                        decoded_line = line.decode('utf-8')
-                    else:
-                        decoded_line = line
-                    # remove ANSI escape sequences
-                    decoded_line = re.compile(r'\x1b[^m]*m').sub('', decoded_line)
-                    log.debug("decoded_line={}".format(decoded_line))
-                    # Store decoded lines in ssh.output
-                    self.output += decoded_line+"\n"
-                    search_prompt = '(^\[?[A-Za-z0-9@~\:_-]+\s*(?:\$|\#|\~|\(|\]))\s?'
-                    match_prompt = re.search(search_prompt, decoded_line)
-                    if match_prompt:
-                        prompt = match_prompt.groups(0)[0]
-                        log.debug("found prompt={}".format(prompt))
-                        self._prompt = prompt
-                        found = True
-            time.sleep(0.2)
-            round = round + 1
+                if not tmp:
+                    log.debug("Channel is closed")
+                    break
+                tail, found = self._prompt_chunk(tail, tmp)
+        finally:
+            if selector:
+                selector.close()
+        if not found and tail:
+            self._output_write(tail+"\n")
         return found
 
-    def commands(self, commands):
+    def _decode(self, read_stdout):
+        """
+        Returns data received on the shell channel as a string without ANSI
+        escape sequences. A multibyte character or an escape sequence cut at
+        the end of the data is completed by the next data (see StreamDecoder)
+        Data is bytes with paramiko on python3, str with mocked paramiko
+        """
+        if self._probe is not None:
+            self._probe.received(len(read_stdout))
+        read = self._decoder.decode(read_stdout)
+        # Called for every chunk received : message only formatted if logged
+        log.debug("read=%s", read)
+        return read
+
+    def _shell_chunk(self, buffer, read_stdout):
+        """
+        Adds data received by shell_read to buffer (a ReadBuffer) and looks
+        for the prompt (if known)
+        For mockup, make sure file 'default_stdin.txt' has same prompt as
+        'show configuration commands | grep network-emulator_stdin.txt' or
+        the prompt won't be found !
+        Only the new data is searched, with an overlap of the prompt length
+        on the data already received in case the prompt was cut between two
+        chunks : time spent does not depend on the size of the output
+        Returns True if prompt was seen
+        """
+        read = self._decode(read_stdout)
+        text = buffer.append(read)
+        if self._prompt:
+            scan = max(0, len(text) - len(read) - len(self._prompt) + 1)
+            index = text.find(self._prompt, scan)
+            log.debug("inspect for prompt=%s in %s new chars, index=%s", self._prompt, len(read), index)
+            if index != -1:
+                log.debug("found prompt in read_block find index=%s", buffer.scan + index)
+                return True
+        return False
+
+    def _prompt_chunk(self, tail, tmp):
+        """
+        Processes data received by read_prompt
+        Complete lines are stored in self.output, the last line not
+        terminated by a newline (tail) is checked against the prompt regex.
+        If found, prompt is stored in self._prompt
+        Returns a tuple (tail, True if prompt was found)
+        """
+        tmp = self._decode(tmp)
+        lines = (tail + tmp).splitlines()
+        if tmp.endswith(('\n', '\r')) or not lines:
+            tail = ""
+        else:
+            tail = lines.pop()
+        # Store decoded lines in ssh.output
+        self._output_write("".join(line+"\n" for line in lines))
+        match_prompt = re.search(SEARCH_PROMPT, tail)
+        if match_prompt:
+            prompt = match_prompt.groups(0)[0]
+            log.debug("found prompt={}".format(prompt))
+            self._prompt = prompt
+            self._output_write(tail+"\n")
+            return tail, True
+        return tail, False
+
+    def _read_timeout(self):
+        """
+        Returns the shell_read deadline in seconds
+        Uses read_timeout or maxround for compatibility (0.1s per round)
+        """
+        if self.read_timeout is not None:
+            return self.read_timeout
+        return self.maxround * 0.1
+
+    def _open_selector(self):
+        """
+        Returns a selector watching the shell channel file descriptor so
+        we are woken up as soon as data is received.
+        Returns None if the channel has no file descriptor (mocked paramiko),
+        recv_ready is then polled every poll_interval
+        """
+        try:
+            fileno = self._channel.fileno()
+        except AttributeError:
+            return None
+        selector = selectors.DefaultSelector()
+        selector.register(fileno, selectors.EVENT_READ)
+        return selector
+
+    def _wait_recv_ready(self, selector, deadline):
+        """
+        Waits until data can be read from the channel or until deadline
+        (a time.monotonic() value) is reached
+        Returns True if data is ready to be received
+        """
+        while not self._channel.recv_ready():
+            if self._channel_ended(self._channel):
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._expire(deadline)
+                return False
+            if selector:
+                selector.select(remaining)
+            else:
+                time.sleep(min(remaining, self.poll_interval))
+        return True
+
+    def _channel_ended(self, channel):
+        """
+        Returns True if nothing more can be received on the channel
+        (closed or end of file received from the remote side)
+        """
+        return getattr(channel, 'closed', False) or getattr(channel, 'eof_received', False)
+
+    def commands(self, commands, concurrent=False, deadline=None):
         """
         Execute a list of commands on remote host using ssh command channel
         Command results is return in self.output
 
+        concurrent : if True, all commands are started at once, each one on
+        its own channel of the same ssh connection (at most max_channels at a
+        time) so the list costs about the time of the longest command.
+        Without it, each command waits for the previous one to end.
+
+        Results of each command are also available in self.results, in the
+        order of commands, as dictionaries with keys :
+        command, stdout, stderr, exit_status (None if unknown, like with mock),
+        timed_out (True if the command was not run or not seen complete
+        before its exec_timeout or the deadline)
+
+        With reconnect, a dead or failing session is opened again and the
+        commands run again (see reconnect)
+
+        deadline : time in seconds for the whole call (self.deadline if None),
+        see shell_send. Each exec channel waits for data exec_timeout seconds
+        at most, within the deadline
+
         Returns True upon success
         """
-        log.debug("Enter with commands={}".format(commands))
+        if self.mux:
+            result_flag = self._mux_call('commands', commands=commands, concurrent=concurrent, deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        return self._run(self._with_reconnect(functools.partial(self._commands, commands, concurrent), deadline))
+
+    def _commands(self, commands, concurrent):
+        """
+        Steps running commands on exec channels, see commands
+        Returns True upon success
+        """
+        log.debug("Enter with commands={} concurrent={}".format(commands, concurrent))
         self.output = ''
-        ssh_error = False
+        self.results = []
         result_flag = True
         if not self.connected:
-            self.connect()
+            yield 'connect',
         try:
             if self.connected:
-                for command in commands:
-                    log.debug("Executing command {} [context={}]".format(command, self.mock_context))
-                    self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
-                    stdin, stdout, stderr = self._client.exec_command(command, timeout=10)
-                    # stdout could either be a channel object (real paramiko)
-                    # or a filehandle when using mocked paramiko.
-                    # The real paramiko requires a decode('utf-8') which is
-                    # not supported by the filehandle.
-                    read_stdout = stdout.read()
-                    if type(read_stdout) is str:
-                        # Mocked paramiko or paramiko on python2
-                        log.debug("read_stdout is a {} (mocked paramiko or python2)".format(type(read_stdout)))
-                        read = re.compile(r'\x1b[^m]*m').sub('', read_stdout)
-                        log.debug("read={}".format(read))
-                        self.output += read
-                    else:
-                        # paramiko on python3
-                        log.debug("read_stdout is a {} (paramiko on python3)".format(type(read_stdout)))
-                        read = re.compile(r'\x1b[^m]*m').sub('', read_stdout.decode('utf-8'))
-                        log.debug("read={}".format(read))
-                        self.output += read
-                    ssh_error = stderr.read()
-                    if ssh_error:
+                errors = []
+                if concurrent and len(commands) > 1:
+                    self.results = yield '_exec_concurrent', errors, commands
+                else:
+                    for command in commands:
+                        if self._expired():
+                            log.debug("deadline reached, command={} not run".format(command))
+                            break
+                        self.results.append((yield from self._exec_guarded(errors, command)))
+                        if errors:
+                            break
+                for result in self.results:
+                    self.output += result['stdout']
+                    if result['timed_out']:
+                        log.debug("Command timed out : {}".format(result['command']))
+                        result_flag = False
+                    elif result['stderr']:
                         log.debug("Problem occurred while running : {} : {}".
-                                  format(str(command), str(ssh_error)))
+                                  format(result['command'], result['stderr']))
                         result_flag = False
                     else:
-                        log.debug("Successfully sent {}".format(command))
+                        log.debug("Successfully sent {}".format(result['command']))
+                if errors:
+                    # output of the commands run is kept
+                    log.debug("Failed to execute the commands {} : {}".format(commands, errors[0]))
+                    self._reset()
+                    result_flag = False
             else:
                 log.debug("Could not establish SSH connection")
                 result_flag = False
         except socket.timeout as e:
             log.debug("Command timed out : {}".format(e))
-            self._client.close()
+            self._reset()
             result_flag = False
         except paramiko.SSHException:
-            log.debug("Failed to execute the command {}".format(command))
-            self._client.close()
+            log.debug("Failed to execute the commands {}".format(commands))
+            self._reset()
             result_flag = False
         self.trace_write(self.output)
         return result_flag
 
-    def invoke_channel(self):
+    def _exec_concurrent(self, errors, commands):
         """
-        Opens a new ssh channel for data
-        Opens also the ssh session if needed
+        Runs commands at once, each one on its own channel (at most
+        max_channels at a time), see _exec_guarded
+        Returns the list of command result dictionaries
         """
-        log.debug("Enter")
-        if not self.connected:
-            self.connect()
-        self._channel = self._client.invoke_shell(term='dumb',
+        workers = min(len(commands), self.max_channels)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda command: self._run(self._exec_guarded(errors, command)), commands))
+
+    def _exec_command(self, command):
+        """
+        Steps running a command on its own ssh channel and waiting for its end
+        Returns the command result dictionary (see commands)
+        """
+        log.debug("Executing command {} [context={}]".format(command, self.mock_context))
+        if self._expired():
+            log.debug("deadline reached, command={} not run".format(command))
+            return self._exec_result(command, b'', b'', None, True)
+        self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
+        probe = self._new_probe(command)
+        stdin, stdout, stderr = yield '_exec_open', command
+        try:
+            read_stdout, read_stderr = yield '_exec_read', stdout, stderr, self.exec_timeout, probe
+        except socket.timeout as e:
+            # the session is fine, only this command is given up
+            log.debug("Command timed out : {}".format(e))
+            self._probe_record(probe, False)
+            if getattr(stdout, 'channel', None) is not None:
+                stdout.channel.close()
+            return self._exec_result(command, b'', b'', None, True)
+        self._probe_record(probe, True)
+        exit_status = None
+        channel = getattr(stdout, 'channel', None)
+        if channel is not None:
+            exit_status = yield '_exit_status', channel
+        return self._exec_result(command, read_stdout, read_stderr, exit_status)
+
+    def _exec_guarded(self, errors, command):
+        """
+        Steps running command like _exec_command. A session failure is added
+        to the errors list instead of being raised, so the results of the
+        other commands are kept
+        Returns the command result dictionary, empty if it failed
+        """
+        try:
+            return (yield from self._exec_command(command))
+        except (socket.timeout, paramiko.SSHException) as e:
+            errors.append(e)
+            return self._exec_result(command, b'', b'', None)
+
+    def _exec_open(self, command):
+        """
+        Opens the exec channel of command
+        Returns the tuple (stdin, stdout, stderr) of paramiko exec_command
+        """
+        return self._client.exec_command(command, timeout=self._remaining(self.exec_timeout))
+
+    def _exit_status(self, channel):
+        """
+        Returns the exit status of the command run on the exec channel
+        """
+        return channel.recv_exit_status()
+
+    def _exec_read(self, stdout, stderr, timeout, probe=None):
+        """
+        Reads stdout and stderr of an exec_command until the remote command
+        ends. Raises socket.timeout if nothing is received for timeout seconds
+        or at the deadline of the call
+        Reads are recorded in probe (a CommandProbe) if given
+        Returns a tuple (stdout data, stderr data)
+        """
+        channel = getattr(stdout, 'channel', None)
+        if channel is None:
+            # Mocked paramiko returns filehandles
+            read_stdout, read_stderr = stdout.read(), stderr.read()
+            if probe is not None:
+                probe.received(len(read_stdout) + len(read_stderr))
+            return read_stdout, read_stderr
+        read_stdout = bytearray()
+        read_stderr = bytearray()
+        selector = selectors.DefaultSelector()
+        selector.register(channel.fileno(), selectors.EVENT_READ)
+        try:
+            deadline = self._until(timeout)
+            while True:
+                if channel.recv_ready():
+                    data = channel.recv(32768)
+                    read_stdout += data
+                elif channel.recv_stderr_ready():
+                    data = channel.recv_stderr(32768)
+                    read_stderr += data
+                elif self._channel_ended(channel):
+                    break
+                elif time.monotonic() >= deadline:
+                    self._expire(deadline)
+                    raise socket.timeout("no data received for {}s".format(timeout))
+                else:
+                    # stderr data does not wake up the channel file descriptor
+                    selector.select(max(0, min(deadline, time.monotonic() + 0.1) - time.monotonic()))
+                    continue
+                if probe is not None:
+                    probe.received(len(data))
+                deadline = self._until(timeout)
+        finally:
+            selector.close()
+        return bytes(read_stdout), bytes(read_stderr)
+
+    def _exec_result(self, command, read_stdout, read_stderr, exit_status, timed_out=False):
+        """
+        Returns the result dictionary of a command (see commands)
+        """
+        # stdout is either bytes from a channel (real paramiko) or a string
+        # from a filehandle (mocked paramiko), StreamDecoder takes both
+        return {'command': command, 'stdout': StreamDecoder().decode(read_stdout, final=True),
+                'stderr': StreamDecoder().decode(read_stderr, final=True), 'exit_status': exit_status,
+                'timed_out': timed_out}
+
+    def invoke_channel(self):
+        """
+        Opens a new ssh channel for data
+        Opens also the ssh session if needed
+        Not available with the mux daemon session
+        """
+        log.debug("Enter")
+        if self._mux_refused('invoke_channel'):
+            return
+        if not self.connected:
+            self.connect()
+        self._open_channel()
+
+    def _open_channel(self):
+        """
+        Opens the shell channel on the connected session
+        """
+        self._channel = self._client.invoke_shell(term='dumb',
                                                   width=0,
                                                   height=0,
                                                   width_pixels=0,
                                                   height_pixels=0,
                                                   environment=None)
+        self._decoder = StreamDecoder()
 
     def channel_send(self, data=""):
         """
@@ -438,12 +1596,14 @@ class Ssh(object):
         Sends data on an already opened channel
         Use shell_read to get the data output (including the ones sent here)
         """
-        log.debug("Enter with data={}".format(data))
+        log.debug("Enter with data=%s", data)
+        if self._mux_refused('channel_send'):
+            return
         if not self._channel:
             log.debug("Channel is not opened, opening")
             self.invoke_channel()
         if self._channel.send_ready():
-            log.debug("sending data={}".format(data))
+            log.debug("sending data=%s", data)
             # no tracing : done on read (otherwise commands are doubled)
             self._channel.send(data)
 
@@ -454,26 +1614,26 @@ class Ssh(object):
         Unlike shell_read, does not try to identify a prompt to stop reading
         Should be used for short read without prompt, for example, to check if
         packet has been received on netcat (a few chars).
-        Faster then shell_read
+        Faster then shell_read : waits at most channel_timeout seconds for
+        data to arrive
         Returns the received data or empty string if no data
         """
         log.debug("Enter")
         read_block = ""
+        if self._mux_refused('channel_read'):
+            return ""
         if not self._channel:
             log.debug("Channel is not opened, leaving")
             return ""
-        time.sleep(0.1)
-        if self._channel.recv_ready():
-            time.sleep(0.1)
+        selector = self._open_selector()
+        try:
+            ready = self._wait_recv_ready(selector, time.monotonic() + self.channel_timeout)
+        finally:
+            if selector:
+                selector.close()
+        if ready:
             read_stdout = self._channel.recv(99999)
-            if type(read_stdout) is str:
-                read = re.compile(r'\x1b[^m]*m').sub('', read_stdout)
-                log.debug("Reading channel read={}".format(read))
-                read_block += read
-            else:
-                read = re.compile(r'\x1b[^m]*m').sub('', read_stdout.decode('utf-8'))
-                log.debug("Reading channel read={}".format(read))
-                read_block += read
+            read_block = self._decode(read_stdout)
         self.trace_write(read_block)
         return read_block
 
@@ -498,40 +1658,68 @@ class Ssh(object):
             self.mock_exception = exception
             self._client.mock(exception=exception)
 
-    def trace_open(self, filename="tracefile.log"):
+    def trace_open(self, filename="tracefile.log", flush_interval=1, max_size=0, backups=5, compress=False):
         """
         Activates file tracing
         Record tracefile name
-        Does not open the tracefile, each write will open and closed it
-        This is needed to make sure all data is flushed in realtime
         Opens an output file to copy all commands output
         This file could be used for command post-processing
+        The file is written by a background thread keeping it opened (see
+        TraceWriter) : data reaches the file within flush_interval seconds,
+        use trace_flush to have it written now. Trace is flushed on close.
+        max_size : size in bytes rotating the file (0 : no rotation), keeping
+        backups older files, gzip compressed if compress is True
         """
-        log.debug("Enter with filename={}".format(filename))
+        log.debug("Enter with filename={} flush_interval={} max_size={} backups={} compress={}"
+                  .format(filename, flush_interval, max_size, backups, compress))
+        self._trace_close()
         self._tracefilename = filename
         self._traceflag = True
+        self._traceoptions = {'flush_interval': flush_interval, 'max_size': max_size,
+                              'backups': backups, 'compress': compress}
 
     def trace_write(self, line):
         """
-        Writes a line in the trace file :
-        Opens tracefile, write and close
+        Writes a line in the trace file
+        The line is queued for the trace writer thread
         """
-        log.debug("Enter with line={}".format(line))
+        log.debug("Enter with line=%s", line)
         if not self._traceflag:
             return
         if self._tracefilename:
-            self._tracefile_FH = open(self._tracefilename, "a")
-            if self._tracefile_FH:
-                try:
-                    self._tracefile_FH.write(line)
-                    self._tracefile_FH.flush()
-                    self._tracefile_FH.close()
-                except:
-                    log.error("Could not write to tracefile")
+            tracer = self._tracer
+            if tracer is None:
+                # commands(concurrent=True) traces from several threads
+                with self._trace_lock:
+                    if self._tracer is None:
+                        self._tracer = TraceWriter(self._tracefilename, **self._traceoptions)
+                    tracer = self._tracer
+            tracer.write(line)
         else:
             log.error("Tracefilename is not defined")
             raise SystemExit
 
+    def trace_flush(self, timeout=None):
+        """
+        Waits until all traced lines are written in the trace file, at most
+        timeout seconds if set
+        Returns False if they could not be written in time
+        """
+        log.debug("Enter")
+        tracer = self._tracer
+        if tracer:
+            return tracer.flush(timeout)
+        return True
+
+    def _trace_close(self):
+        """
+        Stops the trace writer, all traced lines are written
+        """
+        with self._trace_lock:
+            tracer, self._tracer = self._tracer, None
+        if tracer:
+            tracer.close()
+
     def trace_mark(self, mark):
         """
         Write a mark in the trace file. A mark is a preformated line with
@@ -542,6 +1730,1648 @@ class Ssh(object):
         self.trace_write("\n### "+time.strftime("%y%m%d-%H:%M:%S")+" "+str(mark)+" ###\n")
 
 
+class AsyncSsh(Ssh):
+    """
+    asyncio flavor of Ssh, same attributes and same methods as coroutines :
+    connect, close, execute, commands, shell_send, shell_read, read_prompt,
+    invoke_channel, channel_send and channel_read.
+    Tracing and mock methods are the same as Ssh (not coroutines).
+
+    Reads never block the event loop : the channel file descriptor is
+    registered on the loop so thousands of sessions can be driven from a
+    single loop. Operations without a non-blocking flavor in paramiko (key
+    exchange and authentication, channel opening) are run in the loop
+    default executor. The control flow of the calls is shared with Ssh
+    (methods written as steps, see Ssh._run), only the methods waiting for
+    the channel or the executor are overridden.
+
+    One AsyncSsh object should only be used by one coroutine at a time.
+
+    ex:
+        myssh = AsyncSsh(ip='10.5.0.31', user='root', password='fortinet')
+        await myssh.shell_send(['uptime\n'])
+        print(myssh.output)
+        await myssh.close()
+    """
+
+    async def connect(self):
+        """
+        Connects to ssh server, see Ssh.connect
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(Ssh.connect, self))
+
+    async def _mux_call_async(self, method, **kwargs):
+        """
+        Runs method on the device session of the mux daemon, see
+        Ssh._mux_call
+        Returns the result flag, None if the daemon could not be used
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self._mux_call, method, **kwargs))
+
+    def _run(self, steps):
+        """
+        Runs steps with the event loop, see Ssh._run
+        Returns a coroutine of the generator return value
+        """
+        return _run_steps_async(self, steps)
+
+    async def close(self):
+        """
+        Close ssh connection if opened
+        """
+        Ssh.close(self)
+
+    async def execute(self, commands=[], type='command'):
+        """
+        Executes a list of commands on the remote host, see Ssh.execute
+        """
+        log.debug("Enter with type={}".format(type))
+        if type == 'command':
+            return await self.commands(commands)
+        elif type == 'shell':
+            return await self.shell_send(commands)
+
+    async def shell_send(self, commands, pipeline=False, deadline=None):
+        """
+        Open a shell channel and send a list of command, see Ssh.shell_send
+        returns True if commands are sent succesfully before the deadline
+        """
+        if self.mux:
+            result_flag = await self._mux_call_async('shell_send', commands=commands, pipeline=pipeline,
+                                                     deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        return await self._run(self._with_reconnect(functools.partial(self._shell_send, commands, pipeline),
+                                                    deadline))
+
+    async def shell_read(self, deadline=None):
+        """
+        Read the shell until the prompt is seen or read_timeout is reached,
+        see Ssh.shell_read
+        returns True if the prompt was found
+        """
+        if self.mux:
+            result_flag = await self._mux_call_async('shell_read', deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        self._start_deadline(deadline)
+        try:
+            return await self._shell_read()
+        finally:
+            self._deadline = None
+
+    async def _shell_read(self):
+        """
+        Reads the shell until the prompt, see Ssh.shell_read
+        returns True if the prompt was found
+        """
+        timeout = self._read_timeout()
+        log.debug("Enter with [prompt={} timeout={}]".format(self._prompt, timeout))
+        result_flag = False
+        buffer = ReadBuffer(self._new_capture())
+        if not self.connected:
+            await self.connect()
+        try:
+            if self.connected:
+                if not self._channel:
+                    await self.invoke_channel()
+                deadline = self._until(timeout)
+                while await self._wait_readable(self._channel, deadline):
+                    read_stdout = self._channel.recv(9999)
+                    if not read_stdout:
+                        log.debug("Channel is closed")
+                        break
+                    result_flag = self._shell_chunk(buffer, read_stdout)
+                    if result_flag:
+                        break
+        except socket.timeout as e:
+            log.debug("Command timed out : {}".format(e))
+            self._reset()
+            result_flag = False
+        except paramiko.SSHException as e:
+            log.debug("Failed : {}".format(e))
+            self._reset()
+            result_flag = False
+        self._read_end(buffer)
+        return result_flag
+
+    async def stream(self, command, deadline=None):
+        """
+        Sends a command on the shell and yields its output lines as they are
+        received, see Ssh.stream
+        ex:
+            async for line in myssh.stream('diagnose sys session list\n'):
+                parse(line)
+        """
+        log.debug("Enter with command={}".format(command))
+        self.output = ''
+        self._stream_done = False
+        if self._mux_refused('stream'):
+            self._result(False)
+            return
+        if not await self._run(self._open_shell()):
+            return
+        self.trace_write("\n* "+time.strftime("%y%m%d-%H:%M:%S")+" command="+str(command)+"\n")
+        state = self._stream_start(command)
+        end = self._stream_end(deadline)
+        try:
+            while not self._stream_done and await self._wait_readable(self._channel, self._stream_until(end)):
+                read_stdout = self._channel.recv(32768)
+                if not read_stdout:
+                    log.debug("Channel is closed")
+                    break
+                for line in self._stream_chunk(state, read_stdout):
+                    yield line
+        finally:
+            self._stream_finish(end)
+
+    async def shell_stream(self, command, callback, deadline=None):
+        """
+        Sends a command on the shell and calls callback with each line of its
+        output, see Ssh.shell_stream
+        Returns True if the end of the command output was seen
+        """
+        async for line in self.stream(command, deadline):
+            callback(line)
+        return self._stream_done
+
+    async def read_prompt(self):
+        """
+        Reads the channel until we can identify the shell prompt or until
+        prompt_timeout is reached, see Ssh.read_prompt
+        Returns True if prompt si found
+        """
+        log.debug("Enter")
+        found = False
+        tail = ""
+        deadline = self._until(self.prompt_timeout)
+        while not found and await self._wait_readable(self._channel, deadline):
+            tmp = self._channel.recv(99999)
+            if not tmp:
+                log.debug("Channel is closed")
+                break
+            tail, found = self._prompt_chunk(tail, tmp)
+        if not found and tail:
+            self._output_write(tail+"\n")
+        return found
+
+    async def commands(self, commands, concurrent=False, deadline=None):
+        """
+        Execute a list of commands on remote host using ssh command channel
+        Command results is return in self.output and self.results
+        concurrent : run all commands at once on their own channels
+        (see Ssh.commands)
+        Returns True upon success
+        """
+        if self.mux:
+            result_flag = await self._mux_call_async('commands', commands=commands, concurrent=concurrent,
+                                                     deadline=deadline)
+            if result_flag is not None:
+                return result_flag
+        return await self._run(self._with_reconnect(functools.partial(self._commands, commands, concurrent),
+                                                    deadline))
+
+    async def _exec_concurrent(self, errors, commands):
+        """
+        Runs commands at once, each one on its own channel (at most
+        max_channels at a time), see Ssh._exec_concurrent
+        Returns the list of command result dictionaries
+        """
+        channels = asyncio.Semaphore(self.max_channels)
+
+        async def limited(command):
+            async with channels:
+                return await self._run(self._exec_guarded(errors, command))
+        return list(await asyncio.gather(*[limited(command) for command in commands]))
+
+    async def _exec_open(self, command):
+        """
+        Opens the exec channel of command in the executor, see Ssh._exec_open
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self._client.exec_command, command,
+                                    timeout=self._remaining(self.exec_timeout)))
+
+    async def _exit_status(self, channel):
+        """
+        Returns the exit status of the command run on the exec channel,
+        waited for in the executor if not received yet
+        """
+        if channel.exit_status_ready():
+            return channel.recv_exit_status()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, channel.recv_exit_status)
+
+    async def _send_pipeline(self, commands):
+        """
+        Writes all commands at once and splits the received stream per
+        command, see Ssh._send_pipeline
+        Returns True if all commands were seen complete
+        """
+        batch = self._pipeline_start(commands)
+        buffer = ReadBuffer()
+        complete = False
+        deadline = self._until(self._pipeline_timeout(commands))
+        while await self._wait_readable(self._channel, deadline):
+            read_stdout = self._channel.recv(32768)
+            if not read_stdout:
+                log.debug("Channel is closed")
+                break
+            text = buffer.append(self._decode(read_stdout))
+            complete = self._pipeline_complete(batch, buffer, text)
+            if complete:
+                break
+        return self._pipeline_end(batch, buffer.getvalue(), complete)
+
+    async def _send_sentinel(self, command):
+        """
+        Sends command and reads until its marker, see Ssh._send_sentinel
+        Returns True if the marker was received
+        """
+        typed, done = self._sentinel_start(command)
+        buffer = ReadBuffer()
+        match = None
+        deadline = self._until(self.sentinel_timeout)
+        while await self._wait_readable(self._channel, deadline):
+            read_stdout = self._channel.recv(32768)
+            if not read_stdout:
+                log.debug("Channel is closed")
+                break
+            match = self._sentinel_chunk(done, buffer, read_stdout)
+            if match:
+                break
+        return self._sentinel_end(command, typed, buffer, match)
+
+    async def invoke_channel(self):
+        """
+        Opens a new ssh channel for data
+        Opens also the ssh session if needed
+        Not available with the mux daemon session
+        """
+        log.debug("Enter")
+        if self._mux_refused('invoke_channel'):
+            return
+        if not self.connected:
+            await self.connect()
+        await self._open_channel()
+
+    async def _open_channel(self):
+        """
+        Opens the shell channel in the executor, see Ssh._open_channel
+        """
+        loop = asyncio.get_running_loop()
+        self._channel = await loop.run_in_executor(
+            None, functools.partial(self._client.invoke_shell, term='dumb', width=0, height=0,
+                                    width_pixels=0, height_pixels=0, environment=None))
+        self._decoder = StreamDecoder()
+
+    async def channel_send(self, data=""):
+        """
+        Sends data on the channel, opened if needed, see Ssh.channel_send
+        """
+        log.debug("Enter with data=%s", data)
+        if self._mux_refused('channel_send'):
+            return
+        if not self._channel:
+            log.debug("Channel is not opened, opening")
+            await self.invoke_channel()
+        if self._channel.send_ready():
+            log.debug("sending data=%s", data)
+            self._channel.send(data)
+
+    async def channel_read(self):
+        """
+        Read what is available on the channel, waiting at most
+        channel_timeout seconds, see Ssh.channel_read
+        Returns the received data or empty string if no data
+        """
+        log.debug("Enter")
+        read_block = ""
+        if self._mux_refused('channel_read'):
+            return ""
+        if not self._channel:
+            log.debug("Channel is not opened, leaving")
+            return ""
+        if await self._wait_readable(self._channel, time.monotonic() + self.channel_timeout):
+            read_block = self._decode(self._channel.recv(99999))
+        self.trace_write(read_block)
+        return read_block
+
+    async def _wait_readable(self, channel, deadline):
+        """
+        Waits until data can be read from channel or until deadline
+        (a time.monotonic() value) is reached.
+        The channel file descriptor is watched by the event loop, channels
+        without file descriptor (mocked paramiko) are polled every
+        poll_interval
+        Returns True if data is ready to be received
+        """
+        loop = asyncio.get_running_loop()
+        while not channel.recv_ready():
+            if self._channel_ended(channel):
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._expire(deadline)
+                return False
+            try:
+                fileno = channel.fileno()
+                ready = loop.create_future()
+                loop.add_reader(fileno, lambda: ready.done() or ready.set_result(True))
+            except (AttributeError, NotImplementedError):
+                await asyncio.sleep(min(remaining, self.poll_interval))
+                continue
+            try:
+                await asyncio.wait([ready], timeout=remaining)
+            finally:
+                loop.remove_reader(fileno)
+        return True
+
+    async def _exec_read(self, stdout, stderr, timeout, probe=None):
+        """
+        Reads stdout and stderr of an exec_command until the remote command
+        ends. Raises socket.timeout if nothing is received for timeout seconds
+        or at the deadline of the call
+        Reads are recorded in probe (a CommandProbe) if given
+        Returns a tuple (stdout data, stderr data)
+        """
+        channel = getattr(stdout, 'channel', None)
+        if channel is None:
+            # Mocked paramiko returns filehandles
+            read_stdout, read_stderr = stdout.read(), stderr.read()
+            if probe is not None:
+                probe.received(len(read_stdout) + len(read_stderr))
+            return read_stdout, read_stderr
+        read_stdout = bytearray()
+        read_stderr = bytearray()
+        deadline = self._until(timeout)
+        while True:
+            if channel.recv_ready():
+                data = channel.recv(32768)
+                read_stdout += data
+            elif channel.recv_stderr_ready():
+                data = channel.recv_stderr(32768)
+                read_stderr += data
+            elif self._channel_ended(channel):
+                break
+            elif time.monotonic() >= deadline:
+                self._expire(deadline)
+                raise socket.timeout("no data received for {}s".format(timeout))
+            else:
+                # stderr data does not wake up the channel file descriptor
+                await self._wait_readable(channel, min(deadline, time.monotonic() + 0.1))
+                continue
+            if probe is not None:
+                probe.received(len(data))
+            deadline = self._until(timeout)
+        return read_stdout, read_stderr
+
+
+class StreamDecoder(object):
+    """
+    Incremental decoder of the data received on a channel : utf-8 decoding
+    and ANSI escape sequences removal.
+    Data is received in chunks which may end in the middle of a multibyte
+    character or of an escape sequence. The incomplete end of a chunk is kept
+    and completed with the next one, so nothing is lost or garbled.
+    Invalid utf-8 bytes are replaced, they do not break the read.
+    One decoder should be used per channel.
+
+    ex:
+        decoder = StreamDecoder()
+        text = decoder.decode(channel.recv(32768))
+    """
+
+    # An escape sequence longer than this is not a sequence, just data
+    max_escape = 256
+
+    def __init__(self):
+        # Private attributs
+        self._utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._escape = ''  # incomplete escape sequence ending last chunk
+
+    def decode(self, data, final=False):
+        """
+        Returns data (bytes, or str with mocked paramiko) as a string without
+        ANSI escape sequences
+        final : no more data is expected, incomplete character or sequence
+        kept from previous chunks is returned as is
+        """
+        if isinstance(data, str):
+            text = self._escape + data
+        else:
+            text = self._escape + self._utf8.decode(data, final)
+        self._escape = ''
+        if not final:
+            incomplete = ANSI_INCOMPLETE.search(text)
+            if incomplete and len(text) - incomplete.start() <= self.max_escape:
+                self._escape = text[incomplete.start():]
+                text = text[:incomplete.start()]
+        return ANSI_ESCAPE.sub('', text)
+
+
+class ReadBuffer(object):
+    """
+    Decoded text received on a channel during a read.
+    Text is kept as a list of chunks joined once by getvalue instead of
+    growing a string for each chunk received. The last line, not terminated
+    by a newline yet, is kept apart so prompts and markers are looked for in
+    the last received data only
+    capture : OutputCapture receiving complete lines instead of the list
+    """
+
+    def __init__(self, capture=None):
+        # public class attributs
+        self.tail = ''  # last line received, without newline
+        self.scan = 0   # position in getvalue() of the text returned by append
+        self.capture = capture
+        # Private attributs
+        self._lines = []  # chunks of complete lines
+        self._size = 0    # size of complete lines
+
+    def append(self, text):
+        """
+        Adds decoded text
+        Returns the text received since the start of the last line, which
+        starts at position self.scan of the buffer
+        """
+        text = self.tail + text
+        self.scan = self._size
+        end = text.rfind('\n') + 1
+        if end:
+            if self.capture:
+                self.capture.write(text[:end])
+            else:
+                self._lines.append(text[:end])
+            self._size += end
+        self.tail = text[end:]
+        return text
+
+    def getvalue(self):
+        """
+        Returns all the text received
+        """
+        if self.capture:
+            return self.capture.getvalue() + self.tail
+        return "".join(self._lines) + self.tail
+
+    def close(self):
+        """
+        Ends the read : the last line is given to the capture
+        Returns the capture
+        """
+        if self.capture and self.tail:
+            self.capture.write(self.tail)
+            self.tail = ''
+        return self.capture
+
+
+class OutputCapture(object):
+    """
+    Output of a command kept in memory up to limit characters.
+    Beyond, the whole output is written (utf-8 encoded) to an anonymous
+    temporary file and only the first limit characters stay in memory
+    (head), so a huge output does not grow the process memory.
+    Full output can be read without loading it with lines() or view(), a
+    read-only memory map of the file that regular expressions (bytes
+    patterns) can search
+
+    ex:
+        myssh.output_limit = 1000000
+        myssh.shell_read()
+        for line in myssh.capture.lines():
+            parse(line)
+    """
+
+    def __init__(self, limit):
+        # public class attributs
+        self.limit = limit
+        self.size = 0          # characters written
+        self.spilled = False   # output was written to the file
+        # Private attributs
+        self._chunks = []      # head chunks
+        self._file = None      # temporary file once spilled
+        self._view = None      # memory map of the file
+
+    def write(self, text):
+        """
+        Adds text to the output
+        """
+        if self._view is not None:
+            self._view.close()
+            self._view = None
+        if not self.spilled and self.size + len(text) > self.limit:
+            log.debug("output above limit={}, spilled to a temporary file".format(self.limit))
+            self._file = tempfile.TemporaryFile()
+            for chunk in self._chunks:
+                self._file.write(chunk.encode('utf-8'))
+            self.spilled = True
+        if self.spilled:
+            self._file.write(text.encode('utf-8'))
+            room = self.limit - self.size
+            if room > 0:
+                self._chunks.append(text[:room])
+        else:
+            self._chunks.append(text)
+        self.size += len(text)
+
+    @property
+    def head(self):
+        """
+        First limit characters of the output (all of it if not spilled)
+        """
+        return "".join(self._chunks)
+
+    def getvalue(self):
+        """
+        Returns the whole output as a string (loaded from the file if spilled)
+        """
+        if not self.spilled:
+            return self.head
+        return bytes(self.view()).decode('utf-8')
+
+    def view(self):
+        """
+        Returns the whole output as a read-only bytes-like object : a memory
+        map of the file if spilled, utf-8 encoded head otherwise
+        """
+        if not self.spilled:
+            return self.head.encode('utf-8')
+        if self._view is None:
+            self._file.flush()
+            self._view = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._view
+
+    def chunks(self, size=1048576):
+        """
+        Yields the whole output in strings of about size characters
+        """
+        if not self.spilled:
+            yield self.head
+            return
+        view = self.view()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for start in range(0, len(view), size):
+            yield decoder.decode(view[start:start+size], start+size >= len(view))
+
+    def lines(self):
+        """
+        Yields each line of the whole output, with its newline
+        """
+        if not self.spilled:
+            yield from self.head.splitlines(keepends=True)
+            return
+        view = self.view()
+        view.seek(0)
+        for line in iter(view.readline, b''):
+            yield line.decode('utf-8')
+
+    def close(self):
+        """
+        Removes the temporary file
+        """
+        if self._view is not None:
+            self._view.close()
+            self._view = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class TraceWriter(object):
+    """
+    Trace file written by a background thread.
+    The file stays opened, lines are queued by write and written by the
+    thread which flushes the file every flush_interval seconds, on flush()
+    and on close(). If the queue is full (queue_size lines), write waits for
+    the thread so a slow disk does not grow the memory.
+    With max_size (bytes), the file is rotated when bigger : it is renamed
+    filename.1 (filename.1.gz if compress), older ones shifted up to
+    filename.<backups>
+    Lines are written utf-8 encoded
+    """
+
+    def __init__(self, filename, flush_interval=1, max_size=0, backups=5, compress=False, queue_size=10000):
+        # public class attributs
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.backups = backups
+        self.compress = compress
+        # Private attributs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="trace-"+filename, daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        """
+        Queues a line for the trace file
+        """
+        if self._closed:
+            log.error("Could not write to closed tracefile")
+            return
+        self._put(line)
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued lines are written and flushed to the file, at
+        most timeout seconds if set
+        Returns False if the lines were not written in time or the writer
+        thread is gone
+        """
+        if self._closed:
+            return True
+        until = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        if not self._put(done, until):
+            return False
+        while not done.wait(0.1):
+            if not self._thread.is_alive() or (until is not None and time.monotonic() >= until):
+                log.error("tracefile not flushed")
+                return False
+        return True
+
+    def close(self):
+        """
+        Writes all queued lines, closes the file and stops the thread
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._put(None):
+            self._thread.join()
+
+    def _put(self, item, until=None):
+        """
+        Queues item, waiting for room while the writer thread is alive (and
+        until time.monotonic() deadline until if set)
+        Returns False if item could not be queued
+        """
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if not self._thread.is_alive() or (until is not None and time.monotonic() >= until):
+                    log.error("Could not queue to tracefile, writer is stuck")
+                    return False
+
+    def _run(self):
+        """
+        Writer thread : writes queued lines until None is received
+        """
+        tracefile = self._open()
+        size = tracefile.tell() if tracefile else 0
+        flushed = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0, flushed + self.flush_interval - time.monotonic()))
+                except queue.Empty:
+                    item = ''
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    self._flush(tracefile)
+                    flushed = time.monotonic()
+                    item.set()
+                    continue
+                if item and tracefile:
+                    try:
+                        data = item.encode('utf-8', errors='replace')
+                        tracefile.write(data)
+                        size += len(data)
+                    except (OSError, ValueError) as e:
+                        log.error("Could not write to tracefile : {}".format(e))
+                    if self.max_size and size >= self.max_size:
+                        tracefile.close()
+                        self._rotate()
+                        tracefile = self._open()
+                        size = 0
+                if time.monotonic() - flushed >= self.flush_interval:
+                    self._flush(tracefile)
+                    flushed = time.monotonic()
+        finally:
+            if tracefile:
+                tracefile.close()
+
+    def _open(self):
+        """
+        Returns the trace file opened for append, None if it can't be opened
+        """
+        try:
+            return open(self.filename, "ab")
+        except OSError as e:
+            log.error("Could not open tracefile : {}".format(e))
+            return None
+
+    def _flush(self, tracefile):
+        """
+        Flushes the trace file, errors are only logged
+        """
+        if not tracefile:
+            return
+        try:
+            tracefile.flush()
+        except (OSError, ValueError) as e:
+            log.error("Could not flush tracefile : {}".format(e))
+
+    def _rotate(self):
+        """
+        Renames the trace file filename.1, shifting older ones
+        """
+        suffix = '.gz' if self.compress else ''
+        log.debug("rotate tracefile={}".format(self.filename))
+        try:
+            if self.backups < 1:
+                os.remove(self.filename)
+                return
+            for index in range(self.backups - 1, 0, -1):
+                older = "{}.{}{}".format(self.filename, index, suffix)
+                if os.path.exists(older):
+                    os.replace(older, "{}.{}{}".format(self.filename, index + 1, suffix))
+            if self.compress:
+                with open(self.filename, 'rb') as source, gzip.open(self.filename+".1.gz", 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(self.filename)
+            else:
+                os.replace(self.filename, self.filename+".1")
+        except OSError as e:
+            log.error("Could not rotate tracefile : {}".format(e))
+
+
+class SshPoolExhausted(paramiko.SSHException):
+    """
+    No connection available in the pool for this host before wait_timeout
+    """
+
+
+class SshPool(object):
+    """
+    Pool of authenticated ssh connections shared between Ssh objects, so a
+    device used again by the same process does not pay for a new key
+    exchange and authentication.
+    Connections are keyed by (ip, port, user, password digest,
+    private_key_file, jump host identity) : a connection is only reused with
+    the same credentials, and devices with the same address behind
+    different bastions are kept apart. The port is compared as an integer
+    and the password is only kept as a digest (see Ssh._pool_key).
+
+    max_per_host : maximum number of connections (used and idle) per key.
+    An Ssh connecting to a host already at max_per_host waits up to
+    wait_timeout seconds for a connection to be released, then fails.
+    idle_timeout : idle connections older than idle_timeout seconds are closed
+    health_check : if True, an ssh 'ignore' message is sent on an idle
+    connection before handing it out to make sure the peer is still there.
+    Inactive transports are always dropped.
+
+    Pool counters : hits, misses, expired, evicted (unhealthy), see stats()
+
+    ex:
+        pool = SshPool(max_per_host=2, idle_timeout=60)
+        myssh = Ssh(ip='10.5.0.31', user='root', password='fortinet', pool=pool)
+        myssh.commands(['uptime'])
+        myssh.close()      # back to the pool
+        myssh.connect()    # no new handshake
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=300, health_check=True, wait_timeout=10):
+        log.debug("Constructor with max_per_host={} idle_timeout={} health_check={} wait_timeout={}"
+                  .format(max_per_host, idle_timeout, health_check, wait_timeout))
+        # public class attributs
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        # Private attributs
+        self._idle = {}   # key : list of (client, release time), last released at the end
+        self._count = {}  # key : number of connections, used and idle
+        self._lock = threading.Condition()
+
+    def acquire(self, key, factory):
+        """
+        Returns a live authenticated paramiko client for key.
+        An idle connection is reused if any, otherwise factory is called to
+        create a new one. Exceptions from factory are raised to the caller.
+        Raises SshPoolExhausted if max_per_host is reached for wait_timeout
+        """
+        log.debug("Enter with key={}".format(key))
+        deadline = time.monotonic() + self.wait_timeout
+        with self._lock:
+            while True:
+                self._expire()
+                idle = self._idle.get(key)
+                while idle:
+                    client, released = idle.pop()
+                    if self._healthy(client):
+                        self.hits += 1
+                        log.debug("pool hit key={}".format(key))
+                        return client
+                    log.debug("evict unhealthy connection key={}".format(key))
+                    self.evicted += 1
+                    self._drop(key, client)
+                if self._count.get(key, 0) < self.max_per_host:
+                    self._count[key] = self._count.get(key, 0) + 1
+                    self.misses += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SshPoolExhausted("no connection available for {} after {}s"
+                                           .format(key, self.wait_timeout))
+                self._lock.wait(remaining)
+        # New connection created out of the lock, the slot is already reserved
+        log.debug("pool miss key={}".format(key))
+        try:
+            return factory()
+        except BaseException:
+            with self._lock:
+                self._count[key] -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, key, client):
+        """
+        Gives back a client obtained with acquire
+        """
+        log.debug("Enter with key={}".format(key))
+        with self._lock:
+            if self._healthy(client, probe=False):
+                self._idle.setdefault(key, []).append((client, time.monotonic()))
+            else:
+                self._drop(key, client)
+            self._expire()
+            self._lock.notify()
+
+    def clear(self):
+        """
+        Closes all idle connections
+        """
+        log.debug("Enter")
+        with self._lock:
+            for key in self._idle:
+                for client, released in self._idle[key]:
+                    self._drop(key, client)
+            self._idle = {}
+            self._lock.notify_all()
+
+    def stats(self):
+        """
+        Returns pool counters as a dictionary
+        """
+        with self._lock:
+            idle = sum(len(self._idle[key]) for key in self._idle)
+            return {'hits': self.hits, 'misses': self.misses,
+                    'expired': self.expired, 'evicted': self.evicted,
+                    'idle': idle, 'used': sum(self._count.values()) - idle}
+
+    def _expire(self):
+        """
+        Closes connections idle for more than idle_timeout
+        Called with the lock held
+        """
+        limit = time.monotonic() - self.idle_timeout
+        for key in self._idle:
+            idle = self._idle[key]
+            # oldest first
+            while idle and idle[0][1] < limit:
+                client, released = idle.pop(0)
+                log.debug("expire idle connection key={}".format(key))
+                self.expired += 1
+                self._drop(key, client)
+
+    def _drop(self, key, client):
+        """
+        Closes a client and frees its slot
+        Called with the lock held
+        """
+        self._count[key] -= 1
+        try:
+            client.close()
+        except Exception as e:
+            log.debug("exception on close : {}".format(e))
+
+    def _healthy(self, client, probe=True):
+        """
+        Returns True if the client transport is still active
+        If probe and health_check, also sends an ssh ignore message
+        """
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if probe and self.health_check:
+            try:
+                transport.send_ignore()
+            except Exception as e:
+                log.debug("health check failed : {}".format(e))
+                return False
+        return True
+
+
+# Process wide pool, used with Ssh(pool=True)
+ssh_pool = SshPool()
+
+
+class JumpHost(object):
+    """
+    Bastion the devices are reached through, like ssh -J : one
+    authenticated ssh connection to the bastion is shared by all Ssh objects
+    using it, each device session runs in a direct-tcpip channel of it. No
+    ProxyCommand process, no bastion handshake per device.
+    The bastion is connected on first use, and again if its connection is
+    found dead. Keepalive messages keep it opened between polling cycles.
+    A bastion may itself be reached through another one (jump).
+    Thread safe.
+
+    ex:
+        bastion = JumpHost(ip='10.5.0.1', user='lab', private_key_file='/home/me/.ssh/id_ed25519')
+        vm = Ssh(ip='192.168.0.10', user='root', password='fortinet', jump=bastion)
+    """
+
+    def __init__(self, ip='', port=22, user='admin', password='', private_key_file='', keepalive=30, jump=None):
+        log.debug("Constructor with ip={}, port={}, user={}, private_key_file={}, keepalive={}"
+                  .format(ip, port, user, private_key_file, keepalive))
+        # public class attributs
+        self.ssh = Ssh(ip=ip, port=port, user=user, password=password,
+                       private_key_file=private_key_file, jump=jump)
+        self.ssh.keepalive = keepalive
+        self.channels = 0  # direct-tcpip channels opened
+        # Private attributs
+        self._lock = threading.Lock()
+
+    def open_channel(self, ip, port=22, timeout=None):
+        """
+        Returns a direct-tcpip channel to ip and port through the bastion,
+        usable as the sock of a paramiko client connect
+        Raises paramiko.SSHException if the bastion can not be reached, or
+        paramiko.ChannelException if the bastion refused the channel (device
+        unreachable from the bastion)
+        Only a dead bastion connection is opened again : a device failure
+        does not break the sessions of the other devices behind the bastion
+        """
+        log.debug("Enter with ip={} port={}".format(ip, port))
+        transport = self._transport()
+        try:
+            channel = transport.open_channel('direct-tcpip', (ip, port), ('127.0.0.1', 0), timeout=timeout)
+        except paramiko.ChannelException:
+            raise
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            log.debug("jump channel failed : {}".format(e))
+            with self._lock:
+                alive = transport.is_active() and self.ssh.alive()
+                if not alive:
+                    self.ssh._reset()
+            if alive:
+                # ex: timeout opening channel, the bastion is fine
+                raise
+            # bastion connection died since our check, once more
+            transport = self._transport()
+            channel = transport.open_channel('direct-tcpip', (ip, port), ('127.0.0.1', 0), timeout=timeout)
+        with self._lock:
+            self.channels += 1
+        return channel
+
+    def identity(self):
+        """
+        Returns the identity of the bastion (and of its own bastion if any),
+        part of the pool key of the devices behind it
+        """
+        return self.ssh._pool_key()
+
+    def _transport(self):
+        """
+        Returns the transport of the bastion connection, connected first if
+        needed
+        Raises paramiko.SSHException if the bastion can not be reached
+        """
+        with self._lock:
+            if self.ssh.connected and not self.ssh.alive():
+                log.debug("jump host connection is dead")
+                self.ssh._reset()
+            if not self.ssh.connected and not self.ssh.connect():
+                raise paramiko.SSHException("Could not connect jump host {}:{}".format(self.ssh.ip, self.ssh.port))
+            return self.ssh._client.get_transport()
+
+    def close(self):
+        """
+        Closes the bastion connection, sessions through it are closed too
+        """
+        with self._lock:
+            self.ssh.close()
+
+
+# JumpHost shared by Ssh objects given the same jump host definition
+_jump_hosts = {}
+_jump_lock = threading.Lock()
+
+
+def jump_host(ip='', port=22, user='admin', password='', private_key_file='', **kwargs):
+    """
+    Returns the process wide JumpHost of a bastion, created on first call,
+    so all devices behind it share its connection (see Ssh jump)
+    Other arguments are given to JumpHost when it is created
+    """
+    key = (ip, int(port), user, _digest(password), private_key_file)
+    with _jump_lock:
+        bastion = _jump_hosts.get(key)
+        if bastion is None:
+            bastion = _jump_hosts[key] = JumpHost(ip=ip, port=port, user=user, password=password,
+                                                   private_key_file=private_key_file, **kwargs)
+        return bastion
+
+
+class SshMux(object):
+    """
+    Local daemon owning device ssh sessions for several processes, like an
+    OpenSSH ControlMaster : short-lived scripts (cron jobs, dashboards)
+    using Ssh(mux=path) have their connect, shell_send, shell_read and
+    commands run on the session kept opened by the daemon, so they do not
+    pay the handshake and the device sees one session whatever the number
+    of processes. Methods using the local shell channel (stream,
+    invoke_channel, channel_send, channel_read) are refused in this mode.
+    Requests are json lines on a unix socket (only accessible to its
+    user). Requests for the same device are run one at a time on its
+    session, sessions unused for idle_timeout seconds are closed.
+
+    ex:
+        daemon : SshMux('/tmp/netcontrol.sock').serve_forever()
+        scripts : Ssh(ip='10.5.0.31', user='admin', mux='/tmp/netcontrol.sock')
+    """
+
+    def __init__(self, path, idle_timeout=600, keepalive=30):
+        log.debug("Constructor with path={} idle_timeout={} keepalive={}".format(path, idle_timeout, keepalive))
+        # public class attributs
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.requests = 0   # requests answered
+        # Private attributs
+        self._lock = threading.Lock()
+        self._sessions = {}  # device key : [Ssh, lock, time.monotonic() of last use]
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Listens on the unix socket in a background thread
+        Returns the SshMux object
+        """
+        self._listen()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='netcontrol-mux', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Listens on the unix socket until stop is called
+        """
+        self._listen()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stops listening and closes all device sessions
+        """
+        log.debug("Enter")
+        if self._server:
+            if self._thread:
+                self._server.shutdown()
+                self._thread.join()
+                self._thread = None
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for ssh, lock, used in sessions:
+            with lock:
+                ssh.close()
+
+    def handle(self, request):
+        """
+        Runs a request (see Ssh._mux_call) on the device session
+        Returns the answer dictionary
+        """
+        method = request.get('method')
+        if method not in ('connect', 'shell_send', 'shell_read', 'commands'):
+            return {'error': "unknown method {}".format(method)}
+        ssh, lock = self._session(request['device'])
+        with lock:
+            for name, value in request.get('options', {}).items():
+                if name in MUX_OPTIONS:
+                    setattr(ssh, name, value)
+            if ssh.mock_context:
+                ssh.mock(context=ssh.mock_context)
+            result_flag = getattr(ssh, method)(**request.get('kwargs', {}))
+            answer = {'result': result_flag, 'output': ssh.output, 'outputs': ssh.outputs,
+                      'results': ssh.results, 'exit_status': ssh.exit_status, 'timed_out': ssh.timed_out}
+        with self._lock:
+            self.requests += 1
+        return answer
+
+    def _session(self, device):
+        """
+        Returns the (Ssh, lock) of a device, created if needed. Idle sessions
+        are closed on the way
+        """
+        key = (device['ip'], device['port'], device['user'], device['password'], device['private_key_file'])
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            for other, session in list(self._sessions.items()):
+                if other != key and now - session[2] > self.idle_timeout and not session[1].locked():
+                    idle.append(self._sessions.pop(other)[0])
+            session = self._sessions.get(key)
+            if session is None:
+                ssh = Ssh(**device)
+                ssh.keepalive = self.keepalive
+                # a long lived session may die between requests
+                ssh.reconnect = 1
+                session = self._sessions[key] = [ssh, threading.Lock(), now]
+            session[2] = now
+        for ssh in idle:
+            log.debug("closing idle session ip={}".format(ssh.ip))
+            ssh.close()
+        return session[0], session[1]
+
+    def _listen(self):
+        """
+        Creates the unix socket server, only accessible to our user
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        umask = os.umask(0o177)
+        try:
+            self._server = SshMuxServer(self.path, SshMuxHandler)
+        finally:
+            os.umask(umask)
+        self._server.mux = self
+        log.debug("listening on path={}".format(self.path))
+
+
+class SshMuxServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server of SshMux, one thread per client connection
+    """
+    daemon_threads = True
+
+
+class SshMuxHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the json line requests of a client connection, see SshMux
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                answer = self.server.mux.handle(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                log.debug("request failed : {}".format(e))
+                answer = {'error': str(e)}
+            try:
+                self.wfile.write(json.dumps(answer).encode('utf-8') + b"\n")
+            except OSError as e:
+                # client gone (it gave up waiting)
+                log.debug("answer not sent : {}".format(e))
+                return
+
+
+def load_private_key(filename, password=None):
+    """
+    Returns the private key read from filename, trying each supported key
+    type (KEY_CLASSES)
+    Raises paramiko.PasswordRequiredException if the key is encrypted and
+    no password given, paramiko.SSHException if the key type is unknown
+    """
+    for name in KEY_CLASSES:
+        key_class = getattr(paramiko, name, None)
+        if key_class is None:
+            continue
+        try:
+            return key_class.from_private_key_file(filename, password=password)
+        except paramiko.PasswordRequiredException:
+            raise
+        except paramiko.SSHException as e:
+            log.debug("{} is not a {} : {}".format(filename, name, e))
+    raise paramiko.SSHException("unsupported private key type in {}".format(filename))
+
+
+class KeyCache(object):
+    """
+    Process wide cache of the private keys and known_hosts files parsed by
+    paramiko, so connecting to many devices parses them only once.
+    A file is parsed again when its modification time or size changes.
+    Host keys objects are shared : clients get a copy of the keys of their
+    host (see Ssh._open_client).
+    Private keys are RSA, Ed25519 or ECDSA (see load_private_key).
+    Thread safe.
+
+    ex:
+        key_cache.private_key('/home/me/.ssh/id_ed25519')
+    """
+
+    def __init__(self):
+        # public class attributs
+        self.hits = 0     # files found in cache
+        self.misses = 0   # files parsed
+        # Private attributs
+        self._lock = threading.Lock()
+        self._keys = {}       # (filename, password) : (fingerprint, key)
+        self._host_keys = {}  # filename : (fingerprint, paramiko.HostKeys)
+
+    def private_key(self, filename, password=None):
+        """
+        Returns the private key of filename, parsed if not cached or changed
+        Raises the exceptions of load_private_key, OSError if not readable
+        """
+        return self._get(self._keys, (filename, password), filename,
+                         lambda: load_private_key(filename, password))
+
+    def host_keys(self, filename=None):
+        """
+        Returns the paramiko.HostKeys of a known_hosts file, by default the
+        user one (~/.ssh/known_hosts). A missing file gives empty host keys
+        like paramiko SSHClient.load_system_host_keys does
+        """
+        if filename is None:
+            filename = os.path.expanduser(os.path.join("~", ".ssh", "known_hosts"))
+        return self._get(self._host_keys, filename, filename,
+                         lambda: self._load_host_keys(filename))
+
+    def clear(self):
+        """
+        Forgets all cached keys
+        """
+        with self._lock:
+            self._keys.clear()
+            self._host_keys.clear()
+
+    def _get(self, cache, key, filename, load):
+        """
+        Returns the cached object of key if filename did not change since,
+        otherwise the object returned by load()
+        """
+        fingerprint = self._fingerprint(filename)
+        with self._lock:
+            cached = cache.get(key)
+            if cached and cached[0] == fingerprint:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            log.debug("parsing filename={}".format(filename))
+            value = load()
+            cache[key] = (fingerprint, value)
+            return value
+
+    def _fingerprint(self, filename):
+        """
+        Returns what identifies a version of filename : (mtime, size), None
+        if the file does not exist
+        """
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load_host_keys(self, filename):
+        """
+        Returns the paramiko.HostKeys of filename, empty if no such file
+        """
+        host_keys = paramiko.HostKeys()
+        if os.path.exists(filename):
+            host_keys.load(filename)
+        return host_keys
+
+
+# Process wide cache of private keys and known_hosts
+key_cache = KeyCache()
+
+
+class CommandProbe(object):
+    """
+    Timing and size of one command while it runs, see SshMetrics.record
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.start = time.monotonic()
+        self.first_byte = None  # seconds from start to the first data
+        self.bytes = 0          # bytes (characters with mock) received
+        self.rounds = 0         # channel reads
+
+    def received(self, size):
+        """
+        Records a read of size bytes
+        """
+        if self.first_byte is None:
+            self.first_byte = time.monotonic() - self.start
+        self.bytes += size
+        self.rounds += 1
+
+
+class SshMetrics(object):
+    """
+    Process wide registry of timing and size metrics recorded by Ssh
+    objects (see Ssh.metrics), keyed by device and normalized command (see
+    normalize_command) to find slow devices and slow commands of polling
+    cycles without tracing. Thread safe.
+
+    Histograms, in seconds :
+      connect_seconds : connection and authentication (command is '')
+      first_byte_seconds : from sending a command to its first data
+      prompt_seconds : from sending a command until it is complete (prompt
+      or marker received, exec channel closed)
+    Counters :
+      commands_total : commands run
+      timeouts_total : commands not seen complete
+      bytes_total : bytes received
+      rounds_total : channel reads
+
+    Commands are the ones of shell_send, commands and stream.
+    Metrics are only recorded by the Ssh objects given the registry. At
+    most max_series (device, command) series are kept : commands of new
+    series beyond are counted under device and command 'other', so
+    commands with variable arguments do not grow the memory forever.
+
+    ex:
+        myssh.metrics = ssh_metrics
+        print(ssh_metrics.as_dict()['prompt_seconds']['10.5.0.31'])
+        with open('netcontrol.prom', 'w') as f:
+            f.write(ssh_metrics.prometheus())
+    """
+
+    # Histograms buckets upper bounds in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # Metrics descriptions, for the prometheus export
+    HELP = {
+        'connect_seconds': 'Time to connect and authenticate',
+        'first_byte_seconds': 'Time from sending a command to its first data',
+        'prompt_seconds': 'Time from sending a command until it is complete',
+        'commands_total': 'Commands run',
+        'timeouts_total': 'Commands not seen complete',
+        'bytes_total': 'Bytes received',
+        'rounds_total': 'Channel reads',
+    }
+
+    def __init__(self, buckets=BUCKETS, prefix='netcontrol_ssh_', max_series=10000):
+        # public class attributs
+        self.buckets = tuple(buckets)
+        self.prefix = prefix     # metric names prefix in prometheus export
+        self.max_series = max_series
+        self.overflows = 0       # records counted under 'other'
+        # Private attributs
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, device, command) : [count per bucket, sum, count]
+        self._counters = {}    # (name, device, command) : value
+        self._series = set()   # (device, command) recorded
+
+    def _key(self, device, command):
+        """
+        Returns the (device, command) to record, ('other', 'other') for a new
+        one once max_series are recorded. Called with the lock held
+        """
+        key = (device, command)
+        if key not in self._series:
+            if len(self._series) >= self.max_series:
+                self.overflows += 1
+                key = ('other', 'other')
+            self._series.add(key)
+        return key
+
+    def observe(self, name, device, command, value):
+        """
+        Adds value to the histogram name of device and command
+        """
+        with self._lock:
+            device, command = self._key(device, command)
+            histogram = self._histograms.get((name, device, command))
+            if histogram is None:
+                histogram = self._histograms[(name, device, command)] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, device, command, value=1):
+        """
+        Adds value to the counter name of device and command
+        """
+        with self._lock:
+            key = (name,) + self._key(device, command)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record(self, device, probe, complete):
+        """
+        Records the metrics of a command (see CommandProbe) run on device,
+        complete is False if it was not seen complete
+        """
+        command = normalize_command(probe.command)
+        if complete:
+            self.observe('prompt_seconds', device, command, time.monotonic() - probe.start)
+        else:
+            self.inc('timeouts_total', device, command)
+        if probe.first_byte is not None:
+            self.observe('first_byte_seconds', device, command, probe.first_byte)
+        self.inc('commands_total', device, command)
+        self.inc('bytes_total', device, command, probe.bytes)
+        self.inc('rounds_total', device, command, probe.rounds)
+
+    def as_dict(self):
+        """
+        Returns the metrics as a dictionary name : device : command : value
+        value is a number for counters, a dictionary for histograms with keys
+        count, sum and buckets (upper bound : cumulative count)
+        """
+        result = {}
+        with self._lock:
+            for (name, device, command), value in self._counters.items():
+                result.setdefault(name, {}).setdefault(device, {})[command] = value
+            for (name, device, command), (counts, total, count) in self._histograms.items():
+                buckets = {}
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    buckets[bound] = cumulative
+                result.setdefault(name, {}).setdefault(device, {})[command] = {
+                    'count': count, 'sum': total, 'buckets': buckets}
+        return result
+
+    def prometheus(self):
+        """
+        Returns the metrics in prometheus text exposition format
+        """
+        lines = []
+        for name, devices in sorted(self.as_dict().items()):
+            metric = self.prefix + name
+            lines.append("# HELP {} {}".format(metric, self.HELP.get(name, name)))
+            lines.append("# TYPE {} {}".format(metric, 'counter' if name.endswith('_total') else 'histogram'))
+            for device, commands in sorted(devices.items()):
+                for command, value in sorted(commands.items()):
+                    labels = 'device="{}",command="{}"'.format(_label(device), _label(command))
+                    if not isinstance(value, dict):
+                        lines.append("{}{{{}}} {}".format(metric, labels, value))
+                        continue
+                    for bound, cumulative in value['buckets'].items():
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, bound, cumulative))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(metric, labels, value['count']))
+                    lines.append("{}_sum{{{}}} {}".format(metric, labels, value['sum']))
+                    lines.append("{}_count{{{}}} {}".format(metric, labels, value['count']))
+        return "".join(line+"\n" for line in lines)
+
+    def clear(self):
+        """
+        Forgets all metrics
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._series.clear()
+            self.overflows = 0
+
+
+# Process wide registry of ssh metrics
+ssh_metrics = SshMetrics()
+
+
+def normalize_command(command):
+    """
+    Returns command as a metrics key : spaces collapsed, numbers (counters,
+    addresses, ids) replaced by N and at most 80 characters, so the same
+    command polled with different arguments shares its metrics
+    ex: 'diagnose sys session filter dport 443' -> '... dport N'
+    """
+    return COMMAND_NUMBERS.sub('N', " ".join(command.split()))[:80]
+
+
+def _digest(secret):
+    """
+    Returns a digest of secret (a password) to use in keys without keeping
+    the secret itself
+    """
+    return hashlib.sha256(str(secret).encode('utf-8')).hexdigest()
+
+
+def _label(value):
+    """
+    Returns value escaped for a prometheus label
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def ssh_steps(method):
+    """
+    Decorator for driver methods written as generators yielding the calls to
+    make on their ssh attribute, as a tuple (method name, arguments...)
+    ex : yield 'shell_send', ['get system status\n']
+    The call result is sent back to the generator and the generator return
+    value is the method result. Output is read from self.ssh.output as usual.
+    An exception raised by a call is raised at the yield, so a generator can
+    catch it and still parse the output received before.
+
+    The decorated method runs immediately if self.ssh is an Ssh and returns
+    a coroutine if self.ssh is an AsyncSsh, so a driver gets both flavors
+    from the same code.
+    Generator of a decorated method is available as method.steps, used to
+    call a decorated method from another one :
+    ex : yield from self._get_nbcpu.steps(self)
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        steps = method(self, *args, **kwargs)
+        if isinstance(self.ssh, AsyncSsh):
+            return _run_steps_async(self.ssh, steps)
+        return _run_steps(self.ssh, steps)
+    wrapper.steps = method
+    return wrapper
+
+
+def _run_steps(ssh, steps):
+    """
+    Runs generator steps of an ssh_steps method with a blocking Ssh
+    """
+    result = None
+    error = None
+    try:
+        while True:
+            if error is None:
+                call = steps.send(result)
+            else:
+                call, error = steps.throw(error), None
+            try:
+                result = getattr(ssh, call[0])(*call[1:])
+            except Exception as e:
+                error = e
+    except StopIteration as stop:
+        return stop.value
+
+
+async def _run_steps_async(ssh, steps):
+    """
+    Runs generator steps of an ssh_steps method with an AsyncSsh
+    """
+    result = None
+    error = None
+    try:
+        while True:
+            if error is None:
+                call = steps.send(result)
+            else:
+                call, error = steps.throw(error), None
+            try:
+                result = await getattr(ssh, call[0])(*call[1:])
+            except Exception as e:
+                error = e
+    except StopIteration as stop:
+        return stop.value
+
+
+def debug_log(filename='debug.log', level=logging.DEBUG):
+    """
+    Writes the logs of all netcontrol modules in filename, what drivers do
+    when created with debug=True. Calling it again for the same file only
+    sets the level.
+    Without it, the library does not configure logging : its messages go
+    to the application handlers (none by default) and debug calls cost a
+    level check.
+    Returns the logging handler
+    """
+    logger = logging.getLogger('netcontrol')
+    path = os.path.abspath(filename)
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == path:
+            break
+    else:
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt='%Y%m%d:%H:%M:%S'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+
+def quiet_log():
+    """
+    Quiet mode : only errors of netcontrol modules are logged, whatever the
+    application logging level is
+    """
+    logging.getLogger('netcontrol').setLevel(logging.ERROR)
+
+
 if __name__ == '__main__':  # pragma: no cover
 
     myssh = Ssh(ip='127.0.0.1', user='paratest', password='paratest', debug=True)
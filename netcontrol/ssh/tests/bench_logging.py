@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 2026
+
+@author: cgustave
+
+Benchmark of the logging cost per command : the same shell commands are
+sent on a mocked ssh session with debug logs written to a file (like
+debug=True) and in quiet mode (see ssh.quiet_log)
+
+usage : PYTHONPATH=.:./tests python3 tests/bench_logging.py [commands]
+'''
+import logging
+import os
+import sys
+import tempfile
+import time
+from ssh import Ssh, debug_log, quiet_log
+
+
+def run(commands):
+    """
+    Returns the time in seconds spent per command
+    """
+    ssh = Ssh(ip='127.0.0.1', user='cgustave', password='')
+    ssh.mock(context='default')
+    ssh.completion = 'sentinel'
+    ssh.shell_send([])
+    start = time.perf_counter()
+    for index in range(commands):
+        ssh.shell_send(["ps -ef\n"])
+    elapsed = time.perf_counter() - start
+    ssh.close()
+    return elapsed / commands
+
+
+if __name__ == '__main__':
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as directory:
+        handler = debug_log(os.path.join(directory, 'debug.log'))
+        debug = run(commands)
+        logging.getLogger('netcontrol').removeHandler(handler)
+        handler.close()
+    quiet_log()
+    quiet = run(commands)
+    print("commands={} debug={:.1f}us quiet={:.1f}us per command, overhead removed={:.1f}us ({:.0f}%)"
+          .format(commands, debug * 1e6, quiet * 1e6, (debug - quiet) * 1e6, 100 * (debug - quiet) / debug))
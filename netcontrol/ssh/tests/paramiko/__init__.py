@@ -6,7 +6,7 @@ from paramiko.client import (
         WarningPolicy,
 )
 
-from paramiko.rsakey import RSAKey
+from paramiko.rsakey import PKey, RSAKey, Ed25519Key, ECDSAKey, HostKeys
 
 from paramiko.ssh_exception import (
         SSHException,
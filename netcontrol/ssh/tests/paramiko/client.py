@@ -7,13 +7,12 @@ Used for unittest
 #from paramiko.rsakey import RSAKey
 #import paramiko
 
-import logging as log
+import logging
+import re
+from paramiko.ssh_exception import ChannelException
+from paramiko.rsakey import HostKeys
 # create logger
-log.basicConfig(
-    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-    datefmt='%Y%m%d:%H:%M:%S',
-    filename='debug.log',
-    level='DEBUG')
+log = logging.getLogger(__name__)
 log.debug("Loading mocked lib paramiko")
 
 class SSHException(Exception):
@@ -100,11 +99,17 @@ class SSHClient():
         self.openedfiles = []
         self.exception = ""
         self.channel = Channel()
+        self.transport = None
+        self.sock = None
         self._send = ""
+        self._host_keys = HostKeys()
 
     def load_system_host_keys(self, filename=None):
         log.debug("Enter with filename=%s" % (filename))
 
+    def get_host_keys(self):
+        return self._host_keys
+
 
     def set_missing_host_key_policy(self, policy):
         log.debug("Enter with policy=%s" % (policy))
@@ -121,6 +126,15 @@ class SSHClient():
         if self.exception:
             log.debug("raise exception=%s" % (self.exception))
             raise self.exception
+        # Socket given to reach the server (ex : a jump host channel)
+        self.sock = sock
+        self.transport = Transport()
+
+    def get_transport(self):
+        """
+        Returns the transport of a connected client, None otherwise
+        """
+        return self.transport
 
     def close(self):
         """
@@ -129,6 +143,8 @@ class SSHClient():
         Need to do it also for all filehandles opened during shell_read
         """
         log.debug("Enter")
+        if self.transport:
+            self.transport.close()
 
         # Close SSHClient files
         for fh in self.openedfiles:
@@ -160,27 +176,29 @@ class SSHClient():
 
         filename = "tests/mockfiles/"+self.context+"/"+tr_command+"_stdin.txt"
         try:
-            self.stdin  = open(filename, "r", encoding="utf8")
+            stdin  = open(filename, "r", encoding="utf8")
         except Exception:
             log.warning("Could no open mockile {} using default/stdin.txt".format(filename))
-            self.stdin  = open("tests/mockfiles/default/stdin.txt", "r", encoding="utf8")
+            stdin  = open("tests/mockfiles/default/stdin.txt", "r", encoding="utf8")
 
         try:
-            self.stdout = open("tests/mockfiles/"+self.context+"/"+tr_command+"_stdout.txt", "r", encoding="utf8")
+            stdout = open("tests/mockfiles/"+self.context+"/"+tr_command+"_stdout.txt", "r", encoding="utf8")
         except Exception:
-            self.stdout = open("tests/mockfiles/default/stdout.txt","r", encoding="utf8")
+            stdout = open("tests/mockfiles/default/stdout.txt","r", encoding="utf8")
 
         try:
-            self.stderr = open("tests/mockfiles/"+self.context+"/"+tr_command+"_stderr.txt", "r", encoding="utf8")
+            stderr = open("tests/mockfiles/"+self.context+"/"+tr_command+"_stderr.txt", "r", encoding="utf8")
         except Exception:
-            self.stderr = open("tests/mockfiles/default/stderr.txt","r", encoding="utf8")
+            stderr = open("tests/mockfiles/default/stderr.txt","r", encoding="utf8")
 
         # Keep trace of all opened files
-        self.openedfiles.append(self.stdin)
-        self.openedfiles.append(self.stdout)
-        self.openedfiles.append(self.stderr)
+        self.openedfiles.append(stdin)
+        self.openedfiles.append(stdout)
+        self.openedfiles.append(stderr)
 
-        return self.stdin, self.stdout, self.stderr
+        # local variables first, exec_command may run concurrently from threads
+        self.stdin, self.stdout, self.stderr = stdin, stdout, stderr
+        return stdin, stdout, stderr
 
     def invoke_shell(self, term='', width=0, height=0, width_pixels=0,
                      height_pixels=0, environment=None):
@@ -213,6 +231,47 @@ class SSHClient():
 
 
 
+class Transport():
+
+    def __init__(self):
+        log.debug("Enter")
+        self.active = True
+        self.forwarded = []
+        # direct-tcpip destinations refused (ChannelException)
+        self.refused = []
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        log.debug("Enter with interval={}".format(interval))
+        self.keepalive = interval
+
+    def send_ignore(self, byte_count=None):
+        log.debug("Enter with byte_count={}".format(byte_count))
+        if not self.active:
+            raise SSHException("SSH session not active")
+
+    def open_channel(self, kind, dest_addr=None, src_addr=None, window_size=None,
+                     max_packet_size=None, timeout=None):
+        """
+        Returns a new channel, destinations of direct-tcpip channels are
+        recorded in self.forwarded
+        """
+        log.debug("Enter with kind={} dest_addr={} src_addr={} timeout={}".format(kind, dest_addr, src_addr, timeout))
+        if not self.active:
+            raise SSHException("SSH session not active")
+        if kind == 'direct-tcpip':
+            if dest_addr in self.refused:
+                raise ChannelException(2, "Connect failed")
+            self.forwarded.append(dest_addr)
+        return Channel()
+
+    def close(self):
+        log.debug("Enter")
+        self.active = False
+
+
 class Channel():
 
     def __init__(self):
@@ -223,6 +282,13 @@ class Channel():
         # Use to remember what was the last sent command
         self._send = 'default'
 
+        # Output not received yet, loaded from mockfile on first read after
+        # a send (like a real channel, each output is only received once)
+        self._pending = None
+
+        # Commands of the last send, with their 'sentinel' completion marker
+        self._batch = [('default', None)]
+
 
     def recv_ready(self):
         """
@@ -233,8 +299,12 @@ class Channel():
         :return:
             ``True`` if a `recv` call on this channel would immediately return
             at least one byte; ``False`` otherwise.
+
+        in mocking : True until the output of the last sent command has been
+        fully received
         """
-        return True
+        self._load()
+        return len(self._pending) > 0
 
     def recv(self, nbytes):
         """
@@ -254,9 +324,44 @@ class Channel():
         output to provide
         """
 
+        self._load()
+        content = self._pending[:nbytes]
+        self._pending = self._pending[nbytes:]
+        return content
+
+    def _load(self):
+        """
+        Loads the output of the last sent command from its mockfile if not
+        already done
+        The trailing newline is removed : like on a real device the prompt
+        is the last line received and is not followed by a newline
+        When several commands were sent at once, their outputs follow each
+        others
+        """
+        if self._pending is not None:
+            return
+        outputs = []
+        for command, sentinel in self._batch:
+            content = self._read_mockfile(command).rstrip('\r\n')
+            if len(self._batch) > 1 and not content.split('\n')[0].endswith(command):
+                # like a device, echo commands sent in a batch (mockfiles
+                # for single commands do not always have the echo)
+                content = command + '\n' + content
+            if sentinel:
+                # echo of the marker after the prompt, then the marker itself
+                content += ' echo "{0}""__" $?\n{0}__ 0'.format(sentinel)
+            outputs.append(content)
+        self._pending = "\n".join(outputs)
+        if self._batch and self._batch[-1][1]:
+            self._pending += "\n"
+
+    def _read_mockfile(self, command):
+        """
+        Returns the content of the mockfile of a command
+        """
         # some commands need to be translated so they can be used as filename
         # We replace / with - and 'space' with _ and | with -
-        tr_command = self._send.translate(str.\
+        tr_command = command.translate(str.\
             maketrans({"/": "-"," ": "_", "\\": "_", "'" : "_", "^" : "_", "|": "-","{":"-","}":"-", "$":"-", "`":"_",\
                        ":":"_", "*":"_", ";":"_", "(":"_", ")":"_", "=":"_", ",":"-", "\"":"-"}))
         log.debug("tr_command={}".format(tr_command))
@@ -275,7 +380,6 @@ class Channel():
             content = fh.read()
 
         fh.close()
-
         return content
 
     def send(self, s):
@@ -299,7 +403,17 @@ class Channel():
         \n should be removed from command sent so the filename looks ok
         """
 
-        self._send=s.strip('\n')
+        # One command per line, a command may be followed by the marker echo
+        # sent by Ssh in 'sentinel' completion mode
+        self._batch = []
+        for line in s.strip('\n').split('\n'):
+            match = re.search(r'^echo "(\w+)""__" \$\?$', line)
+            if match and self._batch:
+                self._batch[-1] = (self._batch[-1][0], match.group(1))
+            else:
+                self._batch.append((line, None))
+        self._send = self._batch[-1][0]
+        self._pending = None
 
 
     def send_ready(self):
@@ -321,6 +435,7 @@ class Channel():
 
         if context:
             self.context = context
+            self._pending = None
 
     def close(self):
         """
@@ -1,24 +1,81 @@
-import logging as log
+import logging
 import sys
+from paramiko.ssh_exception import SSHException
 
 
-log.basicConfig(
-    format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-    datefmt='%Y%m%d:%H:%M:%S',
-    filename='ssh.log',
-    level='DEBUG')
+log = logging.getLogger(__name__)
 
 
-class RSAKey(object):
+class PKey(object):
+    """
+    Base class for mocked private keys
+    A mock key file is a text file, it is a key of the class having its
+    marker in the file
+    """
+    marker = None
+
+    def __init__(self, msg=None, data=None, filename=None, password=None, key=None, file_obj=None,):
+        self.filename = filename
+
+    @classmethod
+    def from_private_key_file(cls, filename, password=None):
+        log.debug("Enter with filename=%s class=%s" % (filename, cls.__name__))
+        with open(filename) as keyfile:
+            content = keyfile.read()
+        if cls.marker not in content:
+            raise SSHException("not a valid {} private key file".format(cls.marker))
+        return cls(filename=filename, password=password)
+
+
+class RSAKey(PKey):
     """
     Representation of an RSA key which can be used to sign and verify SSH2
     data.
     """
+    marker = 'RSA'
 
-    def __init__(self, msg=None, data=None, filename=None, password=None, key=None, file_obj=None,):
-        pass
 
+class Ed25519Key(PKey):
+    """
+    Representation of an Ed25519 key
+    """
+    marker = 'ED25519'
+
+
+class ECDSAKey(PKey):
+    """
+    Representation of an ECDSA key
+    """
+    marker = 'ECDSA'
+
+
+class HostKeys(object):
+    """
+    Representation of a known_hosts file, lines are kept as is
+    """
+
+    def __init__(self, filename=None):
+        self.lines = []
+        if filename is not None:
+            self.load(filename)
+
+    def load(self, filename):
+        log.debug("Enter with filename=%s" % (filename))
+        with open(filename) as hostfile:
+            self.lines.extend(line for line in hostfile if line.strip())
 
-    def from_private_key_file(self, filename="toto"):
-        pass
+    def add(self, hostname, keytype, key):
+        log.debug("Enter with hostname=%s keytype=%s" % (hostname, keytype))
+        self.lines.append("%s %s %s\n" % (hostname, keytype, key))
 
+    def lookup(self, hostname):
+        """
+        Returns the keys of hostname as a dictionary keytype : key, None if
+        hostname is unknown
+        """
+        keys = {}
+        for line in self.lines:
+            fields = line.split()
+            if hostname in fields[0].split(','):
+                keys[fields[1]] = fields[2]
+        return keys or None
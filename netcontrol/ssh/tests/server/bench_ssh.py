@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 2026
+
+@author: cgustave
+
+Benchmark of the Ssh read/write path (commands, shell_send, shell_read,
+channel_read) against the local ssh server stand-in (see sshserver) with
+the real paramiko : commands per second and latency percentiles for
+outputs from 100 bytes to 50MB, chunked delivery and the prompt styles of
+FortiGate, VyOS and ESXi.
+
+Results can be saved as a baseline (json), later runs fail (exit status 1)
+when the throughput of a case is lower than its baseline by more than
+threshold (0.2 : 20%). Baselines depend on the machine : save them where
+the benchmark is run.
+
+usage : PYTHONPATH=.:./tests/server python3 tests/server/bench_ssh.py [options]
+  --sizes 100,10000     output sizes in bytes (default 100 to 50MB)
+  --time 1              seconds spent per case (at least 3 rounds)
+  --save                saves the results as the baseline
+  --baseline file       baseline file (default tests/server/bench_baseline.json)
+  --threshold 0.2       allowed throughput regression
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from ssh import Ssh
+from sshserver import SshServer
+
+# Prompts of the benchmarked devices
+PROMPTS = {
+    'fortigate': 'FGT-B1-1 # ',
+    'vyos': 'vyos@vyos:~$ ',
+    'esxi': '[root@neutron:~] ',
+}
+
+SIZES = (100, 10000, 1000000, 50000000)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def output(size, prompt):
+    """
+    Returns a command output of size bytes, lines of 80 characters, followed
+    by the prompt
+    """
+    line = 'x' * 79 + '\n'
+    text = line * (size // len(line)) + 'x' * (size % len(line))
+    return text + '\n' + prompt
+
+
+def cases(sizes):
+    """
+    Returns the benchmark cases as a list of (method, size, prompt style,
+    chunk size)
+    """
+    result = []
+    for size in sizes:
+        result.append(('commands', size, 'fortigate', 0))
+        result.append(('shell_send', size, 'fortigate', 0))
+        result.append(('shell_read', size, 'fortigate', 0))
+    for prompt in ('vyos', 'esxi'):
+        result.append(('shell_send', 10000, prompt, 0))
+    for chunk in (1024, 16384):
+        result.append(('shell_send', 1000000, 'fortigate', chunk))
+        result.append(('shell_read', 1000000, 'fortigate', chunk))
+    for size in (100, 10000):
+        result.append(('channel_read', size, 'fortigate', 0))
+    return [case for case in result if case[1] <= max(sizes)]
+
+
+def run_once(ssh, method):
+    """
+    Runs the benchmarked method once
+    Returns True if the output was received up to the prompt
+    """
+    if method == 'commands':
+        return ssh.commands(['show'])
+    if method == 'shell_send':
+        return ssh.shell_send(['show\n'])
+    if method == 'shell_read':
+        ssh.channel_send('show\n')
+        return ssh.shell_read()
+    ssh.channel_send('show\n')
+    received = ''
+    while not received.endswith(ssh._prompt):
+        data = ssh.channel_read()
+        if not data:
+            return False
+        received += data
+    return True
+
+
+def run_case(server, case, duration):
+    """
+    Runs a case for duration seconds (at least 3 rounds)
+    Returns the result dictionary : rounds, cps (commands per second), p50,
+    p90 and p99 latencies in milliseconds
+    """
+    method, size, prompt, chunk = case
+    server.responses = {'default': PROMPTS[prompt].rstrip(), 'show': output(size, PROMPTS[prompt].rstrip())}
+    server.chunk_size = chunk
+    ssh = Ssh(ip='127.0.0.1', port=server.port, user='bench', password='')
+    ssh.read_timeout = 60
+    ssh.prompt_timeout = 60
+    ssh.channel_timeout = 5
+    ssh.metrics = None
+    # warm up : connection, shell and prompt discovery
+    ssh.shell_send([])
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < 3 or (time.perf_counter() - start < duration and len(latencies) < 10000):
+        begin = time.perf_counter()
+        if not run_once(ssh, method):
+            raise RuntimeError("{} did not complete".format(name(case)))
+        latencies.append(time.perf_counter() - begin)
+    ssh.close()
+    latencies.sort()
+    return {'rounds': len(latencies), 'cps': len(latencies) / sum(latencies),
+            'p50': percentile(latencies, 50) * 1000, 'p90': percentile(latencies, 90) * 1000,
+            'p99': percentile(latencies, 99) * 1000}
+
+
+def percentile(values, percent):
+    """
+    Returns the percentile of sorted values
+    """
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def name(case):
+    """
+    Returns the name of a case in results and baselines
+    """
+    return "{} size={} prompt={} chunk={}".format(*case)
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the list of regression messages of results against baseline
+    """
+    regressions = []
+    for case, result in results.items():
+        if case in baseline and result['cps'] < baseline[case]['cps'] * (1 - threshold):
+            regressions.append("{} : {:.1f} cps, baseline {:.1f} cps".format(case, result['cps'], baseline[case]['cps']))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Ssh read/write path benchmark")
+    parser.add_argument('--sizes', default=",".join(str(size) for size in SIZES))
+    parser.add_argument('--time', type=float, default=1)
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {}
+    with SshServer() as server:
+        for case in cases(sizes):
+            result = results[name(case)] = run_case(server, case, args.time)
+            print("{:55} {:10.1f} cps  p50={:9.2f}ms p90={:9.2f}ms p99={:9.2f}ms ({} rounds)"
+                  .format(name(case), result['cps'], result['p50'], result['p90'], result['p99'], result['rounds']))
+    if args.save:
+        with open(args.baseline, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print("baseline saved in {}".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline {}, use --save".format(args.baseline))
+        return 0
+    with open(args.baseline) as fh:
+        regressions = compare(results, json.load(fh), args.threshold)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
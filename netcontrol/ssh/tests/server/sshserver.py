@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 2026
+
+@author: cgustave
+
+Local ssh server stand-in for end to end tests, built on the real paramiko
+(not the mocked one of tests/paramiko) : an in-process paramiko
+ServerInterface on localhost replaying the tests/mockfiles/<context>
+outputs, so the real channel read path of Ssh (selectors, chunks, prompt
+timing) is exercised without lab devices.
+
+Like the mocked paramiko :
+  - exec channels (Ssh.commands) get <command>_stdout.txt and
+    <command>_stderr.txt, default/stdout.txt and default/stderr.txt if
+    missing
+  - shell channels get default_stdin.txt when opened, then
+    <command>_stdin.txt for each command line received (default/stdin.txt
+    if missing), without its trailing newline so the prompt ends the output
+  - 'sentinel' completion marker echoes are answered with the marker and a
+    0 exit status
+
+Delivery is configurable : delay before each command output (per command
+with delays), chunk size and bandwidth in bytes per second.
+responses gives outputs of commands without mockfiles ('default' is the
+shell banner), ex: large outputs or other prompt styles for benchmarks.
+
+The mocked paramiko package is found first from the tests directory : run
+from the ssh directory without it on the path
+usage : PYTHONPATH=.:./tests/server python3 tests/server/test_sshserver.py
+
+ex:
+    with SshServer(context='sentinel', chunk_size=512, bandwidth=1e6) as server:
+        myssh = Ssh(ip='127.0.0.1', port=server.port, user='cgustave', password='')
+        myssh.shell_send(['uname -a\n'])
+'''
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import paramiko
+
+log = logging.getLogger('netcontrol.sshserver')
+
+# Mockfiles directory (tests/mockfiles)
+MOCKFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mockfiles')
+
+# Command characters replaced in mockfile names, like the mocked paramiko
+EXEC_FILENAME = str.maketrans({"/": "-", "\\": "_", "'": "_", "^": "_", " ": "_", "|": "-", "<": "_", ">": "_"})
+SHELL_FILENAME = str.maketrans({"/": "-", " ": "_", "\\": "_", "'": "_", "^": "_", "|": "-", "{": "-", "}": "-",
+                                "$": "-", "`": "_", ":": "_", "*": "_", ";": "_", "(": "_", ")": "_", "=": "_",
+                                ",": "-", "\"": "-"})
+
+# Marker echo of Ssh 'sentinel' completion
+SENTINEL_ECHO = re.compile(r'^echo "(\w+)""__" \$\?$')
+
+# Host key, generated once per process (see host_key)
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def host_key():
+    """
+    Returns the server host key, generated on first call
+    """
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+class SshServer(object):
+    """
+    In-process ssh server on localhost replaying mockfiles, see module
+    """
+
+    def __init__(self, context='default', delay=0, delays=None, chunk_size=0, bandwidth=0,
+                 responses=None, password=None, mockfiles=MOCKFILES):
+        """
+        context : mockfiles directory of the outputs
+        delay : seconds before each command output, delays : per command
+        delays ({command: seconds}) overriding it
+        chunk_size : bytes sent at a time (0 : whole output at once)
+        bandwidth : bytes per second (0 : unlimited)
+        responses : outputs of commands ({command: text}) used before the
+        mockfiles
+        password : password accepted (None : any), keys are always accepted
+        """
+        # public class attributs
+        self.context = context
+        self.delay = delay
+        self.delays = delays or {}
+        self.chunk_size = chunk_size
+        self.bandwidth = bandwidth
+        self.responses = responses or {}
+        self.password = password
+        self.mockfiles = mockfiles
+        self.port = None
+        self.connections = 0  # ssh connections accepted
+        self.commands = []    # commands received, in order
+        # Private attributs
+        self._socket = None
+        self._thread = None
+        self._transports = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """
+        Listens on a free localhost port (self.port)
+        Returns the server
+        """
+        host_key()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(128)
+        # accept wakes up to see the server stopped
+        self._socket.settimeout(0.2)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept, name='sshserver', daemon=True)
+        self._thread.start()
+        log.debug("listening on port={}".format(self.port))
+        return self
+
+    def stop(self):
+        """
+        Closes the listening socket and all connections
+        """
+        listener, self._socket = self._socket, None
+        if listener:
+            listener.close()
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def response(self, command, suffix):
+        """
+        Returns the output of command, suffix is _stdin (shell), _stdout or
+        _stderr (exec)
+        """
+        if suffix != '_stderr' and command in self.responses:
+            return self.responses[command]
+        table = SHELL_FILENAME if suffix == '_stdin' else EXEC_FILENAME
+        filename = os.path.join(self.mockfiles, self.context, command.translate(table) + suffix + '.txt')
+        if not os.path.exists(filename):
+            filename = os.path.join(self.mockfiles, 'default', suffix.lstrip('_') + '.txt')
+        with open(filename, 'r', encoding='utf8') as fh:
+            return fh.read()
+
+    def _accept(self):
+        """
+        Accepts connections, each one served by its own thread
+        """
+        listener = self._socket
+        while self._socket is listener:
+            try:
+                client, address = listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            client.settimeout(None)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        """
+        Runs the ssh transport of a connection and serves its channels
+        """
+        transport = paramiko.Transport(client)
+        # client disconnections are not errors here
+        transport.set_log_channel('netcontrol.sshserver.transport')
+        transport.add_server_key(host_key())
+        interface = SshServerInterface(self)
+        with self._lock:
+            self._transports.append(transport)
+            self.connections += 1
+        try:
+            transport.start_server(server=interface)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            log.debug("negotiation failed : {}".format(e))
+            return
+        while transport.is_active():
+            channel = transport.accept(0.5)
+            if channel is not None:
+                threading.Thread(target=self._channel, args=(channel, interface), daemon=True).start()
+
+    def _channel(self, channel, interface):
+        """
+        Serves a session channel once its exec or shell request is received
+        """
+        request = interface.wait_request(channel)
+        try:
+            if request is None:
+                return
+            if request[0] == 'exec':
+                self._exec(channel, request[1])
+            else:
+                self._shell(channel)
+        except (EOFError, OSError) as e:
+            log.debug("channel closed : {}".format(e))
+        finally:
+            channel.close()
+
+    def _exec(self, channel, command):
+        """
+        Sends the stdout and stderr of an exec command, then its exit status
+        """
+        self._record(command)
+        self._send(channel, self.response(command, '_stdout'), command)
+        stderr = self.response(command, '_stderr')
+        if stderr:
+            channel.sendall_stderr(stderr.encode('utf-8'))
+        channel.send_exit_status(0)
+
+    def _shell(self, channel):
+        """
+        Sends the banner, then the output of each command line received
+        """
+        banner = self.response('default', '_stdin').rstrip('\r\n')
+        prompt = banner.split('\n')[-1]
+        self._send(channel, banner, None)
+        pending = b''
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                return
+            pending += data
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                line = line.decode('utf-8').rstrip('\r')
+                match = SENTINEL_ECHO.search(line)
+                if match:
+                    # real shells print the marker, then the prompt
+                    channel.sendall(' {}\n{}__ 0\n{}'.format(line, match.group(1), prompt).encode('utf-8'))
+                    continue
+                self._record(line)
+                self._send(channel, self.response(line, '_stdin').rstrip('\r\n'), line)
+
+    def _send(self, channel, text, command):
+        """
+        Sends text after the delay of command, in chunks at the bandwidth
+        """
+        delay = self.delays.get(command, self.delay)
+        if delay:
+            time.sleep(delay)
+        data = text.encode('utf-8')
+        size = self.chunk_size or len(data) or 1
+        for start in range(0, len(data), size):
+            chunk = data[start:start+size]
+            channel.sendall(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+
+    def _record(self, command):
+        """
+        Records a command received
+        """
+        with self._lock:
+            self.commands.append(command)
+
+
+class SshServerInterface(paramiko.ServerInterface):
+    """
+    Authentication and channel requests of SshServer
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self._requests = {}  # channel id : ('exec', command) or ('shell', None)
+        self._condition = threading.Condition()
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if self.server.password is None or password == self.server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self._request(channel, ('shell', None))
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._request(channel, ('exec', command.decode('utf-8')))
+        return True
+
+    def wait_request(self, channel, timeout=10):
+        """
+        Returns the exec or shell request of channel, None if not received
+        within timeout seconds
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: channel.get_id() in self._requests, timeout)
+            return self._requests.get(channel.get_id())
+
+    def _request(self, channel, request):
+        with self._condition:
+            self._requests[channel.get_id()] = request
+            self._condition.notify_all()
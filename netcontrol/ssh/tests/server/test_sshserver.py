@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Created on Oct 2026
+
+@author: cgustave
+
+End to end tests of Ssh with the real paramiko, against the local ssh
+server stand-in (see sshserver)
+usage : PYTHONPATH=.:./tests/server python3 tests/server/test_sshserver.py
+'''
+import asyncio
+import unittest
+import time
+from ssh import Ssh, AsyncSsh
+from sshserver import SshServer
+
+
+class SshServerTestCase(unittest.TestCase):
+
+    # Always run before any test
+    def setUp(self):
+        self.server = SshServer().start()
+        self.ssh = Ssh(ip='127.0.0.1', port=self.server.port, user='cgustave', password='')
+
+    # Always run after any test
+    def tearDown(self):
+        self.ssh.close()
+        self.server.stop()
+
+    def test_commands(self):
+        self.assertTrue(self.ssh.commands(["uptime"]))
+        self.assertEqual(self.ssh.output, " 12:09:34 up  2:49,  1 user,  load average: 0.01, 0.05, 0.08\n")
+        self.assertEqual(self.ssh.results[0]['exit_status'], 0)
+        self.assertEqual(self.server.commands, ["uptime"])
+
+    def test_shell_send_prompt(self):
+        self.server.context = 'sentinel'
+        self.assertTrue(self.ssh.shell_send(["hostname\n"]))
+        self.assertEqual(self.ssh._prompt, '~$')
+        self.assertEqual(self.ssh.output, "~$ hostname\nchameleon\n~$\n")
+
+    def test_shell_send_sentinel(self):
+        self.server.context = 'sentinel'
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send(["uname -a\n", "hostname\n"]))
+        self.assertEqual(self.ssh.output, "Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n"
+                                          "chameleon\n")
+        self.assertEqual(self.ssh.exit_status, 0)
+
+    def test_chunks_and_bandwidth(self):
+        self.server.context = 'sentinel'
+        self.server.chunk_size = 8
+        self.server.bandwidth = 1000
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send([]))
+        start = time.monotonic()
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        # about 90 bytes at 1000 bytes/s
+        self.assertGreater(time.monotonic() - start, 0.08)
+        self.assertEqual(self.ssh.output, "Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n")
+
+    def test_command_delay(self):
+        self.server.context = 'sentinel'
+        self.server.delays = {'hostname': 0.3}
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send([]))
+        start = time.monotonic()
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.assertLess(time.monotonic() - start, 0.3)
+        start = time.monotonic()
+        self.assertTrue(self.ssh.shell_send(["hostname\n"]))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(self.ssh.output, "chameleon\n")
+
+    def test_responses(self):
+        self.server.responses = {'default': '[root@neutron:~]', 'get': 'x' * 100000 + '\n[root@neutron:~]'}
+        self.assertTrue(self.ssh.shell_send(["get\n"]))
+        self.assertEqual(self.ssh._prompt, '[root@neutron:~]')
+        self.ssh.channel_send("get\n")
+        self.assertTrue(self.ssh.shell_read())
+        self.assertNotEqual(self.ssh.output.find('x' * 100000), -1)
+
+    def test_password(self):
+        self.server.password = 'secret'
+        self.assertFalse(self.ssh.connect())
+        ssh = Ssh(ip='127.0.0.1', port=self.server.port, user='cgustave', password='secret')
+        self.assertTrue(ssh.connect())
+        ssh.close()
+
+    def test_async(self):
+        self.server.context = 'sentinel'
+
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', port=self.server.port, user='cgustave', password='')
+            ssh.completion = 'sentinel'
+            try:
+                self.assertTrue(await ssh.commands(["uptime", "uptime"], concurrent=True))
+                self.assertEqual([result['exit_status'] for result in ssh.results], [0, 0])
+                self.assertTrue(await ssh.shell_send(["hostname\n"]))
+                self.assertEqual(ssh.output, "chameleon\n")
+            finally:
+                await ssh.close()
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,11 +5,20 @@ Created on Sep 25, 2019
 @author: cgustave
 '''
 import unittest
-from ssh import Ssh
+import unittest.mock
+import asyncio
+from ssh import Ssh, AsyncSsh, SshPool, StreamDecoder, ReadBuffer, KeyCache, SshMetrics, JumpHost, SshMux, normalize_command, debug_log, quiet_log, ssh_steps
+import shutil
+import re
+import os
+import gzip
+import tempfile
 
 # Import our mockd paramiko
 import paramiko 
 import socket
+import time
+import threading
 import logging as log
 
 # create logger
@@ -84,6 +93,67 @@ class SshTestCase(unittest.TestCase):
         self.ssh.close()
         self.assertNotEqual(self.ssh.output.find("load average"),-1)
 
+    def test_sshcmd_concurrent_commands(self):
+        self.ssh.mock(context='default')
+        self.ssh.commands(["uptime","ps -ef"])
+        expected = self.ssh.output
+        self.assertTrue(self.ssh.commands(["uptime","ps -ef"], concurrent=True))
+        self.ssh.close()
+        self.assertEqual(self.ssh.output, expected)
+        self.assertEqual([r['command'] for r in self.ssh.results], ["uptime","ps -ef"])
+        self.assertNotEqual(self.ssh.results[0]['stdout'].find("load average"),-1)
+        self.assertEqual(self.ssh.results[0]['stderr'], '')
+        self.assertIsNone(self.ssh.results[0]['exit_status'])
+
+    def test_commands_concurrent_deadline(self):
+        self.ssh.mock(context='default')
+        self.ssh.connect()
+        # deadline reached before the commands start : not run, the session
+        # is kept
+        self.assertFalse(self.ssh.commands(["uptime","ps -ef"], concurrent=True, deadline=0))
+        self.assertTrue(self.ssh.timed_out)
+        self.assertEqual([r['timed_out'] for r in self.ssh.results], [True, True])
+        self.assertTrue(self.ssh.connected)
+        self.assertTrue(self.ssh.commands(["uptime"]))
+        self.assertFalse(self.ssh.results[0]['timed_out'])
+        self.ssh.close()
+
+    def test_commands_concurrent_failure(self):
+        self.ssh.mock(context='default')
+        self.ssh.connect()
+        exec_command = self.ssh._client.exec_command
+
+        def refused(command, **kwargs):
+            if command == "ps -ef":
+                raise paramiko.SSHException("channel open refused")
+            return exec_command(command, **kwargs)
+        self.ssh._client.exec_command = refused
+        # results of the other commands are kept
+        self.assertFalse(self.ssh.commands(["uptime","ps -ef"], concurrent=True))
+        self.assertNotEqual(self.ssh.results[0]['stdout'].find("load average"),-1)
+        self.assertEqual(self.ssh.results[1]['stdout'], '')
+        self.assertEqual(self.ssh.output, self.ssh.results[0]['stdout'])
+        self.ssh.close()
+
+    def test_ssh_steps_exception(self):
+        class Driver(object):
+            def __init__(self, ssh):
+                self.ssh = ssh
+
+            @ssh_steps
+            def collect(self):
+                yield 'shell_send', ["ps -ef\n"]
+                output = self.ssh.output
+                try:
+                    yield 'missing_method'
+                except AttributeError:
+                    return "partial:" + output
+        self.ssh.mock(context='default')
+        result = Driver(self.ssh).collect()
+        self.assertTrue(result.startswith("partial:"))
+        self.assertNotEqual(result.find("UID"),-1)
+        self.ssh.close()
+
     def test_sshcmd_commands_timeout(self):
         self.ssh.mock(exception=socket.timeout)
         self.ssh.connect()
@@ -112,6 +182,162 @@ class SshTestCase(unittest.TestCase):
         self.ssh.close()
         self.assertNotEqual(self.ssh.output.find("load average"),-1)
 
+    def test_shell_send_prompt_discovery(self):
+        self.ssh.mock(context='default')
+        self.ssh.shell_send([])
+        self.ssh.close()
+        self.assertEqual(self.ssh._prompt, '~$')
+
+    def test_shell_send_sentinel(self):
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.ssh.close()
+        self.assertEqual(self.ssh.output, "Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n")
+        self.assertEqual(self.ssh.exit_status, 0)
+
+    def test_shell_send_pipeline(self):
+        self.ssh.mock(context='sentinel')
+        start = time.monotonic()
+        self.assertTrue(self.ssh.shell_send(["uname -a\n", "hostname\n"], pipeline=True))
+        self.assertLess(time.monotonic() - start, 1)
+        self.ssh.close()
+        self.assertEqual(self.ssh.outputs, ["Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n",
+                                            "chameleon\n"])
+        self.assertNotEqual(self.ssh.output.find("~$ hostname"), -1)
+
+    def test_shell_send_pipeline_sentinel(self):
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send(["uname -a\n", "hostname\n"], pipeline=True))
+        self.ssh.close()
+        self.assertEqual(self.ssh.outputs, ["Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n",
+                                            "chameleon\n"])
+        self.assertEqual(self.ssh.output, "".join(self.ssh.outputs))
+        self.assertEqual(self.ssh.exit_status, 0)
+
+    def test_stream(self):
+        self.ssh.mock(context='sentinel')
+        lines = list(self.ssh.stream("uname -a\n"))
+        self.assertTrue(self.ssh._stream_done)
+        self.assertEqual(lines, ["Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux"])
+        self.ssh.completion = 'sentinel'
+        lines = []
+        self.assertTrue(self.ssh.shell_stream("hostname\n", lines.append))
+        self.ssh.close()
+        self.assertEqual(lines, ["chameleon"])
+        self.assertEqual(self.ssh.exit_status, 0)
+
+    def test_stream_decoder(self):
+        data = "café \x1b[1;31mred\x1b[0m \x1b]0;title\x07ok\n".encode('utf-8')
+        # any cut, even inside a character or an escape sequence
+        for cut in range(len(data)):
+            decoder = StreamDecoder()
+            text = decoder.decode(data[:cut]) + decoder.decode(data[cut:])
+            self.assertEqual(text, "café red ok\n")
+        self.assertEqual(decoder.decode(b'\xc3', final=True), "�")
+
+    def test_shell_read_prompt_cut(self):
+        self.ssh._prompt = 'FGT-B1-1 #'
+        buffer = ReadBuffer()
+        self.assertFalse(self.ssh._shell_chunk(buffer, "line 1\n" * 1000))
+        self.assertFalse(self.ssh._shell_chunk(buffer, "line 2\nFGT-B"))
+        self.assertTrue(self.ssh._shell_chunk(buffer, "1-1 # "))
+        self.assertEqual(buffer.getvalue(), "line 1\n" * 1000 + "line 2\nFGT-B1-1 # ")
+
+    def test_stream_prompt_cut(self):
+        self.assertFalse(self.ssh._is_prompt("statistic(bytes/pac"))
+        self.assertTrue(self.ssh._is_prompt("FGT-B1-1 # "))
+        self.ssh._prompt = 'FGT-B1-1 #'
+        self.assertFalse(self.ssh._is_prompt("FGT-B"))
+        self.assertFalse(self.ssh._is_prompt("statistic(bytes/pac"))
+        self.assertTrue(self.ssh._is_prompt("FGT-B1-1 # "))
+        self.ssh._prompt = 'FGT-B1-1 ('
+        self.assertFalse(self.ssh._is_prompt("FGT-B1-1 (vd"))
+        self.assertTrue(self.ssh._is_prompt("FGT-B1-1 (root) # "))
+
+    def test_shell_read_deadline(self):
+        self.ssh.mock(context='ps')
+        self.ssh.read_timeout = 0.3
+        start = time.monotonic()
+        found = self.ssh.shell_read()
+        elapsed = time.monotonic() - start
+        self.ssh.close()
+        self.assertFalse(found)
+        self.assertLess(elapsed, 1)
+        self.assertNotEqual(self.ssh.output.find("release"),-1)
+
+    def test_shell_send_call_deadline(self):
+        self.ssh.mock(context='ps')
+        self.ssh.prompt_timeout = 5
+        start = time.monotonic()
+        result = self.ssh.shell_send(["ps -ef\n", "uptime\n"], deadline=0.5)
+        elapsed = time.monotonic() - start
+        self.ssh.close()
+        self.assertFalse(result)
+        self.assertTrue(self.ssh.timed_out)
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(self.ssh.failures, 1)
+
+    def test_shell_send_deadline_early_return(self):
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.ssh.deadline = 5
+        start = time.monotonic()
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(self.ssh.timed_out)
+        self.assertTrue(self.ssh.commands(["uptime"], deadline=5))
+        self.assertFalse(self.ssh.timed_out)
+        self.assertEqual(self.ssh.failures, 0)
+        self.ssh.close()
+
+    def test_shell_read_call_deadline(self):
+        self.ssh.mock(context='ps')
+        self.ssh.read_timeout = 5
+        start = time.monotonic()
+        self.assertFalse(self.ssh.shell_read(deadline=0.3))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(self.ssh.timed_out)
+        self.ssh.close()
+
+    def test_shell_read_output_limit(self):
+        self.ssh.mock(context='ps')
+        self.ssh.read_timeout = 0.3
+        self.ssh.shell_read()
+        expected = self.ssh.output
+        self.ssh.close()
+        ssh = Ssh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+        ssh.mock(context='ps')
+        ssh.read_timeout = 0.3
+        ssh.output_limit = 1000
+        ssh.shell_read()
+        ssh.close()
+        self.assertTrue(ssh.capture.spilled)
+        self.assertEqual(ssh.output, expected[:1000])
+        self.assertEqual("".join(ssh.capture.lines()), expected)
+        self.assertEqual(ssh.capture.getvalue(), expected)
+        self.assertIsNotNone(re.search(rb'release', ssh.capture.view()))
+        ssh.capture.close()
+
+    def test_shell_send_output_limit(self):
+        self.ssh.mock(context='default')
+        self.ssh.prompt_timeout = 0.3
+        self.ssh.shell_send(["ps -ef\n"])
+        expected = self.ssh.output
+        self.ssh.close()
+        ssh = Ssh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+        ssh.mock(context='default')
+        ssh.prompt_timeout = 0.3
+        ssh.output_limit = 1000
+        ssh.shell_send(["ps -ef\n"])
+        ssh.close()
+        self.assertGreater(len(expected), 1000)
+        self.assertTrue(ssh.capture.spilled)
+        self.assertEqual(ssh.output, expected[:1000])
+        self.assertEqual(ssh.capture.getvalue(), expected)
+        ssh.capture.close()
+
     def test_ssh_ouputfile(self):
         self.ssh.trace_open(filename="myTraceFile.log")
         self.ssh.trace_write("\n*** This is test mark line 1 ***\n") 
@@ -128,6 +354,455 @@ class SshTestCase(unittest.TestCase):
         self.ssh.shell_read()
         self.ssh.close()
 
+    def test_trace_flush_and_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "trace.log")
+            self.ssh.trace_open(filename=filename, flush_interval=60, max_size=100, backups=2, compress=True)
+            self.ssh.trace_write("line 1\n")
+            self.ssh.trace_flush()
+            with open(filename) as tracefile:
+                self.assertEqual(tracefile.read(), "line 1\n")
+            for index in range(30):
+                self.ssh.trace_write("line {}\n".format(index))
+            self.ssh.close()
+            self.assertFalse(os.path.exists(filename+".3.gz"))
+            with gzip.open(filename+".2.gz", 'rt') as older, gzip.open(filename+".1.gz", 'rt') as old, open(filename) as current:
+                trace = older.read() + old.read() + current.read()
+            self.assertTrue(trace.endswith("line 28\nline 29\n"))
+
+    def test_trace_bytes_and_threads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "trace.log")
+            # max_size counts bytes : 3 lines of 40 bytes (20 characters)
+            self.ssh.trace_open(filename=filename, max_size=100, backups=1)
+            for index in range(3):
+                self.ssh.trace_write("\u00e9" * 19 + "\n")
+            self.assertTrue(self.ssh.trace_flush())
+            self.assertEqual(os.path.getsize(filename+".1"), 117)
+            # concurrent first writes start one writer
+            self.ssh.trace_open(filename=filename)
+            threads = [threading.Thread(target=self.ssh.trace_write, args=("line\n",)) for index in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            tracer = self.ssh._tracer
+            self.ssh.close()
+            with open(filename) as tracefile:
+                self.assertEqual(tracefile.read(), "line\n" * 10)
+            self.assertEqual(len([thread for thread in threading.enumerate() if thread.name == "trace-"+filename]), 0)
+            # writer thread gone : flush does not wait forever
+            self.assertFalse(tracer._thread.is_alive())
+            tracer._closed = False
+            self.assertFalse(tracer.flush())
+
+    def test_debug_log(self):
+        logger = log.getLogger('netcontrol')
+        handler = debug_log('netcontrol_debug.log')
+        self.assertIs(debug_log('netcontrol_debug.log'), handler)
+        self.assertNotIn(handler, log.getLogger().handlers)
+        quiet_log()
+        self.assertFalse(log.getLogger('netcontrol.ssh').isEnabledFor(log.DEBUG))
+        logger.removeHandler(handler)
+        handler.close()
+        logger.setLevel(log.DEBUG)
+
+    def test_key_cache(self):
+        cache = KeyCache()
+        self.ssh.key_cache = cache
+        self.ssh.ip = '10.5.0.31'
+        self.ssh.private_key_file = "tests/mockfiles/keys/id_ed25519"
+        known_hosts = unittest.mock.patch('os.path.expanduser', return_value="tests/mockfiles/keys/known_hosts")
+        with known_hosts:
+            self.assertTrue(self.ssh.connect())
+        self.assertEqual(self.ssh._client.get_host_keys().lookup('10.5.0.31'), {'ssh-ed25519': 'AAAAC3NzaC1lZDI1NTE5AAAAImock'})
+        self.ssh.close()
+        ssh2 = Ssh(ip='127.0.0.2', user='cgustave', private_key_file="tests/mockfiles/keys/id_ed25519")
+        ssh2.key_cache = cache
+        with known_hosts:
+            self.assertTrue(ssh2.connect())
+        self.assertIsNone(ssh2._client.get_host_keys().lookup('127.0.0.2'))
+        ssh2.close()
+        self.assertEqual(cache.misses, 2)  # known_hosts and key
+        self.assertEqual(cache.hits, 2)
+        key = cache.private_key("tests/mockfiles/keys/id_ed25519")
+        self.assertIsInstance(key, paramiko.Ed25519Key)
+        self.assertIsInstance(cache.private_key("tests/mockfiles/keys/id_rsa"), paramiko.RSAKey)
+        self.assertEqual(cache.host_keys("tests/mockfiles/keys/known_hosts").lines[0].split()[0], "10.5.0.31")
+        self.assertEqual(cache.host_keys("tests/mockfiles/keys/no_such_file").lines, [])
+
+    def test_key_cache_file_change(self):
+        cache = KeyCache()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "id")
+            shutil.copy("tests/mockfiles/keys/id_rsa", filename)
+            key = cache.private_key(filename)
+            self.assertIs(cache.private_key(filename), key)
+            shutil.copy("tests/mockfiles/keys/id_ed25519", filename)
+            os.utime(filename, ns=(0, 0))
+            self.assertIsInstance(cache.private_key(filename), paramiko.Ed25519Key)
+        with self.assertRaises(paramiko.SSHException):
+            cache.private_key("tests/mockfiles/keys/known_hosts")
+
+    def test_reconnect_dead_session(self):
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.ssh.keepalive = 30
+        self.ssh.reconnect = 1
+        self.ssh.replay = ["hostname\n"]
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.assertTrue(self.ssh.alive())
+        self.assertEqual(self.ssh._client.get_transport().keepalive, 30)
+        # session silently dies
+        self.ssh._client.get_transport().close()
+        self.assertFalse(self.ssh.alive())
+        sent = []
+        channel = self.ssh._client.channel
+        send = channel.send
+        channel.send = lambda data: sent.append(data) or send(data)
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.ssh.close()
+        self.assertEqual(self.ssh.output, "Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n")
+        self.assertEqual(self.ssh.reconnects, 1)
+        self.assertGreaterEqual(self.ssh.downtime, 0)
+        # shell state restored before the command
+        self.assertEqual(sent[0], "hostname\n")
+        self.assertTrue(sent[1].startswith("uname -a\n"))
+
+    def test_reconnect_failing_session(self):
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send([]))
+        channel = self.ssh._channel
+        send = channel.send
+
+        def fail_once(data):
+            channel.send = send
+            raise paramiko.SSHException("connection reset")
+        channel.send = fail_once
+        self.assertFalse(self.ssh.shell_send(["uname -a\n"]))
+        self.assertFalse(self.ssh.connected)
+        self.assertIsNone(self.ssh._channel)
+        channel.send = fail_once
+        self.ssh.reconnect = 1
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.ssh.close()
+        self.assertEqual(self.ssh.exit_status, 0)
+        self.assertEqual(self.ssh.reconnects, 2)
+
+    def test_metrics(self):
+        metrics = SshMetrics()
+        self.ssh.metrics = metrics
+        self.ssh.mock(context='sentinel')
+        self.ssh.completion = 'sentinel'
+        self.assertTrue(self.ssh.shell_send(["uname -a\n"]))
+        self.assertTrue(self.ssh.commands(["uname -a"]))
+        self.ssh.close()
+        values = metrics.as_dict()
+        self.assertEqual(values['connect_seconds']['127.0.0.1']['']['count'], 1)
+        self.assertEqual(values['commands_total']['127.0.0.1']['uname -a'], 2)
+        self.assertEqual(values['prompt_seconds']['127.0.0.1']['uname -a']['count'], 2)
+        self.assertEqual(values['first_byte_seconds']['127.0.0.1']['uname -a']['count'], 2)
+        self.assertGreater(values['bytes_total']['127.0.0.1']['uname -a'], 60)
+        self.assertGreater(values['rounds_total']['127.0.0.1']['uname -a'], 0)
+        self.assertNotIn('timeouts_total', values)
+        text = metrics.prometheus()
+        self.assertIn('# TYPE netcontrol_ssh_prompt_seconds histogram\n', text)
+        self.assertIn('netcontrol_ssh_prompt_seconds_bucket{device="127.0.0.1",command="uname -a",le="+Inf"} 2\n', text)
+        self.assertIn('netcontrol_ssh_commands_total{device="127.0.0.1",command="uname -a"} 2\n', text)
+
+    def test_metrics_timeout(self):
+        metrics = SshMetrics()
+        self.ssh.metrics = metrics
+        self.ssh.mock(context='ps')
+        self.ssh.prompt_timeout = 0.2
+        self.ssh.shell_send(["ps -ef\n"])
+        self.ssh.close()
+        self.assertEqual(metrics.as_dict()['timeouts_total']['127.0.0.1']['ps -ef'], 1)
+
+    def test_metrics_opt_in(self):
+        self.assertIsNone(self.ssh.metrics)
+        metrics = SshMetrics(max_series=2)
+        for index in range(4):
+            metrics.inc('commands_total', '10.0.0.{}'.format(index), 'uptime')
+        values = metrics.as_dict()['commands_total']
+        self.assertEqual(sorted(values), ['10.0.0.0', '10.0.0.1', 'other'])
+        self.assertEqual(values['other']['other'], 2)
+        self.assertEqual(metrics.overflows, 2)
+
+    def test_normalize_command(self):
+        self.assertEqual(normalize_command("diagnose sys session filter dport 443\n"),
+                         "diagnose sys session filter dport N")
+        self.assertEqual(normalize_command("ping  -c 5 10.0.0.1"), "ping -c N N")
+        self.assertEqual(normalize_command("show port1"), "show port1")
+        metrics = SshMetrics()
+        metrics.inc('commands_total', 'fgt"1', 'a\\b')
+        self.assertIn('{device="fgt\\"1",command="a\\\\b"} 1', metrics.prometheus())
+
+    def test_jump_host(self):
+        bastion = JumpHost(ip='10.0.0.1', user='lab', password='lab')
+        devices = [Ssh(ip='192.168.0.{}'.format(i), user='root', password='', jump=bastion) for i in (1, 2)]
+        for device in devices:
+            device.mock(context='default')
+            self.assertTrue(device.commands(["uptime"]))
+            self.assertIsNotNone(device._client.sock)
+            device.close()
+        transport = bastion.ssh._client.get_transport()
+        self.assertEqual(transport.forwarded, [('192.168.0.1', 22), ('192.168.0.2', 22)])
+        self.assertEqual(bastion.channels, 2)
+        self.assertEqual(bastion.ssh.keepalive, 30)
+        # bastion connection is opened again once dead
+        transport.close()
+        device = Ssh(ip='192.168.0.3', user='root', password='', jump=bastion)
+        self.assertTrue(device.connect())
+        self.assertEqual(bastion.ssh.reconnects, 1)
+        self.assertEqual(bastion.ssh._client.get_transport().forwarded, [('192.168.0.3', 22)])
+        device.close()
+        bastion.close()
+
+    def test_jump_host_device_refused(self):
+        bastion = JumpHost(ip='10.0.0.1', user='lab', password='lab')
+        device = Ssh(ip='192.168.0.1', user='root', password='', jump=bastion)
+        device.mock(context='default')
+        self.assertTrue(device.connect())
+        transport = bastion.ssh._client.get_transport()
+        transport.refused.append(('192.168.0.2', 22))
+        dead = Ssh(ip='192.168.0.2', user='root', password='', jump=bastion)
+        self.assertFalse(dead.connect())
+        # sessions of the other devices are kept
+        self.assertIs(bastion.ssh._client.get_transport(), transport)
+        self.assertTrue(transport.is_active())
+        self.assertEqual(bastion.ssh.reconnects, 0)
+        self.assertTrue(device.commands(["uptime"]))
+        device.close()
+        bastion.close()
+
+    def test_jump_host_pool_key(self):
+        first = Ssh(ip='192.168.0.1', user='root', jump=JumpHost(ip='10.0.0.1', user='lab'))
+        second = Ssh(ip='192.168.0.1', user='root', jump=JumpHost(ip='10.0.0.2', user='lab'))
+        self.assertNotEqual(first._pool_key(), second._pool_key())
+
+    def test_jump_host_shared(self):
+        first = Ssh(ip='192.168.0.1', user='root', jump={'ip': '10.0.0.2', 'user': 'lab'})
+        second = Ssh(ip='192.168.0.2', user='root', jump={'ip': '10.0.0.2', 'user': 'lab'})
+        self.assertIs(first.jump, second.jump)
+        bastion = first.jump
+        bastion.ssh.mock(exception=paramiko.AuthenticationException)
+        self.assertFalse(first.connect())
+        self.assertEqual(bastion.channels, 0)
+
+    def test_mux(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'mux.sock')
+        daemon = SshMux(path).start()
+        try:
+            for index in range(2):
+                ssh = Ssh(ip='127.0.0.1', user='cgustave', password='', mux=path)
+                ssh.mock(context='sentinel')
+                ssh.completion = 'sentinel'
+                self.assertTrue(ssh.connect())
+                self.assertTrue(ssh.shell_send(["uname -a\n"]))
+                self.assertEqual(ssh.output, "Linux chameleon 5.4.0-42-generic #46-Ubuntu SMP x86_64 GNU/Linux\n")
+                self.assertEqual(ssh.exit_status, 0)
+                self.assertTrue(ssh.commands(["uname -a"]))
+                self.assertEqual(ssh.results[0]['command'], "uname -a")
+                # no session opened by the script itself
+                self.assertIsNone(ssh._client.get_transport())
+                ssh.close()
+            self.assertEqual(len(daemon._sessions), 1)
+            self.assertEqual(daemon.requests, 6)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        finally:
+            daemon.stop()
+        self.assertFalse(os.path.exists(path))
+        # no daemon listening : direct session
+        ssh = Ssh(ip='127.0.0.1', user='cgustave', password='', mux=path)
+        ssh.mock(context='default')
+        self.assertTrue(ssh.commands(["uptime"]))
+        self.assertIsNotNone(ssh._client.get_transport())
+        ssh.close()
+        shutil.rmtree(directory)
+
+    def test_mux_daemon_error(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'mux.sock')
+        daemon = SshMux(path).start()
+        try:
+            ssh = Ssh(ip='127.0.0.1', user='cgustave', password='', mux=path)
+            ssh.mock(context='default')
+            # the daemon answers an error : commands are not run again on a
+            # direct session
+            with unittest.mock.patch.object(daemon, 'handle', side_effect=RuntimeError("session failed")):
+                self.assertFalse(ssh.commands(["uptime"]))
+            self.assertIsNone(ssh._client.get_transport())
+            self.assertEqual(ssh.failures, 1)
+            # local channel methods are refused
+            self.assertEqual(list(ssh.stream("uptime\n")), [])
+            self.assertEqual(ssh.channel_read(), "")
+            self.assertIsNone(ssh._channel)
+            self.assertEqual(ssh.failures, 2)
+            # no answer before the deadline
+            with unittest.mock.patch.object(daemon, 'handle', side_effect=lambda request: time.sleep(1)):
+                self.assertFalse(ssh.commands(["uptime"], deadline=0.2))
+            self.assertTrue(ssh.timed_out)
+            self.assertIsNone(ssh._client.get_transport())
+        finally:
+            daemon.stop()
+            shutil.rmtree(directory)
+
+    def test_pool_reuse(self):
+        pool = SshPool()
+        ssh1 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh1.connect()
+        client = ssh1._client
+        ssh1.close()
+        ssh2 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh2.mock(context='default')
+        ssh2.commands(["uptime"])
+        self.assertIs(ssh2._client, client)
+        ssh2.close()
+        self.assertNotEqual(ssh2.output.find("load average"),-1)
+        self.assertEqual(pool.stats(), {'hits': 1, 'misses': 1, 'expired': 0,
+                                        'evicted': 0, 'idle': 1, 'used': 0})
+
+    def test_pool_max_per_host(self):
+        pool = SshPool(max_per_host=1, wait_timeout=0.1)
+        ssh1 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh2 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh3 = Ssh(ip='127.0.0.1', user='admin', password='', pool=pool)
+        self.assertTrue(ssh1.connect())
+        self.assertFalse(ssh2.connect())
+        self.assertTrue(ssh3.connect())
+        ssh1.close()
+        self.assertTrue(ssh2.connect())
+        self.assertEqual(pool.stats()['used'], 2)
+
+    def test_pool_key(self):
+        pool = SshPool(max_per_host=1, wait_timeout=0.1)
+        ssh1 = Ssh(ip='127.0.0.1', port='22', user='cgustave', password='secret', pool=pool)
+        # connecting twice does not take a second slot
+        self.assertTrue(ssh1.connect())
+        self.assertTrue(ssh1.connect())
+        self.assertEqual(pool.stats()['used'], 1)
+        self.assertNotIn('secret', str(ssh1._pool_key()))
+        # same port given as an int : same connection
+        ssh2 = Ssh(ip='127.0.0.1', port=22, user='cgustave', password='secret', pool=pool)
+        self.assertEqual(ssh2._pool_key(), ssh1._pool_key())
+        self.assertFalse(ssh2.connect())
+        ssh1.close()
+        # other credentials : not the same connection
+        ssh3 = Ssh(ip='127.0.0.1', port=22, user='cgustave', password='other', pool=pool)
+        self.assertNotEqual(ssh3._pool_key(), ssh1._pool_key())
+
+    def test_pool_idle_expiry(self):
+        pool = SshPool(idle_timeout=0)
+        ssh1 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh1.connect()
+        client = ssh1._client
+        ssh1.close()
+        ssh1.connect()
+        self.assertIsNot(ssh1._client, client)
+        self.assertFalse(client.get_transport().is_active())
+        self.assertEqual(pool.expired, 1)
+        self.assertEqual(pool.misses, 2)
+
+    def test_pool_health_check(self):
+        pool = SshPool()
+        ssh1 = Ssh(ip='127.0.0.1', user='cgustave', password='', pool=pool)
+        ssh1.connect()
+        client = ssh1._client
+        ssh1.close()
+        # peer went away while the connection was idle
+        client.get_transport().close()
+        ssh1.connect()
+        self.assertIsNot(ssh1._client, client)
+        self.assertEqual(pool.evicted, 1)
+        self.assertEqual(pool.hits, 0)
+
+    def test_async_commands(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='default')
+            await ssh.connect()
+            await ssh.commands(["uptime"])
+            await ssh.close()
+            return ssh
+        ssh = asyncio.run(run())
+        self.assertFalse(ssh.connected)
+        self.assertNotEqual(ssh.output.find("load average"),-1)
+
+    def test_async_concurrent_commands(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='default')
+            await ssh.commands(["uptime","ps -ef","uptime"], concurrent=True)
+            await ssh.close()
+            return ssh
+        ssh = asyncio.run(run())
+        self.assertEqual([r['command'] for r in ssh.results], ["uptime","ps -ef","uptime"])
+        self.assertEqual(ssh.results[0]['stdout'], ssh.results[2]['stdout'])
+        self.assertNotEqual(ssh.results[2]['stdout'].find("load average"),-1)
+
+    def test_async_shell_send_pipeline(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='sentinel')
+            await ssh.shell_send(["uname -a\n", "hostname\n"], pipeline=True)
+            await ssh.close()
+            return ssh
+        ssh = asyncio.run(run())
+        self.assertEqual(ssh.outputs[1], "chameleon\n")
+
+    def test_async_stream(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='sentinel')
+            lines = [line async for line in ssh.stream("hostname\n")]
+            await ssh.close()
+            return lines
+        self.assertEqual(asyncio.run(run()), ["chameleon"])
+
+    def test_async_shell_send(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='default')
+            await ssh.shell_send([])
+            await ssh.close()
+            return ssh
+        ssh = asyncio.run(run())
+        self.assertEqual(ssh._prompt, '~$')
+
+    def test_async_shell_send_deadline(self):
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', debug=True)
+            ssh.mock(context='ps')
+            ssh.prompt_timeout = 5
+            result = await ssh.shell_send(["ps -ef\n"], deadline=0.5)
+            await ssh.close()
+            return result, ssh.timed_out
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(run()), (False, True))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_async_mux(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'mux.sock')
+        daemon = SshMux(path).start()
+
+        async def run():
+            ssh = AsyncSsh(ip='127.0.0.1', user='cgustave', password='', mux=path)
+            ssh.mock(context='sentinel')
+            ssh.completion = 'sentinel'
+            result = await ssh.shell_send(["uname -a\n"])
+            await ssh.close()
+            return result, ssh.exit_status
+        try:
+            self.assertEqual(asyncio.run(run()), (True, 0))
+            self.assertEqual(daemon.requests, 1)
+        finally:
+            daemon.stop()
+            shutil.rmtree(directory)
+
 if __name__ == '__main__':
     unittest.main()
  
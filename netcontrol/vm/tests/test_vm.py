@@ -7,7 +7,10 @@ Created on Oct 15, 2019
 import logging as log
 import json
 import unittest
-from vm import Vm
+import unittest.mock
+import asyncio
+import paramiko
+from vm import Vm, AsyncVm, VmFleet, DiskCache
 
 # create logger
 log.basicConfig(
@@ -52,6 +55,50 @@ class VMctlTestCase(unittest.TestCase):
         self.assertEqual(result["load"]["15mn"], "13.96")
         self.assertEqual(len(str(result)), 1194)
 
+    #@unittest.skip
+    def test_async_get_statistics_kvm(self):
+        self.vm.ssh.mock(context='kvm_vm1')
+        expected = json.loads(self.vm.get_statistics())
+        self.vm.close()
+        async def run():
+            vm = AsyncVm(ip='10.5.0.31', port='22', user='root',
+                         password='fortinet', debug=True)
+            vm.ssh.mock(context='kvm_vm1')
+            result = await vm.get_statistics()
+            await vm.close()
+            return result
+        result = json.loads(asyncio.run(run()))
+        self.assertDictEqual(result, expected)
+
+    #@unittest.skip
+    def test_get_statistics_compound_kvm(self):
+        self.vm.ssh.mock(context='kvm_vm1')
+        expected = json.loads(self.vm.get_statistics())
+        self.vm.close()
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet')
+        vm.ssh.mock(context='kvm_vm1')
+        vm.compound = True
+        result = json.loads(vm.get_statistics())
+        vm.close()
+        self.assertDictEqual(result, expected)
+
+    #@unittest.skip
+    def test_get_statistics_compound_esx(self):
+        self.vm.host_type = 'ESX'
+        self.vm.hypervisor_type = 'esx'
+        self.vm.ssh.mock(context='esx_vm1_67')
+        expected = json.loads(self.vm.get_statistics())
+        self.vm.close()
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet',
+                host_type='ESX', hypervisor_type='esx')
+        vm.ssh.mock(context='esx_vm1_67')
+        vm.compound = True
+        result = json.loads(vm.get_statistics())
+        vm.close()
+        self.assertEqual(result["nb_cpu"], 128)
+        self.assertEqual(result["memory"]['free'], 620054120)
+        self.assertDictEqual(result, expected)
+
     #@unittest.skip
     def test_get_statistics_esx_v60(self):
         self.vm.host_type = 'ESX'
@@ -127,6 +174,20 @@ class VMctlTestCase(unittest.TestCase):
         self.assertEqual(result["vms_total"]["number"], 2)
         self.assertEqual(len(str(result)), 385)
 
+    #@unittest.skip
+    def test_get_vm_resources_kvm_domstats(self):
+        self.vm.ssh.mock(context='kvm_vm7')
+        expected = json.loads(self.vm.get_vms_statistics())
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet')
+        vm.ssh.mock(context='kvm_vm7')
+        vm.kvm_backend = 'domstats'
+        result = json.loads(vm.get_vms_statistics())
+        self.assertDictEqual(result["vms_total"], expected["vms_total"])
+        self.assertEqual(result["vms"][1]['id'], '032')
+        self.assertEqual(result["vms"][1]['cpu'], 4)
+        self.assertEqual(result["vms"][1]['memory'], 6144)
+        self.assertEqual(result["vms"][1]['template'], '/home/virtualMachines/032/ubuntu2404.qcow2')
+        self.assertEqual(result["vms_system"], expected["vms_system"])
 
     #@unittest.skip
     def test_build_vms_esx_disk(self):
@@ -138,6 +199,21 @@ class VMctlTestCase(unittest.TestCase):
         log.debug("ESXI disk Result : {} len={}".format(result, len(str(result))))
         self.assertEqual(result['vms_disks'][0]['size'], 22225616896)
 
+    #@unittest.skip
+    def test_get_vms_statistics_esx_sentinel(self):
+        self.vm.host_type = 'ESX'
+        self.vm.hypervisor_type = 'esx'
+        self.vm.ssh.mock(context='esx_vm2')
+        expected = json.loads(self.vm.get_vms_statistics())
+        self.vm.close()
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet',
+                host_type='ESX', hypervisor_type='esx')
+        vm.ssh.mock(context='esx_vm2')
+        vm.ssh.completion = 'sentinel'
+        result = json.loads(vm.get_vms_statistics())
+        vm.close()
+        self.assertDictEqual(result, expected)
+
     #@unittest.skip
     def test_build_vms_esx_disk2(self):
         # case with different path on uranium
@@ -178,6 +254,20 @@ class VMctlTestCase(unittest.TestCase):
         self.assertEqual(result["vms_total"]["memory"], 196608)
         self.assertEqual(result["vms_total"]["number"], 12)
 
+    #@unittest.skip
+    def test_get_vm_resources_esx_json(self):
+        self.vm.host_type = 'ESX'
+        self.vm.hypervisor_type = 'esx'
+        self.vm.ssh.mock(context='esx_vm1_67')
+        expected = json.loads(self.vm.get_vms_statistics())
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet',
+                host_type='ESX', hypervisor_type='esx')
+        vm.ssh.mock(context='esx_vm1_67')
+        vm.esx_backend = 'json'
+        result = json.loads(vm.get_vms_statistics())
+        self.assertEqual(result["vms_total"]["number"], 12)
+        self.assertDictEqual(result, expected)
+
     #@unittest.skip
     def test_total_vm_resources(self):
         self.vm.ssh.mock(context='kvm_vm2')
@@ -228,6 +318,55 @@ class VMctlTestCase(unittest.TestCase):
         self.assertEqual(result['vms_disks'][0]['size'], 23773429760)
         self.assertEqual(result['vms_disks'][0]['type'], 'KVM')
 
+    #@unittest.skip
+    def test_get_vms_disk_kvm_cached(self):
+        self.vm.ssh.mock(context='kvm_vm7')
+        self.vm._get_vms_disk_kvm()
+        expected = self.vm._vms_disks
+        cache = DiskCache()
+        vm = Vm(ip='10.5.0.31', port='22', user='root', password='fortinet')
+        vm.ssh.mock(context='kvm_vm7')
+        vm.disk_cache = cache
+        vm._get_vms_disk_kvm()
+        self.assertEqual(vm._vms_disks, expected)
+        # unchanged files : sizes from the cache
+        cache.update('10.5.0.31', '/home/virtualMachines/001', (1, 1772945408, 1760711903), 1024)
+        # changed files : measured again
+        cache.update('10.5.0.31', '/home/virtualMachines/032', (1, 1486618624, 1760700000), 1024)
+        self.assertEqual(cache.changed('10.5.0.31', {'/home/virtualMachines/001': (1, 1772945408, 1760711903),
+                                                     '/home/virtualMachines/032': (1, 1486618624, 1760711905)}),
+                         ['/home/virtualMachines/032'])
+        vm._vms_disks = []
+        vm._get_vms_disk_kvm()
+        self.assertEqual(vm._vms_disks[0]['size'], 1024)
+        self.assertEqual(vm._vms_disks[1], expected[1])
+        # full refresh
+        cache.refresh = 0
+        vm._vms_disks = []
+        vm._get_vms_disk_kvm()
+        self.assertEqual(vm._vms_disks, expected)
+        # du not complete : previous sizes kept, never measured directories
+        # not reported
+        cache.update('10.5.0.31', '/home/virtualMachines/001', (1, 1772945408, 1760700000), 1024)
+        del cache._hosts['10.5.0.31']['paths']['/home/virtualMachines/032']
+        shell_stream = vm.ssh.shell_stream
+        with unittest.mock.patch.object(vm.ssh, 'shell_stream',
+                                        side_effect=lambda command, callback: shell_stream(command, callback) and False):
+            vm._vms_disks = []
+            vm._get_vms_disk_kvm()
+        self.assertEqual(vm._vms_disks, [{'id': '001', 'size': 1024, 'type': 'KVM'}])
+        self.assertEqual(cache._hosts['10.5.0.31']['paths']['/home/virtualMachines/001'],
+                         ((1, 1772945408, 1760700000), 1024))
+
+    #@unittest.skip
+    def test_build_vms_esx_disk_cached(self):
+        self.vm.ssh.mock(context='esx_vm4')
+        self.vm.disk_cache = DiskCache()
+        self.vm._build_vms_esx_disk()
+        self.assertEqual(self.vm._vms_esx_disks['uranium-esx14'], 21196)
+        self.assertEqual(self.vm._vms_esx_disks['uranium-esx04'], 2662)
+        self.assertEqual(self.vm._vms_disks[1], {'id': '004', 'size': 2662 << 20, 'type': 'ESXI'})
+
     #empty vm list {} causing a failure
     #@unittest.skip
     def test_get_vm_statistics_case3(self):
@@ -305,6 +444,57 @@ class VMctlTestCase(unittest.TestCase):
         self.assertEqual(self.vm._vms_system[0]['system'], 'FGT_VM64')
         self.assertEqual(self.vm._vms_system[0]['type'], 'KVM')
 
+    #@unittest.skip
+    def test_fleet(self):
+        fleet = VmFleet([{'name': 'iron', 'ip': '10.5.0.31', 'mock_context': 'kvm_vm4'},
+                         {'name': 'cobalt', 'ip': '10.5.0.32', 'host_type': 'ESX', 'hypervisor_type': 'esx',
+                          'mock_context': 'esx_vm1_67'}], workers=1)
+        result = json.loads(fleet.collect())
+        self.assertEqual(result['hosts']['iron']['status'], 'ok')
+        self.assertEqual(result['hosts']['iron']['statistics']['nb_cpu'], 128)
+        self.assertEqual(result['hosts']['cobalt']['vms_statistics']['vms_total']['cpu'], 48)
+        self.assertEqual(result['total']['hosts'], 2)
+        self.assertEqual(result['total']['ok'], 2)
+        self.assertEqual(result['total']['nb_cpu'], 256)
+        self.assertEqual(result['total']['vms']['cpu'],
+                         48 + result['hosts']['iron']['vms_statistics']['vms_total']['cpu'])
+
+    #@unittest.skip
+    def test_fleet_timeout(self):
+        class SlowVm(AsyncVm):
+            async def get_vms_statistics(self):
+                await asyncio.sleep(10)
+        class BrokenVm(AsyncVm):
+            async def get_statistics(self):
+                raise ValueError("broken")
+        fleet = VmFleet([{'name': 'slow', 'ip': '10.5.0.31', 'mock_context': 'kvm_vm1'}], timeout=0.5)
+        fleet.vm_class = SlowVm
+        result = json.loads(fleet.collect())
+        self.assertEqual(result['hosts']['slow']['status'], 'partial')
+        self.assertEqual(result['hosts']['slow']['statistics']['nb_cpu'], 64)
+        self.assertNotIn('vms_statistics', result['hosts']['slow'])
+        self.assertEqual(result['total']['failed'], 1)
+        self.assertLess(result['duration'], 5)
+        fleet.vm_class = BrokenVm
+        result = json.loads(fleet.collect())
+        self.assertEqual(result['hosts']['slow']['status'], 'error')
+        self.assertEqual(result['hosts']['slow']['error'], 'broken')
+
+    #@unittest.skip
+    def test_fleet_unreachable(self):
+        class UnreachableVm(AsyncVm):
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                self.ssh.mock(exception=paramiko.AuthenticationException)
+        fleet = VmFleet([{'name': 'iron', 'ip': '10.5.0.31', 'mock_context': 'kvm_vm4'}])
+        fleet.vm_class = UnreachableVm
+        result = json.loads(fleet.collect())
+        self.assertEqual(result['hosts']['iron']['status'], 'error')
+        self.assertEqual(result['hosts']['iron']['error'], 'connection failed')
+        self.assertNotIn('statistics', result['hosts']['iron'])
+        self.assertEqual(result['total']['ok'], 0)
+        self.assertEqual(result['total']['failed'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
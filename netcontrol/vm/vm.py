@@ -14,14 +14,36 @@ sub classes vm_driver_kvm and vm_driver_esxi are the hypervisor specific code.
 
 This object is used in project labvmstats for all interaction with VM servers.
 '''
-from netcontrol.ssh.ssh import Ssh
-import logging as log
+from netcontrol.ssh.ssh import Ssh, AsyncSsh, ssh_steps, debug_log
+import asyncio
+import logging
 import re
 import json
+import threading
+import time
 # Workaround for paramiko deprecation warnings (will be fixed later in paramiko)
 import warnings
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
+log = logging.getLogger('netcontrol.vm')
+
+# Single round-trip probe of get_statistics (see Vm.compound) by host_type :
+# each section is announced by an ==<section>== line, then parsed by the
+# same method as its command sent alone
+STATISTICS_PROBE = {
+    'Linux': (('nb_cpu', "cat /proc/cpuinfo | grep processor | wc -l", '_parse_nbcpu'),
+              ('load', "cat /proc/loadavg", '_parse_loadavg'),
+              ('memory', "cat /proc/meminfo", '_parse_memory_kvm'),
+              ('disk', "df -BG", '_parse_disk_kvm')),
+    'ESX': (('nb_cpu', "cat /proc/cpuinfo | grep processor | wc -l", '_parse_nbcpu'),
+            ('load', "uptime", '_parse_loadavg'),
+            ('memory', "memstats -r comp-stats", '_parse_memory_esx'),
+            ('disk', "df -m", '_parse_disk_esx')),
+}
+
+# Section delimiter line of the statistics probe
+SECTION_RE = re.compile(r'^==(?P<section>\w+)==\s*$')
+
 
 class Vm(object):
     '''
@@ -32,23 +54,34 @@ class Vm(object):
     If given, the ssh key is prefered over password
     host_type : Linux (default) or KVM
     hypervisor_type : kvm (default) or esx
+    pool : SshPool to reuse ssh connections (see netcontrol.ssh.ssh.SshPool)
+    jump : JumpHost (or its definition) the host is reached through (see
+    netcontrol.ssh.ssh.JumpHost)
+    compound : if True, get_statistics sends a single command printing all
+    its outputs in delimited sections instead of one command per statistic
+    kvm_backend : how KVM VMs are found by get_vms_statistics, 'ps' (default,
+    qemu processes command line) or 'domstats' (virsh domstats)
+    esx_backend : how ESX VMs are found by get_vms_statistics, 'text'
+    (default, esxcli vm process list) or 'json' (esxcli --formatter=json)
+    disk_cache : DiskCache of VMs disk sizes (ex: netcontrol.vm.vm.disk_cache),
+    only VM directories with changed files are measured again (du). None
+    (default) : all VM directories are measured on each call
     '''
+    # ssh session class, see AsyncVm
+    ssh_class = Ssh
+    # default deadline in seconds of each ssh call (see Ssh.deadline),
+    # disk usage of large VMs may take a while on ESXi
+    deadline = 120
 
     def __init__(self, host_type='Linux', hypervisor_type='kvm', ip='', port=22, user='root', password='fortinet',
-                 private_key_file='', mock=False, debug=0):
+                 private_key_file='', mock=False, debug=0, pool=None, jump=None):
         '''
         Constructor
         '''
-        # logger
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
         # Set debug level first
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
+            debug_log()
         log.debug(f"Enter with host_type={host_type} hypervisor_type={hypervisor_type} ip={ip}, port={port}, user={user}, password={password}, private_key_file={private_key_file}, debug={debug}") 
         # public class attributs
         self.host_type = host_type
@@ -59,7 +92,12 @@ class Vm(object):
         self.password = password
         self.private_key_file = private_key_file
         self.mock_context = ''
-        self.ssh = Ssh(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug)
+        self.compound = False
+        self.kvm_backend = 'ps'
+        self.esx_backend = 'text'
+        self.disk_cache = None
+        self.ssh = self.ssh_class(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug, pool=pool, jump=jump)
+        self.ssh.deadline = self.deadline
         # private class attributes
         self._statistics = {}  # Internal representation of statistics
         self._vms = []         # Internal representation of each VMs
@@ -69,6 +107,7 @@ class Vm(object):
         self._vms_disks_dict = {} # temp object
         self._vms_esx_id_map = {} # wid to vm_name mapping
         self._vms_esx_cpu = {}    # dict of vm_id containing nb_cpu
+        self._vms_esx_cartel_cpu = {} # dict of cartel id containing nb_cpu
         self._vms_esx_memory = {} # dict of vm_id containing memory size
         self._vms_esx_disks = {}  # dict of vm_id containing disk size in
 
@@ -85,26 +124,73 @@ class Vm(object):
     def trace_mark(self, mark):
         self.ssh.trace_mark(mark)
 
+    def trace_flush(self):
+        self.ssh.trace_flush()
+
     def close(self):
         self.ssh.close()
 
+    @ssh_steps
     def get_statistics(self):
         """
         Get server CPU, MEMORY and DISK usage
         Commands to run depends on host_type
+        With compound, all commands are sent at once (see STATISTICS_PROBE)
         Return: json
         """
         log.debug('Enter')
-        self._get_nbcpu()
-        self._get_loadavg()
+        if self.compound:
+            yield from self._get_statistics_compound.steps(self)
+            return(json.dumps(self._statistics))
+        yield from self._get_nbcpu.steps(self)
+        yield from self._get_loadavg.steps(self)
         if self.host_type == 'Linux':
-            self._get_memory_kvm()
-            self._get_disk_kvm()
+            yield from self._get_memory_kvm.steps(self)
+            yield from self._get_disk_kvm.steps(self)
         elif self.host_type == 'ESX':
-            self._get_memory_esx()
-            self._get_disk_esx()
+            yield from self._get_memory_esx.steps(self)
+            yield from self._get_disk_esx.steps(self)
         return(json.dumps(self._statistics))
 
+    @ssh_steps
+    def _get_statistics_compound(self):
+        """
+        Fills self._statistics from a single command running all statistics
+        commands of the host_type, each output preceded by its section line
+        ex: echo ==nb_cpu==; cat /proc/cpuinfo | grep processor | wc -l; echo ==load==; cat /proc/loadavg; ...
+        """
+        log.debug("Enter")
+        probe = STATISTICS_PROBE.get(self.host_type)
+        if not probe:
+            log.error(f"No statistics probe for host_type={self.host_type}")
+            return
+        cmd = "; ".join(f"echo =={section}==; {command}" for section, command, parser in probe)
+        yield 'shell_send', [cmd+"\n"]
+        sections = self._split_sections(self.ssh.output)
+        for section, command, parser in probe:
+            if section in sections:
+                getattr(self, parser)(sections[section])
+            else:
+                log.error(f"Missing section={section} in statistics probe output")
+
+    def _split_sections(self, output):
+        """
+        Splits the output of the statistics probe on its section lines
+        Lines before the first section (command echo) are ignored
+        Returns a dictionary of section : output
+        """
+        sections = {}
+        section = None
+        for line in output.splitlines():
+            match = SECTION_RE.search(line)
+            if match:
+                section = match.group('section')
+                sections[section] = []
+            elif section:
+                sections[section].append(line)
+        return {section: "\n".join(lines)+"\n" for section, lines in sections.items()}
+
+    @ssh_steps
     def get_vms_statistics(self):
         """
         Get server VMS related statistics
@@ -112,14 +198,20 @@ class Vm(object):
         """
         log.debug('Enter')
         if self.hypervisor_type == 'kvm':
-            self._get_processes_kvm()
-            self._get_vms_system_kvm()
-            self._get_vms_disk_kvm()
+            if self.kvm_backend == 'domstats':
+                yield from self._get_domstats_kvm.steps(self)
+            else:
+                yield from self._get_processes_kvm.steps(self)
+            yield from self._get_vms_system_kvm.steps(self)
+            yield from self._get_vms_disk_kvm.steps(self)
         elif self.hypervisor_type == 'esx':
-            self._build_vms_esx_cpu()
-            self._build_vms_esx_memory()
-            self._build_vms_esx_disk()
-            self._get_processes_esx()
+            yield from self._build_vms_esx_cpu.steps(self)
+            yield from self._build_vms_esx_memory.steps(self)
+            yield from self._build_vms_esx_disk.steps(self)
+            if self.esx_backend == 'json':
+                yield from self._get_processes_esx_json.steps(self)
+            else:
+                yield from self._get_processes_esx.steps(self)
         result = {}
         result['vms'] = self._vms
         result['vms_total'] = self._vms_total
@@ -127,21 +219,29 @@ class Vm(object):
         result['vms_system'] = self._vms_system
         return(json.dumps(result))
 
+    @ssh_steps
     def _get_nbcpu(self):
         """
         Fills self._statistics with the number of CPU on the server
         Same command used for for Linux and ESX system
         """
         log.debug("Enter")
-        self.ssh.shell_send(["cat /proc/cpuinfo | grep processor | wc -l\n"])
-        log.debug(f"output={self.ssh.output}")
+        yield 'shell_send', ["cat /proc/cpuinfo | grep processor | wc -l\n"]
+        self._parse_nbcpu(self.ssh.output)
+
+    def _parse_nbcpu(self, output):
+        """
+        Parses the output of the number of CPU command for _get_nbcpu
+        """
+        log.debug("output=%s", output)
         # This is the first line with a single number in the line
-        nb_cpu_match = re.search(r'(\d+)\n', str(self.ssh.output))
+        nb_cpu_match = re.search(r'(\d+)\n', str(output))
         if nb_cpu_match:
             nb_cpu = int(nb_cpu_match.groups(0)[0])
             log.debug(f"nb_cpu={nb_cpu}")
             self._statistics['nb_cpu'] = nb_cpu
 
+    @ssh_steps
     def _get_loadavg(self):
         """
         Fills self._statistics with cpu load average information
@@ -155,9 +255,6 @@ class Vm(object):
         Different commands for Linux system (cat /proc/loadavg) and ESX (uptime)
         """
         log.debug("Enter")
-        load_1mn = ""
-        load_5mn = ""
-        load_15mn = ""
         log.debug(f"host_type={self.host_type}")
         if self.host_type == 'Linux':
             cmd = "cat /proc/loadavg\n"
@@ -166,8 +263,17 @@ class Vm(object):
         elif self.host_type == 'ESX':
             cmd = "uptime\n"
             #  9:43:24 up 141 days, 03:33:10, load average: 0.06, 0.07, 0.07
-        self.ssh.shell_send([cmd])
-        load_match = re.search(r'(\d+\.?\d?\d?)\,?\s+(\d+\.?\d?\d?)\,?\s+(\d+\.?\d?\d?)', str(self.ssh.output))
+        yield 'shell_send', [cmd]
+        self._parse_loadavg(self.ssh.output)
+
+    def _parse_loadavg(self, output):
+        """
+        Parses the output of the load average command for _get_loadavg
+        """
+        load_1mn = ""
+        load_5mn = ""
+        load_15mn = ""
+        load_match = re.search(r'(\d+\.?\d?\d?)\,?\s+(\d+\.?\d?\d?)\,?\s+(\d+\.?\d?\d?)', str(output))
         if load_match:
             load_1mn = load_match.groups(0)[0]
             load_5mn = load_match.groups(0)[1]
@@ -180,6 +286,7 @@ class Vm(object):
         else:
             log.error(f"Could not extract system load for type={self.host_type}")
 
+    @ssh_steps
     def _get_memory_kvm(self):
         """
         Fills  self._statistics with memory load information
@@ -200,25 +307,32 @@ class Vm(object):
         # MemFree:         5160488 kB
         # MemAvailable:   108789520 kB
         # Note: MemAvailable considers the swap that we don't want to use so use MemTotal-MemFree for used
+        yield 'shell_send', ["cat /proc/meminfo\n"]
+        self._parse_memory_kvm(self.ssh.output)
+
+    def _parse_memory_kvm(self, output):
+        """
+        Parses the output of cat /proc/meminfo for _get_memory_kvm
+        """
         self._statistics['memory'] = {}
-        self.ssh.shell_send(["cat /proc/meminfo\n"])
         memory_total = 0
         memory_free = 0
         memory_available = 0
-        mem_total_match = re.search(r'MemTotal:\s+(\d+) kB', str(self.ssh.output))
+        mem_total_match = re.search(r'MemTotal:\s+(\d+) kB', str(output))
         if mem_total_match:
             memory_total = int(mem_total_match.groups(0)[0])
             self._statistics['memory']['total'] = memory_total
-        mem_free_match = re.search(r'MemFree:\s+(\d+) kB', str(self.ssh.output))
+        mem_free_match = re.search(r'MemFree:\s+(\d+) kB', str(output))
         if mem_free_match:
             memory_free = int(mem_free_match.groups(0)[0])
             self._statistics['memory']['free'] = memory_free
-        mem_available_match = re.search(r'MemAvailable:\s+(\d+) kB', str(self.ssh.output))
+        mem_available_match = re.search(r'MemAvailable:\s+(\d+) kB', str(output))
         if mem_available_match:
             memory_available = int(mem_available_match.groups(0)[0])
             self._statistics['memory']['available'] = memory_available
         log.debug(f"memory_total={memory_total}, memory_free={memory_free}, memory_available={memory_available}")
 
+    @ssh_steps
     def _get_memory_esx(self):
         """
         Fills  self._statistics with memory load information
@@ -236,61 +350,37 @@ class Vm(object):
         # command has several values : total, minFree, free and some others.
         # use 'total', 'free' and consider available as free (we don't use it anyway)
         # this is how % is shown in vcenter for free so it matches
+        yield 'shell_send', ["memstats -r comp-stats\n"]
+        self._parse_memory_esx(self.ssh.output)
+
+    def _parse_memory_esx(self, output):
+        """
+        Parses the output of memstats -r comp-stats for _get_memory_esx
+        """
         self._statistics['memory'] = {}
-        self.ssh.shell_send(["memstats -r comp-stats\n"])
         memory_total = 0
         memory_free = 0
         memory_available = 0
-        # Memory regexp for version 6.0.0 and 6.7.0
-        mem_re_v60 = r'(?P<total>\d+)\s+'\
-                   + r'(?P<discarded>\d+)\s+'\
-                   + r'(?P<managedByMemMap>\d+)\s+'\
-                   + r'(?P<reliableMem>\d+)\s+'\
-                   + r'(?P<kernelCode>\d+)\s+'\
-                   + r'(?P<critical>\d+)\s+'\
-                   + r'(?P<dataAndHeap>\d+)\s+'\
-                   + r'(?P<buddyOvhd>\d+)\s+'\
-                   + r'(?P<rsvdLow>\d+)\s+'\
-                   + r'(?P<managedByMemSched>\d+)\s+'\
-                   + r'(?P<minFree>\d+)\s+'\
-                   + r'(?P<vmkClientConsumed>\d+)\s+'\
-                   + r'(?P<otherConsumed>\d+)\s+'\
-                   + r'(?P<free>\d+)\s+'
-        # v6,7
-        mem_re_v67 = r'(?P<total>\d+)\s+'\
-                   + r'(?P<discarded>\d+)\s+'\
-                   + r'(?P<managedByMemMap>\d+)\s+'\
-                   + r'(?P<reliableMem>\d+)\s+'\
-                   + r'(?P<kernelCode>\d+)\s+'\
-                   + r'(?P<dataAndHeap>\d+)\s+'\
-                   + r'(?P<buddyOvhd>\d+)\s+'\
-                   + r'(?P<rsvdLow>\d+)\s+'\
-                   + r'(?P<managedByMemSched>\d+)\s+'\
-                   + r'(?P<minFree>\d+)\s+'\
-                   + r'(?P<vmkClientConsumed>\d+)\s+'\
-                   + r'(?P<otherConsumed>\d+)\s+'\
-                   + r'(?P<free>\d+)\s+'
-        esx_vers = '6.7'
-        for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
-            # 'critical' is the marker of the 6.0 version
-            match_version = re.search(r'critical', line)
-            if match_version:
-                esx_vers = '6.0'
-                log.debug("found 6.0 like version")
-            if esx_vers == '6.7':
-                match_memory = re.search(mem_re_v67, line)
-            else:
-                match_memory = re.search(mem_re_v60, line)
-            if match_memory:
-                memory_total = int(match_memory.group('total'))
-                memory_free = int(match_memory.group('free'))
+        # Columns differ between versions ('critical' only in 6.0) : values
+        # are taken by their column name from the header line
+        columns = []
+        for line in output.splitlines():
+            log.debug("line=%s", line)
+            fields = line.split()
+            if 'total' in fields and 'free' in fields:
+                columns = fields
+                continue
+            if columns and len(fields) == len(columns) and fields[0].isdigit():
+                values = dict(zip(columns, fields))
+                memory_total = int(values['total'])
+                memory_free = int(values['free'])
                 memory_available = memory_free
                 log.debug(f"memory_total={memory_total} memory_free={memory_free} computed memory_available={memory_available}")
                 self._statistics['memory']['total'] = memory_total
                 self._statistics['memory']['free'] = memory_free
                 self._statistics['memory']['available'] = memory_available
 
+    @ssh_steps
     def _get_disk_kvm(self):
         """
         Fills self._statistics with disk usage information
@@ -315,10 +405,16 @@ class Vm(object):
         # tmpfs                              26G    1G       26G   1% /run
         # /dev/sda1                          10G    4G        5G  45% /
         # /dev/sda6                        1751G 1167G      496G  71% /home
-        self.ssh.shell_send(["df -BG\n"])
+        yield 'shell_send', ["df -BG\n"]
+        self._parse_disk_kvm(self.ssh.output)
+
+    def _parse_disk_kvm(self, output):
+        """
+        Parses the output of df -BG for _get_disk_kvm
+        """
         self._statistics['disk'] = {}
-        for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+        for line in output.splitlines():
+            log.debug("line=%s", line)
             home_re = r'(?P<dev>[A-Za-z0-9\/]+)(?:\s+)(\d+)G\s+(?P<used>\d+)G\s+'\
                     + r'(?P<available>\d+)G\s+(?P<used_percent>\d+)%\s+'\
                     + r'(?P<mounted>[A-Za-z0-9\/]+)'
@@ -337,6 +433,7 @@ class Vm(object):
                 self._statistics['disk'][mounted]['used_percent'] = used_percent
                 self._statistics['disk'][mounted]['type'] = 'KVM'
 
+    @ssh_steps
     def _get_disk_esx(self):
         """
         Fills self._statistics with disk usage information
@@ -365,10 +462,16 @@ class Vm(object):
         # vfat            4094      32      4061   1% /vmfs/volumes/58f72d54-99c8b477-1ff9-d4ae52e8199a
         # vfat             249     175        74  70% /vmfs/volumes/42497372-e8f357aa-1697-4021215e5aa2
         # vfat             285     262        23  92% /vmfs/volumes/58f72d4b-3d836623-207e-d4ae52e8199a
-        self.ssh.shell_send(["df -m\n"])
+        yield 'shell_send', ["df -m\n"]
+        self._parse_disk_esx(self.ssh.output)
+
+    def _parse_disk_esx(self, output):
+        """
+        Parses the output of df -m for _get_disk_esx
+        """
         self._statistics['disk'] = {}
-        for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+        for line in output.splitlines():
+            log.debug("line=%s", line)
             datastore_re = r'(?P<dev>[A-Za-z0-9\/-]+)(?:\s+)(\d+)\s+(?P<used>\d+)\s+'\
                     + r'(?P<available>\d+)\s+(?P<used_percent>\d+)%\s+'\
                     + r'(?P<mounted>[A-Za-z0-9\/]+)'
@@ -387,6 +490,7 @@ class Vm(object):
                 self._statistics['disk'][mounted]['used_percent'] = used_percent
                 self._statistics['disk'][mounted]['type'] = 'ESXI'
 
+    @ssh_steps
     def _get_processes_esx(self):
         """
         Retrieve esxi process from 'esxcli process list' to fill _vms and _vms_total attributs
@@ -404,7 +508,7 @@ class Vm(object):
         We use Display name as VM id
         """
         log.debug("Enter")
-        self.ssh.shell_send(["esxcli vm process list\n"])
+        yield 'shell_send', ["esxcli vm process list\n"]
         self._vms = []
         self._vms_total = {}
         self._vms_total['cpu'] = 0
@@ -422,7 +526,7 @@ class Vm(object):
         for line in self.ssh.output.splitlines():
             if esx_start:
                 esx_line = esx_line + 1
-            log.debug(f"esx_line={esx_line} line={line}")
+            log.debug("esx_line=%s line=%s", esx_line, line)
             if esx_line == 1:
                 match_name = re.search(r'(?P<vm_name>\S+)\s\[(?P<create_user>\S+)\]\s(?P<system>\S+)', line)
                 if match_name:
@@ -447,7 +551,7 @@ class Vm(object):
                             vm_memory = int(int(self._vms_esx_memory[vm_esxid]) >> 10)
                             self._vms_total['memory'] += int(vm_memory)
                         else:
-                            log.warn('ignore memory on non lms vm')
+                            log.warning('ignore memory on non lms vm')
                     else:
                         log.error(f"Could not find vm memory for vm_esxi={vm_esxid}")
                         ret = False
@@ -502,6 +606,91 @@ class Vm(object):
                     log.warning(f'vm is not an lms vm, skip')
         return ret
 
+    @ssh_steps
+    def _get_processes_esx_json(self):
+        """
+        Retrieve esxi processes like _get_processes_esx from the json output
+        of 'esxcli --formatter=json vm process list', VMs are joined to
+        their cpu and memory by VMX cartel ID
+        Sample of 1 process:
+            [{"ConfigFile":"/vmfs/volumes/.../uranium-esx36 [knagaraju] FGT_VM64_ESXI.vmx",
+              "DisplayName":"uranium-esx36 [knagaraju] FGT_VM64_ESXI",
+              "ProcessID":0,"UUID":"cc cf 7f af 0f 3d 45 23-8a 69 1f 43 4e c2 97 56",
+              "VMXCartelID":2557322,"WorldID":2557323}]
+        """
+        log.debug("Enter")
+        yield 'shell_send', ["esxcli --formatter=json vm process list\n"]
+        self._vms = []
+        self._vms_total = {}
+        self._vms_total['cpu'] = 0
+        self._vms_total['memory'] = 0
+        self._vms_total['number'] = 0
+        self._vms_total['disk'] = 0
+        self._vms_esx_id_map = {}
+        processes = self._decode_json(self.ssh.output)
+        if processes is None:
+            log.error("Could not decode esxcli json output")
+            return False
+        ret = True
+        for process in processes:
+            display_name = process.get('DisplayName', '')
+            match_name = re.search(r'(?P<vm_name>\S+)\s\[(?P<create_user>\S+)\]\s(?P<system>\S+)', display_name)
+            if not match_name:
+                log.warning(f"VM does not look like an LMS vms display_name={display_name}")
+                continue
+            vm_name = match_name.group('vm_name')
+            system = match_name.group('system')
+            cartel = str(process.get('VMXCartelID', ''))
+            self._vms_esx_id_map[cartel] = vm_name
+            instance = self._get_vm_instance_from_name(name=vm_name)
+            if not re.search(r'\d+', instance):
+                log.warning(f"got unexpected instance format instance={instance}")
+                ret = False
+                continue
+            self._vms_total['number'] += 1
+            vm = {'id': instance, 'cpu': 0, 'memory': 0, 'template': system}
+            system = system.replace('_ESXI', '')
+            vm['system'] = system
+            self._vms_system.append({'id': instance, 'system': system, 'type': 'ESXI'})
+            if cartel in self._vms_esx_memory:
+                vm['memory'] = int(int(self._vms_esx_memory[cartel]) >> 10)
+                self._vms_total['memory'] += vm['memory']
+            else:
+                log.error(f"Could not find vm memory for cartel={cartel}")
+                ret = False
+            if cartel in self._vms_esx_cartel_cpu:
+                vm['cpu'] = self._vms_esx_cartel_cpu[cartel]
+                self._vms_total['cpu'] += vm['cpu']
+            else:
+                log.error(f"Could not find nb of cpu for cartel={cartel}")
+                ret = False
+            if vm_name in self._vms_esx_disks:
+                vm['disk'] = self._vms_esx_disks[vm_name]
+                vm['type'] = 'ESXI'
+                self._vms_total['disk'] += vm['disk']
+            else:
+                log.error(f"Could not find disk size for vm_name={vm_name}")
+                ret = False
+            log.debug(f'record vm={vm}')
+            self._vms.append(vm)
+        return ret
+
+    def _decode_json(self, output):
+        """
+        Returns the first json list or object found at a line start of
+        output (after the command echo), None if there is none
+        """
+        decoder = json.JSONDecoder()
+        position = 0
+        for line in output.splitlines(keepends=True):
+            if line.startswith(('[{', '[]', '{')):
+                try:
+                    return decoder.raw_decode(output, position)[0]
+                except ValueError:
+                    pass
+            position += len(line)
+        return None
+
     def _get_vm_instance_from_name(self, name=""):
         """
         VM instance is like 001, 011, 122 and so on.
@@ -513,16 +702,18 @@ class Vm(object):
         if match_inst:
             inst = match_inst.group('inst')
             result = str(inst).zfill(3)
-            log.debug(f"formatted instance result={result}")
+            log.debug("formatted instance result=%s", result)
         else:
             log.warning(f"Could not extract formatted instance from name={name}")
         return result
 
+    @ssh_steps
     def _build_vms_esx_cpu(self):
         """
         To be run before _get_process_cpu_esx
         Update self._vms_esx_cpu with number of CPUs by VM using 'ps -u | grep vcpu'
         One line per cpu by vm so keep the last line and add +1
+        Second column is the VMX cartel ID (key of self._vms_esx_cartel_cpu)
         sample:
         7446209  7446202  vmx-vcpu-0:neutron-esx04 [spathak] FGT_VM64_ESXI        <- 1 cpu
         7872663  7872656  vmx-vcpu-0:neutron-esx06 [atsakiridis] FGT_VM64_ESXI    <- 1 cpu
@@ -533,16 +724,19 @@ class Vm(object):
         """
         log.debug("Enter")
         self._vms_esx_cpu = {}
-        self.ssh.shell_send(["ps -u\n"])
+        self._vms_esx_cartel_cpu = {}
+        yield 'shell_send', ["ps -u\n"]
         for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
-            match = re.search(r'\d+\s+\d+\s+vmx-vcpu-(?P<cpu>\d+):(?P<vm_id>\S+)',line)
+            log.debug("line=%s", line)
+            match = re.search(r'\d+\s+(?P<cartel>\d+)\s+vmx-vcpu-(?P<cpu>\d+):(?P<vm_id>\S+)',line)
             if match:
                 cpu = match.group('cpu')
                 vm_id = match.group('vm_id')
                 log.debug(f"found vm_id={vm_id} cpu={cpu}")
                 self._vms_esx_cpu[vm_id] = int(cpu) + 1
+                self._vms_esx_cartel_cpu[match.group('cartel')] = int(cpu) + 1
 
+    @ssh_steps
     def _build_vms_esx_memory(self):
         """
         To be run before _get_process_cpu_esx
@@ -555,9 +749,9 @@ class Vm(object):
         """
         log.debug("Enter")
         self._vms_esx_memory = {}
-        self.ssh.shell_send(["memstats -r vm-stats\n"])
+        yield 'shell_send', ["memstats -r vm-stats\n"]
         for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+            log.debug("line=%s", line)
             match = re.search(r'vm\.\d+\s+\S+\s+\d+\s+\d+\s+(?P<esxid>\d+)\s+(?P<memory>\d+)\s',line)
             if match:
                 esxid = match.group('esxid')
@@ -565,6 +759,7 @@ class Vm(object):
                 log.debug(f"found esxid={esxid} memory={memory}")
                 self._vms_esx_memory[esxid] = memory
 
+    @ssh_steps
     def _get_processes_kvm(self):
         """
         Retrieve qemu processes from KVM server
@@ -580,7 +775,7 @@ class Vm(object):
         25/08 Debian13 memory is like :  -m size=6291456k
         """
         log.debug("Enter")
-        self.ssh.shell_send(["sudo ps -xww | grep --color=never -E 'qemu-system |kvm '\n"])
+        yield 'shell_send', ["sudo ps -xww | grep --color=never -E 'qemu-system |kvm '\n"]
         self._vms_total = {}
         self._vms_total['cpu'] = 0
         self._vms_total['memory'] = 0
@@ -589,7 +784,7 @@ class Vm(object):
         kvm_start = False
         kvm_end = False
         for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+            log.debug("line=%s", line)
             need_tokenize = False
             # Looking for kvm process starting line (qemu-system-x86_64)
             if line.find('qemu-system-x86_64 ') != -1:
@@ -640,6 +835,70 @@ class Vm(object):
                     self._vms_total['memory'] += int(result['memory'])
                     log.debug(f"vms_total_memory={self._vms_total['memory']}")
 
+    @ssh_steps
+    def _get_domstats_kvm(self):
+        """
+        Retrieve running domains from KVM server using virsh domstats
+        Fills _vms and _vms_total attributs like _get_processes_kvm
+        All domains are given in one key=value stream :
+        vmstats@gallium:~$ sudo virsh domstats --raw --list-active --state --vcpu --balloon --block
+        Domain: '001'
+          state.state=1
+          state.reason=1
+          balloon.current=4194304
+          balloon.maximum=4194304
+          vcpu.current=2
+          vcpu.maximum=2
+          block.count=1
+          block.0.name=vda
+          block.0.path=/home/virtualMachines/001/ubuntu2404.qcow2
+        memory is in KB (balloon.maximum, the -m of the qemu process)
+        template is the first disk (block.0.path)
+        """
+        log.debug("Enter")
+        yield 'shell_send', ["sudo virsh domstats --raw --list-active --state --vcpu --balloon --block\n"]
+        self._vms_total = {}
+        self._vms_total['cpu'] = 0
+        self._vms_total['memory'] = 0
+        self._vms_total['number'] = 0
+        for domain, stats in self._parse_domstats(self.ssh.output).items():
+            log.debug(f"domain={domain} stats={stats}")
+            # 5 : shut off
+            if stats.get('state.state') == '5':
+                continue
+            try:
+                cpu = int(stats['vcpu.current'])
+                memory = int(int(stats['balloon.maximum']) / 1024)
+            except (KeyError, ValueError):
+                log.warning(f"incomplete domain stats domain={domain}")
+                continue
+            vm = {'id': domain, 'cpu': cpu, 'memory': memory}
+            if 'block.0.path' in stats:
+                vm['template'] = stats['block.0.path']
+            self._vms.append(vm)
+            self._vms_total['number'] += 1
+            self._vms_total['cpu'] += cpu
+            self._vms_total['memory'] += memory
+        log.debug(f"vms_total={self._vms_total}")
+
+    def _parse_domstats(self, output):
+        """
+        Parses virsh domstats output in one pass
+        Returns a dictionary of domain : {stat : value}
+        """
+        domains = {}
+        stats = None
+        for line in output.splitlines():
+            match = re.search(r"^Domain:\s+'(?P<domain>.*)'", line)
+            if match:
+                stats = domains[match.group('domain')] = {}
+                continue
+            key, separator, value = line.strip().partition('=')
+            if stats is not None and separator:
+                stats[key] = value
+        return domains
+
+    @ssh_steps
     def _get_vms_system_kvm(self):
         """
         Retrieve the running system code from virsh list --title
@@ -662,9 +921,9 @@ class Vm(object):
         - match with ESX behavior for which we don't extract OS on shutdown systems (based on process)
         """
         log.debug("Enter")
-        self.ssh.shell_send(["sudo virsh list --title\n"])
+        yield 'shell_send', ["sudo virsh list --title\n"]
         for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+            log.debug("line=%s", line)
             system_match = re.search(r'\s+\S+\s+(?P<id>\S+)\s+(?:running|idle|paused|in\sshutdown|shut\soff|crashed|pmsuspended)\s+\S+\s+\S+\s+(?P<system>\S+)', line)
             if system_match:
                 id = system_match.group('id')
@@ -692,7 +951,7 @@ class Vm(object):
             'template': ...
         }
         """
-        log.debug(f"Enter with line={line}")
+        log.debug("Enter with line=%s", line)
         vm_id = None
         cpu = None
         memory = None
@@ -702,30 +961,30 @@ class Vm(object):
         id_match = re.search(r'\sguest=([A-Za-z0-9_\-\.\/\s]+)(?:,|\s)', line)
         if id_match:
             vm_id = id_match.groups(0)[0]
-            log.debug(f"id={vm_id}")
+            log.debug("id=%s", vm_id)
         # Number of CPU assigned to the VM
         cpu_match = re.search(r'\s-smp\s(\d+)(?:,|\s)', line)
         if cpu_match:
             cpu = int(cpu_match.groups(0)[0])
-            log.debug(f"cpu={cpu}")
+            log.debug("cpu=%s", cpu)
         # Allocated memory in Mb
         memory_match = re.search(r'\s-m\s(\d+)(?:,|\s)', line)
         if memory_match:
             memory = int(memory_match.groups(0)[0])
-            log.debug(f"memory={memory} Mb")
+            log.debug("memory=%s Mb", memory)
         # Allocated memory for Debian13 :  -m size=6291456k, need to convert to MB
         memory_match2 = re.search(r'\s-m\ssize=(\d+)k(?:,|\s)', line)
         if memory_match2:
             memory = int(int(memory_match2.groups(0)[0]) / 1024)
-            log.debug(f"Debian13 memory={memory} Mb")
+            log.debug("Debian13 memory=%s Mb", memory)
         # Running template
         template_match = re.search(r'\s-drive\sfile=([A-Za-z0-9_\-\.\/\s]+)', line)
         if template_match:
             template = template_match.groups(0)[0]
-            log.debug(f"template={template}")
+            log.debug("template=%s", template)
         vm = {}
         if template_match and (memory_match or memory_match2) and cpu_match and id_match:
-            log.debug(f"tokenize succesful : id={vm_id} cpu={cpu} memory={memory} template={template}")
+            log.debug("tokenize succesful : id=%s cpu=%s memory=%s template=%s", vm_id, cpu, memory, template)
             vm['id'] = vm_id
             vm['cpu'] = cpu
             vm['memory'] = memory
@@ -734,7 +993,7 @@ class Vm(object):
         elif (memory_match or memory_match2) and cpu_match and id_match:
             # This case was seen with windows VM created without disk (stay in
             # boot failure)
-            log.debug(f"tokenize succesful without template : id={vm_id} cpu={cpu} memory={memory}")
+            log.debug("tokenize succesful without template : id=%s cpu=%s memory=%s", vm_id, cpu, memory)
             vm['id'] = vm_id
             vm['cpu'] = cpu
             vm['memory'] = memory
@@ -744,6 +1003,7 @@ class Vm(object):
         # Need to return an empty dictionnary
         return {}
 
+    @ssh_steps
     def _get_vms_disk_kvm(self, vmpath='/home/virtualMachines'):
         """
         Retrieve VM disk usage.
@@ -768,10 +1028,13 @@ class Vm(object):
         Need to addition for each VM the size of each disks in bytes
         """
         log.debug(f'Enter with vmpath={vmpath}')
+        if self.disk_cache is not None:
+            yield from self._get_vms_disk_kvm_cached.steps(self, vmpath)
+            return
         cmd = "for i in `sudo virsh list --all | awk '{print $2}'`; do sudo du "+vmpath+"/$i/* ; done"
-        self.ssh.shell_send([cmd+"\n"])
+        yield 'shell_send', [cmd+"\n"]
         for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
+            log.debug("line=%s", line)
             if re.search(r'No such file', line):
                 continue
             self._extract_vms_disk(vmpath, line)
@@ -780,6 +1043,75 @@ class Vm(object):
             size = self._vms_disks_dict[id]
             self._vms_disks.append({'id': id, 'size': size, 'type': 'KVM'})
 
+    @ssh_steps
+    def _get_vms_disk_kvm_cached(self, vmpath='/home/virtualMachines'):
+        """
+        Retrieve VM disk usage like _get_vms_disk_kvm, using self.disk_cache
+        VM files are listed with stat (cheap, no disk walk), du is only run
+        on VM directories whose files changed since their last measure
+        (all of them on the disk_cache full refresh)
+        vmstats@gallium:~$ for i in `sudo virsh list --all | awk '{print $2}'`; do sudo stat -c '%Y %s %n' /home/virtualMachines/$i/* ; done
+        stat: cannot statx '/home/virtualMachines/Name/*': No such file or directory
+        1760711903 1772945408 /home/virtualMachines/001/ubuntu2404.qcow2
+        1760711905 1486618624 /home/virtualMachines/032/ubuntu2404.qcow2
+        """
+        log.debug(f'Enter with vmpath={vmpath}')
+        cmd = "for i in `sudo virsh list --all | awk '{print $2}'`; do sudo stat -c '%Y %s %n' "+vmpath+"/$i/* ; done"
+        if not (yield 'shell_send', [cmd+"\n"]):
+            log.error("VM files listing failed, disk cache unchanged")
+            return
+        fingerprints = self._disk_fingerprints(self.ssh.output)
+        paths = self.disk_cache.changed(self.ip, fingerprints)
+        if paths:
+            sizes = {}
+
+            def du_line(line):
+                log.debug("line=%s", line)
+                match = re.search(r'^(?P<size>\d+)\s+(?P<path>\S+)/[^/]+$', line)
+                if match:
+                    path = match.group('path')
+                    # size in KB, need in Bytes
+                    sizes[path] = sizes.get(path, 0) + int(match.group('size')) * 1024
+            # du takes time : streamed until its end (stream_timeout without data)
+            if (yield 'shell_stream', "sudo du "+" ".join(path+"/*" for path in paths)+"\n", du_line):
+                self._update_disk_cache(fingerprints, sizes)
+            else:
+                log.error("du not complete, keeping previous disk sizes")
+        for path in fingerprints:
+            size = self.disk_cache.size(self.ip, path)
+            if size is None:
+                log.debug(f"no measured size for path={path}")
+                continue
+            id = path[len(vmpath)+1:]
+            self._vms_disks.append({'id': id, 'size': size, 'type': 'KVM'})
+
+    def _update_disk_cache(self, fingerprints, sizes):
+        """
+        Records in self.disk_cache the sizes of the directories measured by
+        du. Directories missing from du output keep their previous size and
+        fingerprint, so they are measured again next time if they changed
+        """
+        for path, size in sizes.items():
+            if path in fingerprints:
+                self.disk_cache.update(self.ip, path, fingerprints[path], size)
+
+    def _disk_fingerprints(self, output):
+        """
+        Parses stat -c '%Y %s %n' output of VM files
+        Returns a dictionary of VM directory : fingerprint of its files
+        (number of files, total size, latest modification time)
+        """
+        fingerprints = {}
+        for line in output.splitlines():
+            match = re.search(r'^(?P<mtime>\d+)\s+(?P<size>\d+)\s+(?P<file>/.+)$', line)
+            if match:
+                path = match.group('file').rsplit('/', 1)[0]
+                count, size, mtime = fingerprints.get(path, (0, 0, 0))
+                fingerprints[path] = (count + 1, size + int(match.group('size')),
+                                      max(mtime, int(match.group('mtime'))))
+        return fingerprints
+
+    @ssh_steps
     def _build_vms_esx_disk(self):
         """
         Parse datastore, retrieve disk usage for each VM.
@@ -822,60 +1154,125 @@ class Vm(object):
         Store in Bytes
         """
         log.debug("Enter")
+        if self.disk_cache is not None:
+            yield from self._build_vms_esx_disk_cached.steps(self)
+            return
         cmd = "du -h /vmfs/volumes/*datastore*/ | grep esx | awk '// { print $1 \", \" $2}'"
-        self.ssh.shell_send([cmd+"\n"])
-        for line in self.ssh.output.splitlines():
-            log.debug(f"line={line}")
-            match_vm = re.search(r'(?P<size>\d+\.?\d+?)(?P<unit>G|M|K|T),\s(?P<machine>\S+)', line)
-            if match_vm:
-                size = match_vm.group('size')
-                unit = match_vm.group('unit')
-                machine = match_vm.group('machine')
-                log.debug(f"Found size={size} unit={unit} machine={machine}")
-                # get machine id from full name
-                # ex: /vmfs/volumes/datastore-Neutron/machines/neutron-esx36  or
-                # ex: /vmfs/volumes/datastore-Uranium/uranium-esx69   (no machines)
-                match_name = re.search(r'(machines)?/(?P<name>[A-Za-z0-9_-]+)$', machine)
-                if match_name:
-                    name = match_name.group('name')
-                    log.debug(f"Found name={name}")
-                    if unit == 'G':
-                        value = int(float(size) * 1024)
-                    elif unit == 'M':
-                        value = int(float(size))
-                    elif unit == 'T':
-                        value == int(float(size) * 1024 * 1024)
-                    elif unit == 'K':
-                        value == int(float(size) / 1024)
-                    else:
-                        log.error(f"Unexpected disk size unit={unit} on esx machine={name}")
-                        value = 0
-                    self._vms_esx_disks[name] = value
-                    log.debug(f"name={name} disk size={value}")
-                    match = re.search(r'esx(?P<id>\d+)', name)
-                    if match:
-                        id = match.group('id')
-                        fid = self.format_instance(id=id)
-                        # size in Mega => to Bytes (1024 * 1024)
-                        size = int(value) << 20
-                        json = {'id': fid , 'size': size, 'type': 'ESXI'}
-                        log.debug(f"json={json}")
-                        self._vms_disks.append(json)
-                    else:
-                        log.warning(f"No disk for name={name}")
-                else:
-                    log.debug(f"Could not extract machine name from machine={machine}")
+        # du output is parsed while received
+        yield 'shell_stream', cmd+"\n", self._esx_disk_line
         # Sending an empty line in the end to temporize before next command
-        # was needed on electron
-        log.debug("end of processing, sending empty line")
-        self.ssh.shell_send(["\n"])
+        # was needed on electron (not with 'sentinel' completion)
+        if self.ssh.completion != 'sentinel':
+            log.debug("end of processing, sending empty line")
+            yield 'shell_send', ["\n"]
+
+    @ssh_steps
+    def _build_vms_esx_disk_cached(self):
+        """
+        Builds self._vms_esx_disks like _build_vms_esx_disk, using
+        self.disk_cache : VM directories files are listed with stat, du is
+        only run on the directories whose files changed since their last
+        measure (all of them on the disk_cache full refresh)
+        [root@uranium:~] stat -c '%Y %s %n' /vmfs/volumes/*datastore*/*esx*/* /vmfs/volumes/*datastore*/machines/*esx*/*
+        1760711903 2147483648 /vmfs/volumes/datastore-Uranium/uranium-esx14 [vpalomo] FAD_VM64_ESXI/FAD_VM64_ESXI-flat.vmdk
+        [root@uranium:~] du -sk "/vmfs/volumes/datastore-Uranium/uranium-esx14 [vpalomo] FAD_VM64_ESXI"
+        21705523        /vmfs/volumes/datastore-Uranium/uranium-esx14 [vpalomo] FAD_VM64_ESXI
+        """
+        log.debug("Enter")
+        if not (yield 'shell_send', ["stat -c '%Y %s %n' /vmfs/volumes/*datastore*/*esx*/* /vmfs/volumes/*datastore*/machines/*esx*/*\n"]):
+            log.error("VM files listing failed, disk cache unchanged")
+            return
+        fingerprints = self._disk_fingerprints(self.ssh.output)
+        paths = self.disk_cache.changed(self.ip, fingerprints)
+        if paths:
+            sizes = {}
+
+            def du_line(line):
+                log.debug("line=%s", line)
+                match = re.search(r'^(?P<size>\d+)\s+(?P<path>/.+)$', line)
+                if match:
+                    # size in KB, need in Bytes
+                    sizes[match.group('path')] = int(match.group('size')) * 1024
+            # du on VMFS takes time : streamed until its end (stream_timeout
+            # without data) so its output does not spill in the next command
+            complete = yield 'shell_stream', "du -sk "+" ".join(f'"{path}"' for path in paths)+"\n", du_line
+            if complete:
+                self._update_disk_cache(fingerprints, sizes)
+            else:
+                log.error("du not complete, keeping previous disk sizes")
+            # temporize before next command like _build_vms_esx_disk
+            if self.ssh.completion != 'sentinel':
+                yield 'shell_send', ["\n"]
+        for path in fingerprints:
+            size = self.disk_cache.size(self.ip, path)
+            if size is None:
+                log.debug(f"no measured size for path={path}")
+                continue
+            # directory name up to the first space is the machine name
+            name = path.rsplit('/', 1)[-1].split(' ')[0]
+            if re.search(r'^[A-Za-z0-9_-]+$', name):
+                # size in Mega like _esx_disk_line
+                self._record_esx_disk(name, size >> 20)
+            else:
+                log.debug(f"Could not extract machine name from path={path}")
+
+    def _esx_disk_line(self, line):
+        """
+        Parses a line of du output for _build_vms_esx_disk
+        """
+        log.debug("line=%s", line)
+        match_vm = re.search(r'(?P<size>\d+\.?\d+?)(?P<unit>G|M|K|T),\s(?P<machine>\S+)', line)
+        if match_vm:
+            size = match_vm.group('size')
+            unit = match_vm.group('unit')
+            machine = match_vm.group('machine')
+            log.debug(f"Found size={size} unit={unit} machine={machine}")
+            # get machine id from full name
+            # ex: /vmfs/volumes/datastore-Neutron/machines/neutron-esx36  or
+            # ex: /vmfs/volumes/datastore-Uranium/uranium-esx69   (no machines)
+            match_name = re.search(r'(machines)?/(?P<name>[A-Za-z0-9_-]+)$', machine)
+            if match_name:
+                name = match_name.group('name')
+                log.debug(f"Found name={name}")
+                if unit == 'G':
+                    value = int(float(size) * 1024)
+                elif unit == 'M':
+                    value = int(float(size))
+                elif unit == 'T':
+                    value == int(float(size) * 1024 * 1024)
+                elif unit == 'K':
+                    value == int(float(size) / 1024)
+                else:
+                    log.error(f"Unexpected disk size unit={unit} on esx machine={name}")
+                    value = 0
+                self._record_esx_disk(name, value)
+            else:
+                log.debug(f"Could not extract machine name from machine={machine}")
+
+    def _record_esx_disk(self, name, value):
+        """
+        Records the disk size of esx machine name, value in Mega
+        """
+        self._vms_esx_disks[name] = value
+        log.debug(f"name={name} disk size={value}")
+        match = re.search(r'esx(?P<id>\d+)', name)
+        if match:
+            id = match.group('id')
+            fid = self.format_instance(id=id)
+            # size in Mega => to Bytes (1024 * 1024)
+            size = int(value) << 20
+            json = {'id': fid , 'size': size, 'type': 'ESXI'}
+            log.debug(f"json={json}")
+            self._vms_disks.append(json)
+        else:
+            log.warning(f"No disk for name={name}")
 
     def _extract_vms_disk(self, vmpath, line):
         """
         Parse output to get all vms disk consumption
         in Bytes
         """
-        log.debug(f"Enter with vmpath={vmpath} line={line}")
+        log.debug("Enter with vmpath=%s line=%s", vmpath, line)
         d_match = re.search(vmpath+r'/(?P<id>[a-zA-Z0-9_\-\.\/s]+)/',line)
         if d_match:
             id = d_match.group("id")
@@ -926,6 +1323,253 @@ class Vm(object):
         print(json.dumps(self._vms_total, indent=4, sort_keys=True))
 
 
+class AsyncVm(Vm):
+    """
+    asyncio flavour of Vm, backed by AsyncSsh
+    Collectors are coroutines, so statistics from many servers can be
+    gathered concurrently from a single event loop :
+      stats = await asyncio.gather(*[vm.get_statistics() for vm in vms])
+    """
+    ssh_class = AsyncSsh
+
+    async def connect(self):
+        await self.ssh.connect()
+
+    async def close(self):
+        await self.ssh.close()
+
+
+class DiskCache(object):
+    """
+    Disk sizes of VM directories by host, see Vm.disk_cache
+    A directory is measured again only when the fingerprint of its files
+    (number, total size and latest modification time) changes, or on the
+    full refresh of its host, every refresh seconds.
+    Thread safe, so one cache can be shared by all Vm objects of a process
+    (see disk_cache)
+    """
+
+    def __init__(self, refresh=3600):
+        # public class attributs
+        self.refresh = refresh
+        # Private attributs
+        self._hosts = {}  # host : {'sweep': time, 'paths': {path: (fingerprint, size)}}
+        self._lock = threading.Lock()
+
+    def changed(self, host, fingerprints):
+        """
+        Forgets the directories of host not in fingerprints anymore
+        Returns the directories of fingerprints to measure : all of them if
+        the full refresh of host is due, the new and changed ones otherwise
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._hosts.setdefault(host, {'sweep': None, 'paths': {}})
+            paths = entry['paths']
+            for path in [path for path in paths if path not in fingerprints]:
+                del paths[path]
+            if entry['sweep'] is None or now - entry['sweep'] >= self.refresh:
+                log.debug(f"host={host} full refresh of {len(fingerprints)} directories")
+                entry['sweep'] = now
+                return list(fingerprints)
+            result = [path for path, fingerprint in fingerprints.items()
+                      if path not in paths or paths[path][0] != fingerprint]
+            log.debug(f"host={host} changed={len(result)}/{len(fingerprints)}")
+            return result
+
+    def update(self, host, path, fingerprint, size):
+        """
+        Records the size of directory path of host, measured with fingerprint
+        """
+        with self._lock:
+            entry = self._hosts.setdefault(host, {'sweep': None, 'paths': {}})
+            entry['paths'][path] = (fingerprint, size)
+
+    def size(self, host, path):
+        """
+        Returns the recorded size of directory path of host, None if it was
+        never measured
+        """
+        with self._lock:
+            entry = self._hosts.get(host, {'paths': {}})
+            return entry['paths'].get(path, (None, None))[1]
+
+    def clear(self):
+        """
+        Forgets all hosts
+        """
+        with self._lock:
+            self._hosts = {}
+
+
+# Process-wide disk sizes cache, see Vm.disk_cache
+disk_cache = DiskCache()
+
+
+class VmFleet(object):
+    """
+    Collects statistics of many VM servers concurrently
+    inventory : list of hosts, each one a dictionary of AsyncVm arguments
+    (ip, host_type, hypervisor_type, user, password, private_key_file...)
+    with optional keys :
+      - name : host name in the result (default : ip)
+      - mock_context : mocked ssh context (tests)
+    workers : maximum number of hosts collected at a time
+    timeout : seconds allowed to each host, its collections finished before
+    are still reported
+    vms : if True, VMs statistics are also collected (get_vms_statistics)
+    compound : single round-trip host statistics (see Vm.compound)
+    disk_cache : DiskCache of the VMs disk sizes (see Vm.disk_cache), kept
+    between sweeps
+
+    A sweep takes about the time of the slowest host (within timeout) as
+    long as there are less hosts than workers.
+
+    ex:
+        fleet = VmFleet([{'ip': '10.5.0.69', 'user': 'vmstats', 'private_key_file': '/tmp/id_vmstats'},
+                         {'ip': '10.5.4.10', 'host_type': 'ESX', 'hypervisor_type': 'esx'}])
+        print(fleet.collect())
+    """
+    # vm class of each host, see AsyncVm
+    vm_class = AsyncVm
+
+    def __init__(self, inventory, workers=32, timeout=300, vms=True, compound=False, disk_cache=None, debug=0):
+        log.debug(f"Enter with hosts={len(inventory)} workers={workers} timeout={timeout} vms={vms} compound={compound}")
+        # public class attributs
+        self.inventory = inventory
+        self.workers = workers
+        self.timeout = timeout
+        self.vms = vms
+        self.compound = compound
+        self.disk_cache = disk_cache
+        self.debug = debug
+        self.result = {}
+
+    def collect(self):
+        """
+        Collects all hosts from a new event loop
+        Returns the result document as json, see collect_async
+        """
+        return asyncio.run(self.collect_async())
+
+    async def collect_async(self):
+        """
+        Collects all hosts, workers at a time
+        Returns the result document as json :
+            {
+                'hosts': {
+                    <name>: {
+                        'ip': ...
+                        'status': ok, partial (timeout or failure after
+                                  some collections), timeout or error
+                        'error': ... (if not ok)
+                        'duration': seconds
+                        'statistics': ... (see Vm.get_statistics)
+                        'vms_statistics': ... (see Vm.get_vms_statistics)
+                    }
+                },
+                'total': {
+                    'hosts', 'ok', 'failed',
+                    'nb_cpu', 'memory': {'total', 'free'},
+                    'vms': {'number', 'cpu', 'memory'}
+                },
+                'duration': seconds
+            }
+        """
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(self.workers)
+        hosts = await asyncio.gather(*[self._collect_host(host, semaphore) for host in self.inventory])
+        self.result = {'hosts': {}}
+        for host in hosts:
+            self.result['hosts'][host.pop('name')] = host
+        self.result['total'] = self._total(self.result['hosts'].values())
+        self.result['duration'] = round(time.monotonic() - start, 3)
+        log.debug(f"hosts={len(hosts)} duration={self.result['duration']}")
+        return json.dumps(self.result)
+
+    async def _collect_host(self, host, semaphore):
+        """
+        Collects one host within timeout once a worker is available
+        Returns the host result, with its name
+        """
+        host = dict(host)
+        name = host.pop('name', host.get('ip', ''))
+        mock_context = host.pop('mock_context', '')
+        host.setdefault('debug', self.debug)
+        result = {'name': name, 'ip': host.get('ip', ''), 'status': 'ok'}
+        async with semaphore:
+            start = time.monotonic()
+            vm = None
+            try:
+                vm = self.vm_class(**host)
+                vm.compound = self.compound
+                vm.disk_cache = self.disk_cache
+                if mock_context:
+                    vm.ssh.mock(context=mock_context)
+                await asyncio.wait_for(self._collect_vm(vm, result), self.timeout)
+            except asyncio.TimeoutError:
+                log.error(f"host={name} timeout after {self.timeout}s")
+                result['status'] = 'partial' if 'statistics' in result else 'timeout'
+                result['error'] = f"timeout after {self.timeout}s"
+            except Exception as e:
+                log.error(f"host={name} collection failed : {e}")
+                result['status'] = 'error'
+                result['error'] = str(e)
+            finally:
+                if vm:
+                    await vm.close()
+            result['duration'] = round(time.monotonic() - start, 3)
+        return result
+
+    async def _collect_vm(self, vm, result):
+        """
+        Runs the collections of a host, each one recorded in result as soon
+        as done. A collection with failed ssh calls (see Ssh.failures) is
+        still recorded, the host status is then partial, or error if the
+        host could not be reached or all its collections failed
+        """
+        failed = []
+        collections = [('statistics', vm.get_statistics)]
+        if self.vms:
+            collections.append(('vms_statistics', vm.get_vms_statistics))
+        for key, collect in collections:
+            failures = vm.ssh.failures
+            statistics = json.loads(await collect())
+            if not vm.ssh.connected:
+                log.error(f"host={result['name']} connection failed")
+                result['status'] = 'error'
+                result['error'] = "connection failed"
+                return
+            result[key] = statistics
+            if vm.ssh.failures > failures:
+                log.error(f"host={result['name']} {key} collection failed")
+                failed.append(key)
+        if failed:
+            result['status'] = 'error' if len(failed) == len(collections) else 'partial'
+            result['error'] = "failed collections : {}".format(", ".join(failed))
+
+    def _total(self, hosts):
+        """
+        Returns the totals of the host results
+        """
+        total = {'hosts': 0, 'ok': 0, 'failed': 0, 'nb_cpu': 0, 'memory': {'total': 0, 'free': 0},
+                 'vms': {'number': 0, 'cpu': 0, 'memory': 0}}
+        for host in hosts:
+            total['hosts'] += 1
+            if host['status'] == 'ok':
+                total['ok'] += 1
+            else:
+                total['failed'] += 1
+            statistics = host.get('statistics', {})
+            total['nb_cpu'] += statistics.get('nb_cpu', 0)
+            for key in ('total', 'free'):
+                total['memory'][key] += statistics.get('memory', {}).get(key, 0)
+            vms_total = host.get('vms_statistics', {}).get('vms_total', {})
+            for key in ('number', 'cpu', 'memory'):
+                total['vms'][key] += vms_total.get(key, 0)
+        return total
+
+
 """
 Class sample code
 """
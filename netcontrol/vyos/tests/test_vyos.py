@@ -7,7 +7,9 @@ Created on Mar 21, 2019
 import logging as log
 import json
 import unittest
-from vyos import Vyos
+import unittest.mock
+import asyncio
+from vyos import Vyos, AsyncVyos
 
 # create logger
 log.basicConfig(
@@ -47,6 +49,19 @@ class VyosTestCase(unittest.TestCase):
         self.vyos.close()
         self.assertEqual(str(result),expected)
 
+    #@unittest.skip
+    def test_async_get_traffic_policy_v1_1(self):
+        async def run():
+            vyos = AsyncVyos(ip='10.205.10.120', version='1.1', port='10106', user='vyos',
+                             password='vyos', debug=True)
+            vyos.ssh.mock(context='vyosctl1')
+            result = await vyos.get_traffic_policy()
+            await vyos.close()
+            return result
+        result = json.loads(asyncio.run(run()))
+        expected = "{'network_delay': '100', 'packet_corruption': 0, 'packet_loss': '0', 'packet_reordering': '0', 'bandwidth': 0}"
+        self.assertEqual(str(result),expected)
+
     #@unittest.skip
     def test_get_traffic_policy_v1_4(self):
         self.vyos.ssh.mock(context='vyosctl4')
@@ -114,5 +129,24 @@ class VyosTestCase(unittest.TestCase):
         expected = ""
         self.vyos.close()
 
+    #@unittest.skip
+    def test_set_link_status_not_confirmed(self):
+        self.vyos.ssh.mock(context='vyosctl4')
+        shell_send = self.vyos.ssh.shell_send
+        sent = []
+
+        def lost_echo(commands, pipeline=False):
+            sent.append(commands)
+            result = shell_send(commands, pipeline)
+            if pipeline:
+                # batch not seen complete : whole stream in one output
+                self.vyos.ssh.outputs = [self.vyos.ssh.output]
+            return result
+        with unittest.mock.patch.object(self.vyos.ssh, 'shell_send', side_effect=lost_echo):
+            self.vyos.set_link_status(link="eth1", status="down")
+        self.vyos.close()
+        # nothing committed
+        self.assertEqual(sent[1:], [["exit discard\n"]])
+
 if __name__ == '__main__':
     unittest.main() 
@@ -65,27 +65,29 @@ non-configuration mode : (notice the ~ that disappear)
 
 """
 
-from netcontrol.ssh.ssh import Ssh
-import logging as log
+from netcontrol.ssh.ssh import Ssh, AsyncSsh, ssh_steps, debug_log
+import logging
 import re
 import json
 
+log = logging.getLogger('netcontrol.vyos')
+
 
 class Vyos(object):
     """
     classdocs
     """
+    # ssh session class, see AsyncVyos
+    ssh_class = Ssh
+    # default deadline in seconds of each ssh call (see Ssh.deadline)
+    deadline = 30
+
     def __init__(self, version='1.1', ip='', port=22, user='vyos', password='vyos',
                  private_key_file='', traffic_policy='WAN', mock=False,
-                 debug=False):
-        log.basicConfig(
-            format='%(asctime)s,%(msecs)3.3d %(levelname)-8s[%(module)-7.7s.%(funcName)-30.30s:%(lineno)5d] %(message)s',
-            datefmt='%Y%m%d:%H:%M:%S',
-            filename='debug.log',
-            level=log.NOTSET)
+                 debug=False, pool=None, jump=None):
         if debug:
             self.debug = True
-            log.basicConfig(level='DEBUG')
+            debug_log()
         log.debug(f"Constructor with version={version} ip={ip}, port={port}, user={user}, password={password}, private_key_file={private_key_file}, traffic_policy={traffic_policy}, debug={debug}")
 
         self.version = version
@@ -97,7 +99,8 @@ class Vyos(object):
         self.moke_exception = ''
         self.moke_context = ''
         self.debug = debug
-        self.ssh = Ssh(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug)
+        self.ssh = self.ssh_class(ip=ip, port=port, user=user, password=password, private_key_file=private_key_file, debug=debug, pool=pool, jump=jump)
+        self.ssh.deadline = self.deadline
 
         # private attributs
         self._config = {}  # Internal representation of config
@@ -115,9 +118,13 @@ class Vyos(object):
     def trace_mark(self, mark):
         self.ssh.trace_mark(mark)
 
+    def trace_flush(self):
+        self.ssh.trace_flush()
+
     def close(self):
         self.ssh.close()
 
+    @ssh_steps
     def get_traffic_policy(self):
         """
         Get network-emulator settings for the given interface
@@ -137,14 +144,12 @@ class Vyos(object):
         bandwidth = 0
 
         # Send command
-        if not self.ssh.connected:
-            self.ssh.connect()
 
         # issue command and capture output (works for v1.1 and v1.4)
         # version 1.4 parameters are slighlty shorter than 1.1
-        self.run_op_mode_command("show configuration commands | grep network-emulator\n")
+        yield from self.run_op_mode_command.steps(self, "show configuration commands | grep network-emulator\n")
 
-        log.debug("output={}".format(self.ssh.output))
+        log.debug("output=%s", self.ssh.output)
 
         # delay
         search_delay = "(?:network-emulator\s"+self.traffic_policy+"\s(?:network-)?delay\s')(\d+)(?:m?s?')"
@@ -191,6 +196,7 @@ class Vyos(object):
         # If needed, return JSON
         return(json.dumps(self._config))
 
+    @ssh_steps
     def set_traffic_policy(self, network_delay='',
                            packet_loss='',
                            packet_reordering='',
@@ -292,35 +298,29 @@ class Vyos(object):
                 return   
             command_list.append(cmd)
 
-        # Processing commands
+        # Processing commands, statements sent at once
         if (flag_configured):
 
             # Enter configuration more
             if configure:
-                self.ssh.shell_send(["configure\n"])
+                command_list.insert(0, "configure\n")
             else:
                 log.debug("configure is bypassed")
 
-            # Issue our list of configuration commands
-            self.ssh.shell_send(command_list)
-
             # Commit and save
-            if commit:
-                self.ssh.shell_send(["commit\n"])
-            else:
+            if not commit:
                 log.debug("commit is bypassed")
 
-            if save:
-                self.ssh.shell_send(["save\n"])
-            else:
+            if not save:
                 log.debug("save is bypassed")
 
             # Exit from configuration mode
-            if exit:
-                self.ssh.shell_send(["exit\n"])
-            else:
+            if not exit:
                 log.debug("exit is bypassed")
 
+            yield from self._send_config.steps(self, command_list, commit=commit, save=save, exit=exit)
+
+    @ssh_steps
     def set_link_status(self, link='', status=''):
        """
        Set vyos port link UP or DOWN for the given peer_port
@@ -339,15 +339,34 @@ class Vyos(object):
             return
        # send an empty command before commit (or it may fail)
        command_list.append("\n")
-       if not self.ssh.connected:
-            self.ssh.connect()
-       self.ssh.shell_send(["configure\n"])
-       self.ssh.shell_send(command_list)
-       self.ssh.shell_send(["commit\n"])
-       self.ssh.shell_send(["save\n"])
-       self.ssh.shell_send(["exit\n"])
-       return(self.ssh.output)
+       command_list = ["configure\n"] + command_list
+       return (yield from self._send_config.steps(self, command_list))
 
+    @ssh_steps
+    def _send_config(self, command_list, commit=True, save=True, exit=True):
+        """
+        Sends the configuration statements of command_list at once
+        (pipelined), then commit, save and exit one at a time : they are
+        only sent once all statements are confirmed and each one waits for
+        the prompt (a commit takes time). Statements not confirmed are
+        discarded when exiting.
+        Returns the output of all commands
+        """
+        yield 'shell_send', command_list, True
+        output = self.ssh.output
+        if len(command_list) > 1 and len(self.ssh.outputs) < len(command_list):
+            log.error("configuration statements not confirmed, nothing committed")
+            if exit:
+                yield 'shell_send', ["exit discard\n"]
+                output += self.ssh.output
+            return output
+        tail = [cmd for cmd, flag in (("commit\n", commit), ("save\n", save), ("exit\n", exit)) if flag]
+        if tail:
+            yield 'shell_send', tail
+            output += self.ssh.output
+        return output
+
+    @ssh_steps
     def get_link_status(self, device=''):
        """
        Returns a json object representing vyos links status for given device.
@@ -355,14 +374,12 @@ class Vyos(object):
        """
        log.debug(f"Enter with device={device}")
        links = {}
-       if not self.ssh.connected:
-            self.ssh.connect()
-       self.run_op_mode_command("show interfaces ethernet detail | grep qdisc\n")
+       yield from self.run_op_mode_command.steps(self, "show interfaces ethernet detail | grep qdisc\n")
        # Ex:
        #eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc pfifo_fast state UP group default qlen 1000                                                             
        #eth1: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc pfifo_fast state UP group default qlen 1000                                                             
        for line in self.ssh.output.splitlines():
-          log.debug(f"line={line}")
+          log.debug("line=%s", line)
           match_port = re.search("^(?P<port>\S+):\s<", line)
           if match_port:
              port = match_port.group('port')
@@ -380,16 +397,31 @@ class Vyos(object):
         """
         print(json.dumps(self._config, indent=4))
 
+    @ssh_steps
     def run_op_mode_command(self, cmd):
         """
         Use netcontrol shell to send commands to vyos
 
         """
         log.debug("Enter run_op_mode_command with cmd={}".format(cmd))
-        self.ssh.shell_send([cmd])
+        yield 'shell_send', [cmd]
         return(self.ssh.output)
 
 
+class AsyncVyos(Vyos):
+    """
+    asyncio flavour of Vyos, backed by AsyncSsh
+    Every method talking to the device is a coroutine
+    """
+    ssh_class = AsyncSsh
+
+    async def connect(self):
+        await self.ssh.connect()
+
+    async def close(self):
+        await self.ssh.close()
+
+
 """
 Class sample code
 """